@@ -0,0 +1,3 @@
+"""
+Benchmarks, run each module directly e.g. `python -m benchmarks.telemetry`
+"""
@@ -0,0 +1,143 @@
+"""
+Cost and accuracy of every attitude estimator of flight-controller/attitude.py
+
+Samples come from a simulated board rocking in roll and pitch, with gyro bias, gyro noise and accelerometer noise.
+Cost is the time of one update, error the RMS difference between estimated and true roll and pitch once settled.
+Runs on CPython and on MicroPython, for the board copy attitude.py and this file over and run it
+
+    python -m benchmarks.attitude
+    mpremote cp flight-controller/attitude.py :attitude.py + run benchmarks/attitude.py
+"""
+import math
+import sys
+
+try:
+    from time import ticks_diff, ticks_us
+except ImportError:
+    import os
+    import time
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+import attitude  # noqa: E402
+
+RATE = 1000  # Hz
+SECONDS = 4
+# Errors only count after this, while the filters converge
+SETTLE = 1  # seconds
+GYRO_BIAS = (0.5, -0.3, 0.2)  # deg/s
+GYRO_NOISE = 0.1  # deg/s
+ACCEL_NOISE = 0.02  # g
+
+
+class Noise:
+    """
+    Same pseudo random sequence everywhere, MicroPython ports don't all have random
+    """
+
+    def __init__(self, seed=1):
+        self.state = seed
+
+    def __call__(self, amplitude):
+        self.state = (self.state * 1103515245 + 12345) & 0x7FFFFFFF
+        return (self.state / 0x7FFFFFFF * 2 - 1) * amplitude
+
+
+def make_sample(i, noise):
+    """
+    @return: (gx, gy, gz, ax, ay, az, true roll, true pitch) of sample i, made on the fly since all of them don't
+        fit in the memory of the board
+    """
+    t = i / RATE
+    roll = 20 * math.sin(2 * math.pi * 0.5 * t) * attitude.DEG_TO_RAD
+    pitch = 10 * math.sin(2 * math.pi * 0.3 * t) * attitude.DEG_TO_RAD
+    roll_rate = 20 * 2 * math.pi * 0.5 * math.cos(2 * math.pi * 0.5 * t)
+    pitch_rate = 10 * 2 * math.pi * 0.3 * math.cos(2 * math.pi * 0.3 * t)
+    # Body rates of Euler angle rates without yaw
+    gx = roll_rate
+    gy = pitch_rate * math.cos(roll)
+    gz = -pitch_rate * math.sin(roll)
+    return (
+        gx + GYRO_BIAS[0] + noise(GYRO_NOISE),
+        gy + GYRO_BIAS[1] + noise(GYRO_NOISE),
+        gz + GYRO_BIAS[2] + noise(GYRO_NOISE),
+        -math.sin(pitch) + noise(ACCEL_NOISE),
+        math.sin(roll) * math.cos(pitch) + noise(ACCEL_NOISE),
+        math.cos(roll) * math.cos(pitch) + noise(ACCEL_NOISE),
+        roll * attitude.RAD_TO_DEG,
+        pitch * attitude.RAD_TO_DEG,
+    )
+
+
+class Legacy(attitude.Estimator):
+    """
+    What Mpu.loop did before the estimators, complementary and Kalman both computed, the Kalman result unused
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._angles = [0.0, 0.0, 0.0]
+        self._kalman_x = attitude.KalmanAngle()
+        self._kalman_y = attitude.KalmanAngle()
+
+    def update(self, gx, gy, gz, ax, ay, az, dt):
+        rad_to_deg = 180 / 3.14159
+        acc_angles = (
+            math.atan(ay / math.sqrt(math.pow(ax, 2) + math.pow(az, 2))) * rad_to_deg,
+            math.atan((-1 * ax) / math.sqrt(math.pow(ay, 2) + math.pow(az, 2))) * rad_to_deg,
+        )
+        gyr_angles = (gx * dt + self._angles[0], gy * dt + self._angles[1], gz * dt + self._angles[2])
+        alpha = 0.90
+        c_angles = (
+            alpha * gyr_angles[0] + (1.0 - alpha) * acc_angles[0],
+            alpha * gyr_angles[1] + (1.0 - alpha) * acc_angles[1],
+        )
+        self._kalman_x.get_angle(acc_angles[0], gx, dt)
+        self._kalman_y.get_angle(acc_angles[1], gy, dt)
+        self._angles = [c_angles[0], c_angles[1], 0.0]
+        self.roll = c_angles[0]
+        self.pitch = c_angles[1]
+
+
+def run(estimator):
+    """
+    @return: (us per update, RMS roll error, RMS pitch error)
+    """
+    noise = Noise()
+    dt = 1 / RATE
+    count = RATE * SECONDS
+    settle = RATE * SETTLE
+    roll_error = 0.0
+    pitch_error = 0.0
+    elapsed = 0
+    for i in range(count):
+        gx, gy, gz, ax, ay, az, roll, pitch = make_sample(i, noise)
+        started = ticks_us()
+        estimator.update(gx, gy, gz, ax, ay, az, dt)
+        elapsed += ticks_diff(ticks_us(), started)
+        if i >= settle:
+            roll_error += (estimator.roll - roll) ** 2
+            pitch_error += (estimator.pitch - pitch) ** 2
+
+    counted = count - settle
+    return elapsed / count, math.sqrt(roll_error / counted), math.sqrt(pitch_error / counted)
+
+
+def main():
+    print('%s, %d samples at %dHz' % (sys.implementation.name, RATE * SECONDS, RATE))
+    print('%-14s %10s %10s %10s' % ('', 'us/update', 'roll RMS', 'pitch RMS'))
+    estimators = [('old (both)', Legacy)] + [(x, attitude.ESTIMATORS[x]) for x in sorted(attitude.ESTIMATORS)]
+    for name, estimator in estimators:
+        # No unpacking into a tuple on MicroPython
+        cost, roll_error, pitch_error = run(estimator())
+        print('%-14s %10.2f %10.2f %10.2f' % (name, cost, roll_error, pitch_error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Camera frames from one process to several, utils.framebus vs a multiprocessing.Queue per reader
+
+A producer process publishes frames at a fixed rate, every reader process looks at each frame it gets (a few pixels,
+like a consumer that only needs part of it) and reports how many it got, how old they were by then, and the CPU it
+took. A Queue pickles every frame once per reader and pushes it through a pipe, the bus writes it once to shared
+memory. Queues hold 2 frames and drop when full, so both only ever hand over recent frames
+
+    python -m benchmarks.framebus
+"""
+import argparse
+import multiprocessing
+import queue
+import time
+import numpy
+from utils.framebus import FrameBus
+
+SIZES = [(320, 240), (640, 480), (1280, 720)]
+READERS = [1, 3]
+FPS = 30
+DURATION = 3  # seconds
+NAME = 'framebus_benchmark'
+
+
+def make_frames(width, height, count=8):
+    rng = numpy.random.default_rng(1)
+    return [rng.integers(0, 255, (height, width, 3), numpy.uint8) for _ in range(count)]
+
+
+def look(frame) -> int:
+    return int(frame[::32, ::32].sum())
+
+
+def produce(frames, send, fps, duration):
+    """
+    @return: CPU time per frame of the producer in us, what it takes to pickle and pipe counts as well
+    """
+    interval = 1 / fps
+    count = int(fps * duration)
+    started = time.process_time()
+    deadline = time.monotonic()
+    for i in range(count):
+        send(frames[i % len(frames)], time.monotonic_ns())
+        deadline += interval
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    return (time.process_time() - started) / count * 10 ** 6
+
+
+def bus_reader(stop, results):
+    bus = FrameBus.attach(NAME, timeout=5)
+    latencies = []
+    last = 0
+    started = time.process_time()
+    while not stop.is_set():
+        item = bus.wait(last, timeout=0.1)
+        if item is None:
+            continue
+        last, timestamp, frame = item
+        latencies.append(time.monotonic_ns() - timestamp)
+        look(frame)
+    results.put((latencies, time.process_time() - started))
+    bus.close()
+
+
+def queue_reader(frames, stop, results):
+    latencies = []
+    started = time.process_time()
+    while not stop.is_set():
+        try:
+            timestamp, frame = frames.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        latencies.append(time.monotonic_ns() - timestamp)
+        look(frame)
+    results.put((latencies, time.process_time() - started))
+
+
+def run(kind, frames, readers, fps, duration):
+    height, width, channels = frames[0].shape
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+
+    if kind == 'bus':
+        bus = FrameBus.create(NAME, width, height, channels)
+        processes = [multiprocessing.Process(target=bus_reader, args=(stop, results)) for _ in range(readers)]
+        send = bus.write
+    else:
+        queues = [multiprocessing.Queue(2) for _ in range(readers)]
+        processes = [multiprocessing.Process(target=queue_reader, args=(x, stop, results)) for x in queues]
+
+        def send(frame, timestamp):
+            for handoff in queues:
+                try:
+                    handoff.put_nowait((timestamp, frame))
+                except queue.Full:
+                    pass
+
+    for process in processes:
+        process.start()
+    # Let the readers attach
+    time.sleep(0.5)
+    producer_cpu = produce(frames, send, fps, duration)
+    time.sleep(0.2)
+    stop.set()
+
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    if kind == 'bus':
+        bus.close()
+
+    latencies = numpy.concatenate([x[0] for x in collected]) / 10 ** 6
+    received = len(latencies) / readers
+    reader_cpu = sum(x[1] for x in collected) / max(len(latencies), 1) * 10 ** 6
+    return (
+        received / duration, numpy.percentile(latencies, 50), numpy.percentile(latencies, 99),
+        producer_cpu, reader_cpu,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--fps', type=int, default=FPS)
+    parser.add_argument('--duration', type=float, default=DURATION)
+    args = parser.parse_args()
+
+    print('%d frames/s for %ss, latency in ms, CPU in us per frame' % (args.fps, args.duration))
+    print('%-12s %-6s %8s %9s %9s %9s %12s %12s' % (
+        '', '', 'readers', 'frames/s', 'p50', 'p99', 'producer CPU', 'reader CPU',
+    ))
+    for width, height in SIZES:
+        frames = make_frames(width, height)
+        for readers in READERS:
+            for kind in ('queue', 'bus'):
+                print('%-12s %-6s %8d %9.1f %9.2f %9.2f %12.0f %12.0f' % (
+                    '%dx%d' % (width, height), kind, readers, *run(kind, frames, readers, args.fps, args.duration),
+                ))
+
+
+if __name__ == '__main__':
+    main()
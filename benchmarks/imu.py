@@ -0,0 +1,120 @@
+"""
+IMU sample rate, the separate gyro and accel reads Mpu.loop used to do vs the single burst read of Mpu6500.read_into,
+then reading the latest sample once per control loop vs draining the sensor FIFO
+
+The sensor is a stand-in register bus that counts transactions and the time they take on the wire, so the bus side is
+exact for any clock, and the CPU side is whatever this machine takes to run the driver code
+
+    python -m benchmarks.imu
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+from benchmarks import stand_ins
+
+stand_ins.install()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+
+import sensor  # noqa: E402
+
+SAMPLES = 20000
+FREQUENCIES = [400000, 1000000]
+SENSOR_RATE = 1000  # Hz
+LOOP_RATES = [250, 100]  # Hz
+
+
+def make_bus(freq):
+    bus = stand_ins.RegisterBus(freq)
+    # Level and still, 1g on z and a little gyro offset
+    struct.pack_into('>hhhhhhh', bus.registers, 0x3B, 120, -80, 16384, 3000, 12, -7, 3)
+    return bus
+
+
+def old_read(mpu, accel, gyro):
+    # What Mpu.loop did, through raw_gyro and raw_accel
+    gyro = [x for x in mpu.read_gyro_data()]
+    accel = [x for x in mpu.read_accel_data()]
+    return accel, gyro
+
+
+def new_read(mpu, accel, gyro):
+    mpu.read_into(accel, gyro)
+    return accel, gyro
+
+
+def run(read, freq, samples):
+    """
+    @return: (transactions, bytes, bus us, CPU us) per sample
+    """
+    bus = make_bus(freq)
+    mpu = sensor.Mpu6500(bus)
+    accel = [0.0, 0.0, 0.0]
+    gyro = [0.0, 0.0, 0.0]
+    bus.reset_counters()
+
+    started = time.perf_counter()
+    for _ in range(samples):
+        read(mpu, accel, gyro)
+    cpu_us = (time.perf_counter() - started) * 1000000 / samples
+    return bus.transactions / samples, bus.bytes / samples, bus.bus_us / samples, cpu_us
+
+
+def run_loop(fifo, freq, loop_rate, seconds=5):
+    """
+    Sensor sampling at SENSOR_RATE, the control loop reading it at loop_rate
+    @return: (samples used, transactions, bus ms) per second
+    """
+    bus = stand_ins.Mpu6500Bus(freq)
+    mpu = sensor.Mpu6500(bus)
+    if fifo:
+        mpu.enable_fifo(SENSOR_RATE)
+    accel = [0.0, 0.0, 0.0]
+    gyro = [0.0, 0.0, 0.0]
+    bus.reset_counters()
+
+    used = 0
+    per_loop = SENSOR_RATE // loop_rate
+    for i in range(SENSOR_RATE * seconds):
+        bus.sample(gyro=(i % 100, 0, 0))
+        if (i + 1) % per_loop:
+            continue
+        if fifo:
+            for index in range(mpu.read_fifo()):
+                mpu.fifo_sample(index, accel, gyro)
+                used += 1
+        else:
+            mpu.read_into(accel, gyro)
+            used += 1
+    return used / seconds, bus.transactions / seconds, bus.bus_us / seconds / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', type=int, default=SAMPLES)
+    args = parser.parse_args()
+
+    print('%-10s %-12s %13s %12s %9s %9s %14s' % (
+        'bus', 'read', 'transactions', 'bytes', 'bus us', 'CPU us', 'bus samples/s',
+    ))
+    for freq in FREQUENCIES:
+        for name, read in (('gyro+accel', old_read), ('burst', new_read)):
+            transactions, size, bus_us, cpu_us = run(read, freq, args.samples)
+            print('%-10s %-12s %13.0f %12.0f %9.1f %9.2f %14.0f' % (
+                '%dkHz' % (freq // 1000), name, transactions, size, bus_us, cpu_us, 1000000 / bus_us,
+            ))
+
+    print()
+    print('Sensor at %dHz' % SENSOR_RATE)
+    print('%-10s %-6s %-8s %14s %14s %14s' % ('bus', 'loop', 'read', 'samples/s', 'transactions/s', 'bus ms/s'))
+    for freq in FREQUENCIES:
+        for loop_rate in LOOP_RATES:
+            for name, fifo in (('latest', False), ('fifo', True)):
+                print('%-10s %-6s %-8s %14.0f %14.0f %14.1f' % (
+                    '%dkHz' % (freq // 1000), '%dHz' % loop_rate, name, *run_loop(fifo, freq, loop_rate),
+                ))
+
+
+if __name__ == '__main__':
+    main()
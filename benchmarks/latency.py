@@ -0,0 +1,319 @@
+"""
+Input to actuation latency of CONTROL over loopback, for every transport and codec
+
+A scripted controller goes through the real BaseController.loop and ClientConnection.send on asyncio, the real
+ServerConnection, QuadController.run_event and Motor.pwm run on a thread, with stand-ins for the micropython modules.
+Latency is from the moment input is sampled to the last Motor.pwm call of the control cycle that applied it.
+
+    python -m benchmarks.latency --output latency.json
+    python -m benchmarks.latency --compare latency.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from benchmarks import stand_ins
+
+stand_ins.install()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+
+import config  # noqa: E402
+import controller as flight_controller  # noqa: E402
+import motor  # noqa: E402
+import radio  # noqa: E402
+from client.controller import BaseController  # noqa: E402
+from client.radio import ClientConnection  # noqa: E402
+from utils.network import BaseConnection, Codec, NetworkEvent  # noqa: E402
+
+MESSAGES = 3000
+RATE = 1000  # Hz, while measuring latency
+BURST = 5000
+ALLOCATION_MESSAGES = 500
+# How long to wait for the last messages to arrive
+SETTLE_TIMEOUT = 2  # seconds
+
+# (transport, codec), UDP control is always binary
+OPTIONS = [
+    ('tcp', Codec.TEXT),
+    ('tcp', Codec.BINARY),
+    ('udp', Codec.BINARY),
+]
+
+
+def control_key(data):
+    # Text controls carry no sequence, setpoints are made unique instead
+    return int(data[0]), int(data[1]), int(data[2]), int(data[3])
+
+
+class ScriptedController(BaseController):
+    """
+    Sweeps the sticks so every sample is a new setpoint
+    """
+
+    def __init__(self, send_callback):
+        super().__init__(send_callback)
+        self.step = 0
+        self.sampled_at = 0
+
+    def read(self, dt: float):
+        self.sampled_at = time.perf_counter_ns()
+        self.step += 1
+        self.throttle = self.step % 100
+        self.rotation[0] = (self.step // 100) % 50 - 25
+        self.rotation[1] = (self.step // 5000) % 50 - 25
+
+
+class StillSensor:
+    angles = [0.0, 0.0, 0.0]
+
+
+class TimedMotor(motor.Motor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.actuated_at = 0
+
+    def pwm(self, *args, **kwargs):
+        super().pwm(*args, **kwargs)
+        self.actuated_at = time.perf_counter_ns()
+
+
+class Server:
+    """
+    Flight controller side, networking and control on one thread
+    """
+
+    def __init__(self, control_port: int = None):
+        self.controller = flight_controller.QuadController(StillSensor(), *[
+            TimedMotor(config.Motors.FRONT_LEFT, code='FL'),
+            TimedMotor(config.Motors.FRONT_RIGHT, code='FR'),
+            TimedMotor(config.Motors.BACK_RIGHT, code='BR'),
+            TimedMotor(config.Motors.BACK_LEFT, code='BL'),
+        ])
+        self.connection = radio.ServerConnection(self.on_event, host='127.0.0.1', port=0, control_port=control_port)
+        self.port = self.connection.server.getsockname()[1]
+        # {control key: sampled at} written by the client, popped here
+        self.sent = {}
+        self.latencies = []
+        self.actuated = 0
+        self.actuated_at = 0
+        self._running = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def on_event(self, event, data):
+        self.controller.run_event(event, data)
+        if event != NetworkEvent.CONTROL:
+            return
+
+        # Apply right away, the real control loop period would only add a constant
+        self.controller.control()
+        self.actuated += 1
+        self.actuated_at = time.perf_counter()
+        sampled_at = self.sent.pop(control_key(data), None)
+        if sampled_at is not None:
+            # Motor BR is the last one written in QuadController.control
+            self.latencies.append(self.controller.motor_br.actuated_at - sampled_at)
+
+    def run(self):
+        while self._running:
+            self.connection.poll(5)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.connection._conn:
+            self.connection.disconnect()
+        if self.connection._udp:
+            self.connection._udp.close()
+        self.connection.server.close()
+
+
+def free_udp_port() -> int:
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def settle(server, expected):
+    """
+    Wait until everything was applied, or nothing was for a while since UDP lets newer setpoints replace older ones
+    """
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    previous = -1
+    while server.actuated < expected and server.actuated != previous and time.monotonic() < deadline:
+        previous = server.actuated
+        await asyncio.sleep(0.05)
+
+
+async def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.001)
+    return condition()
+
+
+async def drive(server, transport, codec, messages, rate, burst):
+    control_port = server.connection._udp.getsockname()[1] if transport == 'udp' else None
+    connection = ClientConnection(lambda event, data: None, host='127.0.0.1', port=server.port,
+                                  codec=codec, control_port=control_port)
+    await connection.open()
+    connection.handshake()
+    if not await wait_for(lambda: connection.codec == codec and server.connection.codec == codec, SETTLE_TIMEOUT):
+        raise RuntimeError('codec %s was not negotiated' % codec)
+
+    def send(event, data):
+        server.sent[control_key(data)] = controller.sampled_at
+        connection.send(event, data)
+
+    controller = ScriptedController(send)
+    loop = asyncio.get_running_loop()
+
+    # Paced, like a stick sampled every 1 / rate seconds
+    deadline = loop.time()
+    for _ in range(messages):
+        controller.loop()
+        deadline += 1 / rate
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+    await settle(server, messages)
+    latencies = list(server.latencies)
+    paced_actuated = server.actuated
+
+    # Burst, as fast as the client can send, to see what the server keeps up with
+    server.sent.clear()
+    server.actuated = 0
+    started = time.perf_counter()
+    for i in range(burst):
+        controller.loop()
+        if not i % 100:
+            await asyncio.sleep(0)
+    sent_elapsed = time.perf_counter() - started
+    await settle(server, burst)
+    burst_elapsed = server.actuated_at - started
+
+    connection.close()
+    await wait_for(lambda: connection.closed.done(), SETTLE_TIMEOUT)
+    return latencies, paced_actuated, burst / sent_elapsed, server.actuated / burst_elapsed
+
+
+def measure_allocations(codec, messages):
+    """
+    Bytes allocated while decoding and applying one CONTROL, on the server side only since that is what runs on
+    the microcontroller. Peak above the starting point per message, tracemalloc can't count individual allocations
+    """
+    server = Server()
+    sender = BaseConnection(None)
+    sender.codec = codec
+    frames = []
+    for i in range(messages):
+        frame = bytearray()
+        sender._write = lambda _conn, data: frame.extend(data)
+        sender._send(None, NetworkEvent.CONTROL, (i % 100, (i // 100) % 50 - 25, 0, 0, i + 1, 0))
+        frames.append(bytes(frame))
+
+    reader = server.connection.reader
+    dispatch = server.connection.dispatch
+    total = 0
+    tracemalloc.start()
+    for frame in frames:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        reader.feed(frame, dispatch)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    server.stop()
+    return total / messages
+
+
+def run(transport, codec, messages, rate, burst):
+    server = Server(control_port=free_udp_port() if transport == 'udp' else None)
+    server.start()
+    try:
+        latencies, actuated, sent_rate, actuated_rate = asyncio.run(drive(server, transport, codec, messages, rate, burst))
+    finally:
+        server.stop()
+
+    us = [x / 1000 for x in latencies]
+    return {
+        'transport': transport,
+        'codec': codec,
+        'messages': messages,
+        'actuated': actuated,
+        # Lost on TCP, replaced by a newer setpoint before being applied on UDP
+        'skipped': messages - actuated,
+        'p50_us': percentile(us, 0.5),
+        'p99_us': percentile(us, 0.99),
+        'p999_us': percentile(us, 0.999),
+        'max_us': max(us) if us else None,
+        'sent_per_s': sent_rate,
+        'actuated_per_s': actuated_rate,
+        'alloc_bytes_per_msg': measure_allocations(codec, ALLOCATION_MESSAGES),
+    }
+
+
+def name(result):
+    return '%s/%s' % (result['transport'], result['codec'])
+
+
+def print_results(results, baseline=None):
+    baseline = {name(x): x for x in (baseline or [])}
+    columns = ['p50_us', 'p99_us', 'p999_us', 'actuated_per_s', 'alloc_bytes_per_msg']
+    print('%-12s %10s %10s %10s %12s %10s %7s' % ('', 'p50 us', 'p99 us', 'p999 us', 'msgs/s', 'alloc B', 'skipped'))
+    for result in results:
+        print('%-12s %10.1f %10.1f %10.1f %12.0f %10.1f %7d' % (
+            name(result), *[result[x] or 0 for x in columns], result['skipped'],
+        ))
+        previous = baseline.get(name(result))
+        if previous:
+            print('%-12s %+9.0f%% %+9.0f%% %+9.0f%% %+11.0f%% %+9.0f%%' % ('  vs base', *[
+                (result[x] - previous[x]) / previous[x] * 100 if previous.get(x) else 0 for x in columns
+            ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    parser.add_argument('--rate', type=int, default=RATE)
+    parser.add_argument('--burst', type=int, default=BURST)
+    parser.add_argument('--output', help='Save results as JSON')
+    parser.add_argument('--compare', help='JSON from an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = [run(transport, codec, args.messages, args.rate, args.burst) for transport, codec in OPTIONS]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'rate': args.rate,
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Stand-ins for the micropython only modules the flight controller imports, so its code can run on a desktop
+
+Only what the controller, motors, radio and sensor touch is there, and only installed when the real module is missing.
+RegisterBus stands in for an I2C bus with a device on it, for driving the sensor code without the sensor
+"""
+import struct
+import sys
+import time
+import types
+from utils import helpers
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, pin, mode=IN, *args, **kwargs):
+        self.pin = pin
+        self.mode = mode
+        self._value = 0
+        self._handler = None
+        self._trigger = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+        self._trigger = trigger
+
+    def pulse(self):
+        """
+        Driven high then low from the outside, running the interrupt handler for either edge
+        """
+        for value, trigger in ((1, self.IRQ_RISING), (0, self.IRQ_FALLING)):
+            self._value = value
+            if self._handler and self._trigger & trigger:
+                self._handler(self)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+
+class PWM:
+    def __init__(self, pin, freq: int = 50, *args, **kwargs):
+        self.pin = pin
+        self.freq = freq
+        self.duty = 0
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self.duty
+        self.duty = int(value)
+
+
+class I2C:
+    def __init__(self, *args, **kwargs):
+        raise OSError('no I2C bus on this machine')
+
+
+class RegisterBus:
+    """
+    I2C bus with one device behind it, seen as 128 byte wide registers. Counts transactions and the time they would
+    take on the wire at `freq`, every byte is 9 clocks and a transaction has address, register and start/stop on top
+    """
+
+    def __init__(self, freq: int = 400000, address: int = 0x68):
+        self.freq = freq
+        self.address = address
+        self.registers = bytearray(128)
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_us = 0.0
+
+    def _transfer(self, address: int, size: int):
+        if address != self.address:
+            raise OSError(19)
+        self.transactions += 1
+        self.bytes += size
+        # Address + register, then a repeated start and the address again for reads
+        self.bus_us += (9 * (size + 3) + 3) * 1000000 / self.freq
+
+    def read(self, register: int, size: int) -> bytes:
+        return bytes(self.registers[register:register + size])
+
+    def write(self, register: int, buf):
+        self.registers[register:register + len(buf)] = buf
+
+    def readfrom_mem(self, address: int, register: int, size: int) -> bytes:
+        self._transfer(address, size)
+        return self.read(register, size)
+
+    def readfrom_mem_into(self, address: int, register: int, buf):
+        self._transfer(address, len(buf))
+        buf[:] = self.read(register, len(buf))
+
+    def writeto_mem(self, address: int, register: int, buf):
+        self._transfer(address, len(buf))
+        self.write(register, buf)
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_us = 0.0
+
+
+class Mpu6500Bus(RegisterBus):
+    """
+    RegisterBus with an MPU6500 on it, `sample` latches a reading into the output registers and, while they are
+    enabled, into the FIFO (accel and gyro only) and pulses the data ready interrupt on `int_pin`
+    """
+    FIFO_SIZE = 512
+
+    def __init__(self, freq: int = 400000, int_pin: Pin = None):
+        super().__init__(freq)
+        self.fifo = bytearray()
+        self.int_pin = int_pin
+
+    def sample(self, accel=(0, 0, 16384), temperature: int = 0, gyro=(0, 0, 0)):
+        struct.pack_into('>hhhhhhh', self.registers, 0x3B, *accel, temperature, *gyro)
+        fifo_on = self.registers[0x6A] & 0x40 and self.registers[0x23] & 0x78 == 0x78
+        # Full FIFO stops taking samples
+        if fifo_on and len(self.fifo) + 12 <= self.FIFO_SIZE:
+            self.fifo += self.registers[0x3B:0x41] + self.registers[0x43:0x49]
+        if self.int_pin and self.registers[0x38] & 0x01:
+            self.int_pin.pulse()
+
+    def read(self, register: int, size: int) -> bytes:
+        if register == 0x72:
+            return bytes([len(self.fifo) >> 8, len(self.fifo) & 0xFF])[:size]
+        if register == 0x74:
+            data = bytes(self.fifo[:size])
+            del self.fifo[:size]
+            return data
+        return super().read(register, size)
+
+    def write(self, register: int, buf):
+        super().write(register, buf)
+        if register == 0x6A and buf[0] & 0x04:
+            # FIFO reset clears itself
+            self.fifo = bytearray()
+            self.registers[0x6A] &= ~0x04
+
+
+def _machine():
+    module = types.ModuleType('machine')
+    module.Pin = Pin
+    module.PWM = PWM
+    module.I2C = I2C
+    return module
+
+
+def _utime():
+    module = types.ModuleType('utime')
+    module.ticks_ms = helpers.ticks_ms
+    module.ticks_us = helpers.ticks_us
+    module.ticks_diff = helpers.ticks_diff
+    module.ticks_add = helpers.ticks_add
+    module.sleep = time.sleep
+    module.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    module.sleep_us = lambda us: time.sleep(us / 1000000)
+    module.time = time.time
+    module.time_ns = time.time_ns
+    return module
+
+
+def _micropython():
+    module = types.ModuleType('micropython')
+    module.const = lambda value: value
+    return module
+
+
+STAND_INS = {
+    'machine': _machine,
+    'utime': _utime,
+    'ustruct': lambda: struct,
+    'micropython': _micropython,
+}
+
+
+def install():
+    for name, factory in STAND_INS.items():
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = factory()
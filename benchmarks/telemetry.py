@@ -0,0 +1,67 @@
+"""
+Bytes and send calls per telemetry cycle, one frame per record vs a single snapshot frame
+"""
+import time
+from utils import network, telemetry
+from utils.network import BaseConnection, Codec, NetworkEvent
+
+CYCLES = 400
+
+
+class CountingSocket:
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def send(self, data):
+        self.calls += 1
+        self.bytes += len(data)
+        return len(data)
+
+
+def per_record(connection, sock, handler):
+    # What Telemetry.loop used to do
+    for record in telemetry.TelemetryRecord.all():
+        value = telemetry.TelemetryRecord.read_value(record, **handler.options)
+        connection._send(sock, NetworkEvent.TELEMETRY, (record, telemetry.format_value(value)))
+
+
+def snapshot(connection, sock, handler):
+    connection._send(sock, NetworkEvent.SNAPSHOT, handler.snapshot())
+
+
+def scheduled(connection, sock, handler):
+    payload = handler.collect()
+    if len(payload):
+        connection._send(sock, NetworkEvent.SNAPSHOT, payload)
+
+
+def run(name, codec, func):
+    sock = CountingSocket()
+    connection = BaseConnection(None)
+    connection.codec = codec
+    handler = telemetry.Telemetry(None)
+
+    elapsed = 0
+    for _ in range(CYCLES):
+        started = time.perf_counter()
+        func(connection, sock, handler)
+        elapsed += time.perf_counter() - started
+        if func is scheduled:
+            # Let the schedule see real time passing, one telemetry cycle per iteration
+            time.sleep(handler.cycle_speed / 1000)
+
+    print('%-22s %8.1f %8.1f %10.1f' % (name, sock.bytes / CYCLES, sock.calls / CYCLES, elapsed / CYCLES * 10 ** 6))
+
+
+def main():
+    print('%-22s %8s %8s %10s' % ('', 'bytes', 'sends', 'us/cycle'))
+    run('per record (text)', Codec.TEXT, per_record)
+    run('per record (binary)', Codec.BINARY, per_record)
+    run('snapshot (binary)', Codec.BINARY, snapshot)
+    run('scheduled (binary)', Codec.BINARY, scheduled)
+    print('%d records per cycle, max payload %d bytes' % (len(telemetry.TelemetryRecord.all()), network.MAX_PAYLOAD))
+
+
+if __name__ == '__main__':
+    main()
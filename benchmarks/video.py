@@ -0,0 +1,128 @@
+"""
+Encode and decode time and bytes per frame of every video frame setting, and of the PNG + pickle it replaced
+
+Frames are synthetic (gradient, moving shapes and sensor noise) so runs compare across machines without a camera.
+Delta frames are measured on a mostly static scene, one small object moving like a hovering drone would see
+
+    python -m benchmarks.video
+"""
+import argparse
+import pickle
+import time
+import cv2
+import numpy
+from utils import camera
+from utils.camera import FrameCodec
+from utils.delta import DeltaEncoder
+
+FRAMES = 60
+SIZES = [(320, 240), (640, 480)]
+
+# (name, codec, quality, png compression)
+SETTINGS = [
+    ('jpeg q50', FrameCodec.JPEG, 50, None),
+    ('jpeg q70', FrameCodec.JPEG, 70, None),
+    ('jpeg q80', FrameCodec.JPEG, 80, None),
+    ('jpeg q90', FrameCodec.JPEG, 90, None),
+    ('png c1 (lossless)', FrameCodec.PNG, None, 1),
+    ('png c3 (lossless)', FrameCodec.PNG, None, 3),
+]
+
+
+def make_frames(width, height, count, noise=4.0, static=False):
+    """
+    Grayscale frames like Capture.process_frame hands over
+    @param static: Only one small shape moves
+    """
+    rng = numpy.random.default_rng(0)
+    gradient = numpy.tile(numpy.linspace(40, 200, width, dtype=numpy.float32), (height, 1))
+    frames = []
+    for i in range(count):
+        frame = gradient + rng.normal(0, noise, (height, width)).astype(numpy.float32)
+        frame = numpy.clip(frame, 0, 255).astype(numpy.uint8)
+        x = (i * 7) % width
+        if not static:
+            cv2.rectangle(frame, (x, height // 4), (x + width // 8, height // 2), 230, -1)
+        cv2.circle(frame, (width - x, 3 * height // 4), height // 20 if static else height // 10, 20, -1)
+        frames.append(frame)
+    return frames
+
+
+def old_encode(frame) -> bytes:
+    # What Capture.read used to send
+    data = pickle.dumps(cv2.imencode('.png', frame)[1])
+    return len(data).to_bytes(8, 'little') + data
+
+
+def old_decode(data):
+    return pickle.loads(data[8:])
+
+
+def new_decode(data):
+    header = camera.decode_header(data)
+    return camera.decode_image(memoryview(data)[camera.FRAME_HEADER_SIZE:camera.FRAME_HEADER_SIZE + header.length])
+
+
+def measure(frames, encode, decode):
+    encoded = []
+    started = time.perf_counter()
+    for frame in frames:
+        encoded.append(encode(frame))
+    encode_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for data in encoded:
+        decode(data)
+    decode_time = time.perf_counter() - started
+
+    count = len(frames)
+    return encode_time / count * 10 ** 3, decode_time / count * 10 ** 3, sum(len(x) for x in encoded) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    args = parser.parse_args()
+
+    for width, height in SIZES:
+        frames = make_frames(width, height, args.frames)
+        print('%dx%d' % (width, height))
+        print('%-26s %10s %10s %10s' % ('', 'encode ms', 'decode ms', 'bytes'))
+        print('%-26s %10.2f %10.2f %10.0f' % ('png + pickle (old)', *measure(frames, old_encode, old_decode)))
+        for name, codec, quality, compression in SETTINGS:
+            params = camera.encode_params(codec, quality=quality, compression=compression)
+
+            def encode(frame):
+                return camera.encode_frame(frame, codec, params, 0)
+
+            print('%-26s %10.2f %10.2f %10.0f' % (name, *measure(frames, encode, new_decode)))
+        print()
+
+        # Sensor noise of a real camera in decent light
+        frames = make_frames(width, height, args.frames, noise=1.5, static=True)
+        print('%dx%d static scene' % (width, height))
+        print('%-26s %10s %10s %10s %8s' % ('', 'encode ms', 'decode ms', 'bytes', 'ratio'))
+        for name, codec, quality, compression in SETTINGS[2:5:2]:
+            params = camera.encode_params(codec, quality=quality, compression=compression)
+            full = measure(frames, lambda frame: camera.encode_frame(frame, codec, params, 0), new_decode)
+            print('%-26s %10.2f %10.2f %10.0f' % (name, *full))
+
+            encoder = DeltaEncoder()
+            receiver = camera.FrameReceiver(lambda image: None)
+            sequence = [0]
+
+            def encode(frame):
+                sequence[0] += 1
+                return camera.encode_delta_frame(frame, encoder, codec, params, sequence[0])
+
+            def decode(data):
+                header = camera.decode_header(data)
+                return receiver.decode_frame(header, memoryview(data)[camera.FRAME_HEADER_SIZE:])
+
+            delta = measure(frames, encode, decode)
+            print('%-26s %10.2f %10.2f %10.0f %7.1fx' % (name + ' delta', *delta, full[2] / delta[2]))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Video receive throughput over loopback, the old concatenating receiver vs the zero copy camera.Client
+
+Frames are the synthetic ones of benchmarks.video, encoded once and sent back to back as fast as the socket goes
+
+    python -m benchmarks.video_receive
+"""
+import argparse
+import socket
+import threading
+import time
+from benchmarks.video import make_frames, SIZES
+from utils import camera
+from utils.camera import FrameCodec
+
+FRAMES = 500
+# (name, codec, quality)
+SETTINGS = [
+    ('jpeg q80', FrameCodec.JPEG, 80),
+    ('png (lossless)', FrameCodec.PNG, None),
+]
+
+
+def serve(server, stream, count):
+    conn, _ = server.accept()
+    for i in range(count):
+        conn.sendall(stream[i % len(stream)])
+    conn.close()
+
+
+def old_receive(sock, count):
+    # What camera.Client.loop used to do, minus pickle
+    data = b''
+    received = 0
+    while received < count:
+        while len(data) < camera.FRAME_HEADER_SIZE:
+            data += sock.recv(camera.BUFFER_SIZE)
+        length = camera.decode_header(data).length
+        data = data[camera.FRAME_HEADER_SIZE:]
+        while len(data) < length:
+            data += sock.recv(camera.BUFFER_SIZE)
+        data = data[length:]
+        received += 1
+
+
+def new_receive(sock, count, decode):
+    # Same as camera.Client.loop
+    receiver = camera.FrameReceiver(lambda frame: None, decode=decode)
+    while receiver.frames < count:
+        size = sock.recv_into(receiver.buffer())
+        if not size:
+            break
+        receiver.advance(size)
+
+
+def run(stream, count, receive):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    thread = threading.Thread(target=serve, args=(server, stream, count), daemon=True)
+    thread.start()
+
+    sock = socket.create_connection(server.getsockname())
+    started = time.perf_counter()
+    receive(sock, count)
+    elapsed = time.perf_counter() - started
+    sock.close()
+    thread.join()
+    server.close()
+
+    size = sum(len(stream[i % len(stream)]) for i in range(count))
+    return count / elapsed, size / elapsed / 10 ** 6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    args = parser.parse_args()
+
+    receivers = [
+        ('old (concatenate)', old_receive),
+        ('recv_into', lambda sock, count: new_receive(sock, count, False)),
+        ('recv_into + decode', lambda sock, count: new_receive(sock, count, True)),
+    ]
+    for width, height in SIZES:
+        for setting, codec, quality in SETTINGS:
+            params = camera.encode_params(codec, quality=quality)
+            stream = [camera.encode_frame(x, codec, params, i + 1) for i, x in enumerate(make_frames(width, height, 30))]
+            print('%dx%d %s, %d bytes/frame' % (width, height, setting, sum(len(x) for x in stream) / len(stream)))
+            print('%-20s %10s %10s' % ('', 'frames/s', 'MB/s'))
+            for name, receive in receivers:
+                print('%-20s %10.0f %10.1f' % (name, *run(stream, args.frames, receive)))
+            print()
+
+
+if __name__ == '__main__':
+    main()
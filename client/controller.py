@@ -9,19 +9,96 @@ MAX_THROTTLE = 100
 MIN_THROTTLE = 0
 
 
-class KeyboardController:
+class BaseController:
+    """
+    Samples inputs every `cycle_speed` seconds but only sends a setpoint when it moved past the deadband,
+    when nothing changes the last setpoint is sent again every `keepalive_speed` seconds so the flight controller
+    doesn't reset to idle (see QuadController.time_before_reset)
+    """
+
+    cycle_speed = 0.005
+    keepalive_speed = 0.1
+    throttle_deadband = 1  # percentage
+    rotation_deadband = 1  # degrees
+
     def __init__(self, send_callback):
         self.send_callback = send_callback
         self.throttle = INT_THROTTLE
         # [ROLL, PITCH, YAW]
         self.rotation = [0, 0, 0]
 
+        self._sent_throttle = None
+        self._sent_rotation = [0, 0, 0]
+        self._sent_time = 0
+        self._sample_time = None
+        # Setpoints sent because they changed, and because of keepalive
+        self.sent_changes = 0
+        self.sent_keepalives = 0
+
+    def read(self, dt: float):
+        """
+        Update throttle and rotation from inputs, dt is time since last read in seconds
+        """
+        raise NotImplementedError
+
+    def changed(self) -> bool:
+        if self._sent_throttle is None:
+            return True
+
+        if abs(self.throttle - self._sent_throttle) >= self.throttle_deadband:
+            return True
+
+        for current, sent in zip(self.rotation, self._sent_rotation):
+            if abs(current - sent) >= self.rotation_deadband:
+                return True
+
+        # Always let throttle reach its limits exactly, even by less than the deadband
+        return self.throttle != self._sent_throttle and self.throttle in (MIN_THROTTLE, MAX_THROTTLE)
+
+    def loop(self):
+        now = time.monotonic()
+        dt = now - self._sample_time if self._sample_time is not None else 0
+        self._sample_time = now
+        self.read(dt)
+
+        if self.changed():
+            self.sent_changes += 1
+        elif now - self._sent_time >= self.keepalive_speed:
+            self.sent_keepalives += 1
+        else:
+            return
+
+        self._sent_throttle = self.throttle
+        self._sent_rotation[:] = self.rotation
+        self._sent_time = now
+        self.send_callback(network.NetworkEvent.CONTROL, (self.throttle, *self.rotation))
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def run(self):
+        """
+        Actually transform raw inputs into throttle and target angle
+        """
+
+        self.start()
+        while True:
+            self.loop()
+            time.sleep(self.cycle_speed)
+
+
+class KeyboardController(BaseController):
+    def __init__(self, send_callback):
+        super().__init__(send_callback)
+
         # YAW Rotation factor, currently this is just a flag since we dont have a compass meter yet
         self.rotation_angle = 90
         self.move_angle = 15  # Change rate by degrees
-        self.move_throttle = 5  # Change rate
+        self.move_throttle = 100  # Change rate in percentage per second
 
-        self.cycle_speed = 0.05
         # Pressed down state of all keys
         self._state = {
             'left': False,
@@ -39,7 +116,7 @@ class KeyboardController:
         # Only update when window is in focus
         self._state[event.name] = event.event_type == keyboard.KEY_DOWN
 
-    def loop(self):
+    def read(self, dt: float):
         _state = self._state
         roll_controls = [_state['left'], _state['right']]
         if any(roll_controls) and not all(roll_controls):
@@ -61,24 +138,17 @@ class KeyboardController:
 
         throttle_controls = [_state['w'], _state['s']]
         if any(throttle_controls) and not all(throttle_controls):
-            self.throttle += self.move_throttle * (- 1 if _state['s'] else 1)
+            self.throttle += self.move_throttle * dt * (- 1 if _state['s'] else 1)
             self.throttle = helpers.clamp(self.throttle, MIN_THROTTLE, MAX_THROTTLE)
 
-        self.send_callback(network.NetworkEvent.CONTROL, helpers.encode_control(self.throttle, *self.rotation))
-
-    def run(self):
-        """
-        Actually transform raw inputs into throttle and target angle
-        should run every like 50ms
-        """
-
+    def start(self):
         keyboard.hook(self.run_event)
-        while True:
-            self.loop()
-            time.sleep(self.cycle_speed)
+
+    def stop(self):
+        keyboard.unhook(self.run_event)
 
 
-class GamepadController:
+class GamepadController(BaseController):
     """
     Controller Scheme
 
@@ -95,15 +165,11 @@ class GamepadController:
     """
 
     def __init__(self, send_callback):
-        self.send_callback = send_callback
-        self.throttle = INT_THROTTLE
-        # [ROLL, PITCH, YAW]
-        self.rotation = [0, 0, 0]
+        super().__init__(send_callback)
 
         # YAW Rotation factor, currently this is just a flag since we dont have a compass meter yet
         self.rotation_angle = 90
         self.max_angle = 25  # Max angle -/+
-        self.cycle_speed = 0.05
 
         self.AXIS = {
             'ROLL': 2,
@@ -116,7 +182,7 @@ class GamepadController:
         pygame.joystick.init()
         self.joystick = pygame.joystick.Joystick(0)
 
-    def loop(self):
+    def read(self, dt: float):
         pygame.event.pump()
 
         roll_axis = self.joystick.get_axis(self.AXIS['ROLL'])
@@ -141,16 +207,3 @@ class GamepadController:
         # This normalizes -1.0 to 1.0 range to be 0, 1.0 range * 100 is percentage
         throttle_axis = (self.joystick.get_axis(self.AXIS['THROTTLE']) * -1 + 1) / 2.0
         self.throttle = helpers.clamp(round(throttle_axis * 100, 2), MIN_THROTTLE, MAX_THROTTLE)
-
-        self.send_callback(network.NetworkEvent.CONTROL, helpers.encode_control(self.throttle, *self.rotation))
-        print(f'{self.throttle}, {self.rotation[0]}, {self.rotation[1]}, {self.rotation[2]}')
-
-    def run(self):
-        """
-        Actually transform raw inputs into throttle and target angle
-        should run every like 50ms
-        """
-
-        while True:
-            self.loop()
-            time.sleep(self.cycle_speed)
@@ -0,0 +1,184 @@
+"""
+Link quality from PING/PONG round trips
+
+Every PONG gives the four NTP timestamps: client send (t0), server receive (t1), server send (t2) and client
+receive (t3), from which
+
+    round trip = (t3 - t0) - (t2 - t1)
+    clock offset = ((t1 - t0) + (t2 - t3)) / 2
+
+Queueing delay only ever adds to the round trip and skews the offset, so like NTP the offset is taken from the
+fastest round trip of the window. Everything is O(1) per pong apart from that, and the window is small
+"""
+import collections
+from utils import helpers
+
+# Client side records, shown next to the telemetry of the flight controller
+LINK_RTT = 'LINK_RTT'
+LINK_JITTER = 'LINK_JITTER'
+LINK_LOSS = 'LINK_LOSS'
+LINK_OFFSET = 'LINK_OFFSET'
+RTT_HISTOGRAM = 'RTT_HIST'
+JITTER_HISTOGRAM = 'JITTER_HIST'
+LOSS_HISTOGRAM = 'LOSS_HIST'
+RECORDS = [LINK_RTT, LINK_JITTER, LINK_LOSS, LINK_OFFSET, RTT_HISTOGRAM, JITTER_HISTOGRAM, LOSS_HISTOGRAM]
+
+# Upper bound of every histogram bucket, anything above the last one goes in an extra bucket
+RTT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)  # ms
+JITTER_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50)  # ms
+LOSS_BUCKETS = (1, 2, 4, 8, 16)  # pings lost in a row
+
+
+def bucket_labels(bounds) -> str:
+    return ' '.join(['<=%s' % x for x in bounds] + ['>%s' % bounds[-1]])
+
+
+class Histogram:
+    """
+    Fixed buckets over the last `window` values, a value leaving the window is taken out of its bucket
+    """
+
+    def __init__(self, bounds, window: int):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        # Bucket of every value in the window
+        self._window = collections.deque(maxlen=window)
+
+    def bucket(self, value) -> int:
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                return index
+        return len(self.bounds)
+
+    def add(self, value):
+        if len(self._window) == self._window.maxlen:
+            self.counts[self._window[0]] -= 1
+        index = self.bucket(value)
+        self._window.append(index)
+        self.counts[index] += 1
+
+    def __str__(self):
+        return ' '.join([str(x) for x in self.counts])
+
+
+class LinkEstimator:
+    """
+    Round trip, jitter, clock offset and loss of the last `window` pings, times in us
+    """
+    window = 64
+    # A ping without a pong by then is lost, a late pong is ignored
+    timeout = 2000000  # us
+
+    def __init__(self):
+        self.next_id = 0
+        # {ping id: sent at}, oldest first
+        self.pending = {}
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.rtt = None
+        # Interarrival jitter of RFC 3550, a running average of round trip changes
+        self.jitter = 0.0
+        # (round trip, offset) and whether each ping got an answer, over the window
+        self._samples = collections.deque(maxlen=self.window)
+        self._answered = collections.deque(maxlen=self.window)
+        self._lost_run = 0
+
+        self.rtt_histogram = Histogram(RTT_BUCKETS, self.window)
+        self.jitter_histogram = Histogram(JITTER_BUCKETS, self.window)
+        self.loss_histogram = Histogram(LOSS_BUCKETS, self.window)
+
+    @property
+    def min_rtt(self):
+        return min(self._samples)[0] if self._samples else None
+
+    @property
+    def offset(self):
+        """
+        Server clock minus client clock, from the fastest round trip in the window
+        """
+        return min(self._samples)[1] if self._samples else None
+
+    @property
+    def loss(self) -> float:
+        """
+        Fraction of the pings in the window that got no answer
+        """
+        if not self._answered:
+            return 0.0
+        return self._answered.count(False) / len(self._answered)
+
+    def _expire(self, now: int):
+        for ping_id in list(self.pending):
+            if now - self.pending[ping_id] < self.timeout:
+                # Oldest first, the rest are even younger
+                break
+            del self.pending[ping_id]
+            self.lost += 1
+            self._lost_run += 1
+            self._answered.append(False)
+
+    def ping(self, now: int):
+        """
+        @param now: client time in us
+        @return: PING payload
+        """
+        self._expire(now)
+        self.next_id = helpers.next_sequence(self.next_id)
+        self.pending[self.next_id] = now
+        self.sent += 1
+        return (
+            self.next_id,
+            now & helpers.SEQUENCE_MASK,
+            min(self.rtt or 0, helpers.SEQUENCE_MASK),
+            min(int(self.jitter), helpers.SEQUENCE_MASK),
+            int(self.loss * 1000),
+        )
+
+    def pong(self, data, now: int) -> bool:
+        """
+        @param data: PONG payload
+        @param now: client time in us it was received at
+        @return: False when the pong is not for a pending ping
+        """
+        ping_id, echoed, server_ms, held = data
+        sent = self.pending.get(ping_id)
+        if sent is None or echoed != sent & helpers.SEQUENCE_MASK:
+            return False
+        del self.pending[ping_id]
+
+        rtt = max(0, now - sent - held)
+        received = server_ms * 1000
+        offset = ((received - sent) + (received + held - now)) // 2
+
+        if self.rtt is not None:
+            change = abs(rtt - self.rtt)
+            self.jitter += (change - self.jitter) / 16
+            self.jitter_histogram.add(change / 1000)
+        if self._lost_run:
+            self.loss_histogram.add(self._lost_run)
+            self._lost_run = 0
+
+        self.rtt = rtt
+        self.received += 1
+        self._samples.append((rtt, offset))
+        self._answered.append(True)
+        self.rtt_histogram.add(rtt / 1000)
+        return True
+
+    def records(self) -> dict:
+        """
+        @return: {record: value} for the telemetry store
+        """
+        if self.rtt is None:
+            return {LINK_LOSS: '%.1f%% (%d/%d)' % (self.loss * 100, self.lost, self.sent)}
+
+        return {
+            LINK_RTT: '%.1fms (MIN %.1f)' % (self.rtt / 1000, self.min_rtt / 1000),
+            LINK_JITTER: '%.2fms' % (self.jitter / 1000),
+            LINK_LOSS: '%.1f%% (%d/%d)' % (self.loss * 100, self.lost, self.sent),
+            LINK_OFFSET: '%+.1fms' % (self.offset / 1000),
+            RTT_HISTOGRAM: str(self.rtt_histogram),
+            JITTER_HISTOGRAM: str(self.jitter_histogram),
+            LOSS_HISTOGRAM: str(self.loss_histogram),
+        }
@@ -3,92 +3,83 @@ This is the client code, to be used to control PI Remotely using
 keyboard or gamepad
 """
 import logging
-import threading
+import queue
+import time
 import PySimpleGUI as sg
 from multiprocessing import freeze_support
-from utils import telemetry, helpers
-from client.controller import GamepadController, KeyboardController
-from client.radio import NetworkEvent, ClientConnection
+from utils import telemetry
+from client import link, runtime
 import config
 
 logger = logging.Logger(__name__)
 
 if config.CAMERA_ENABLED:
-    from utils import camera
+    import cv2
 
 EVENT_OUTPUT = '-OUTPUT-'
 EVENT_RECONNECT = '-RECONNECT-'
 EVENT_CAMERA_FEED = '-CAMERA_FEED-'
 EVENT_IP_ADDRESS_FIELD = '-EVENT_IP_ADDRESS_FIELD-'
+EVENT_BLACKBOX = '-BLACKBOX-'
+EVENT_UI_SAVED = '-UI_SAVED-'
 
-CLIENT_THREAD = None
-CONTROLLER_THREAD = None
-CAMERA_THREAD = None
+BLACKBOX_PATH = 'blackbox.bin'
 
+# How often the GUI checks for updates from the runtime
+GUI_TIMEOUT = 20  # ms
+# How often telemetry widgets are refreshed, whatever rate records arrive at
+TELEMETRY_REFRESH_RATE = 30  # Hz
+
+RUNTIME = None
 
 CURRENT_HOST = config.DEFAULT_HOST
 CURRENT_PORT = config.DEFAULT_PORT
 
 
 def listen_client_func(event, data):
-    if event == NetworkEvent.TELEMETRY:
-        # Update Telemetry UI with new value
-        telemetry_name, telemetry_data = helpers.decode_telemetry_record(data)
+    # Telemetry never gets here, see refresh_telemetry
+    print('%s -> %s' % (event, data))
+
+
+def refresh_telemetry():
+    """
+    Update only the telemetry widgets whose value changed since the last refresh
+    """
+    store = RUNTIME.telemetry
+    for telemetry_name, telemetry_data in store.drain().items():
         WINDOW[telemetry_name].update(value=telemetry_data)
-    else:
-        WINDOW.write_event_value(EVENT_OUTPUT, '%s -> %s' % (event, data))
+    WINDOW[EVENT_UI_SAVED].update(value='%d/%d' % (store.saved, store.received))
 
 
 def listen_camera_func(img):
-    WINDOW[EVENT_CAMERA_FEED].update(value=img.tobytes())
+    # Frames arrive decoded, the Image element only shows PNG
+    WINDOW[EVENT_CAMERA_FEED].update(data=cv2.imencode('.png', img)[1].tobytes())
 
 
-def connect(host, port):
-    global CLIENT_THREAD, CONTROLLER_THREAD, CAMERA_THREAD
-
-    # RESET THREADS
-    if CLIENT_THREAD:
+def handle_updates():
+    """
+    Apply everything the runtime posted since last time, runs on the GUI thread
+    """
+    while True:
         try:
-            CLIENT_THREAD._stop()
-        except Exception as e:
-            logger.error(e)
-            pass
-
-    if CONTROLLER_THREAD:
-        CONTROLLER_THREAD._stop()
-
-    if CAMERA_THREAD:
-        CAMERA_THREAD._stop()
-
-    CLIENT_THREAD = None
-    CONTROLLER_THREAD = None
-    CAMERA_THREAD = None
+            kind, value = RUNTIME.updates.get_nowait()
+        except queue.Empty:
+            return
 
-    WINDOW.write_event_value(EVENT_OUTPUT, 'CONNECTING TO %s:%s' % (host, port))
-    try:
-        network_client = ClientConnection(listen_client_func, host=host, port=int(port))
-        CLIENT_THREAD = threading.Thread(target=network_client.run, daemon=True)
-        CLIENT_THREAD.start()
-        network_client.send(NetworkEvent.CONNECTED)
-    except Exception as e:
-        logger.error(e)
-        WINDOW.write_event_value(EVENT_OUTPUT, 'CONNECTION FAILED')
-        return False
+        if kind == runtime.UPDATE_EVENT:
+            listen_client_func(*value)
+        elif kind == runtime.UPDATE_FRAME:
+            listen_camera_func(value)
+        else:
+            print(value)
 
-    controller = KeyboardController(network_client.send)
-    CONTROLLER_THREAD = threading.Thread(target=controller.run, daemon=True)
-    CONTROLLER_THREAD.start()
 
-    if config.CAMERA_ENABLED:
-        camera_handler = camera.Client(listen_camera_func, host=host)
-        CAMERA_THREAD = threading.Thread(target=camera_handler.run, daemon=True)
-        CAMERA_THREAD.start()
-
-    return True
+def connect(host, port):
+    RUNTIME.connect(host, port)
 
 
 def main():
-    global WINDOW, CURRENT_HOST, CURRENT_PORT
+    global WINDOW, RUNTIME, CURRENT_HOST, CURRENT_PORT
 
     output_col = [
         [sg.Text('Output', font='Any 15')],
@@ -97,7 +88,18 @@ def main():
 
     telemetry_col = [
         [sg.Text('Telemetry', font='Any 15')],
-    ] + [[sg.Text('%s:' % record, size=(10, None)), sg.Text('NONE', key=record.strip(), size=(20, None))] for record in telemetry.TelemetryRecord.all()]
+    ] + [[sg.Text('%s:' % record, size=(10, None)), sg.Text('NONE', key=record.strip(), size=(20, None))] for record in telemetry.TelemetryRecord.all()] + [
+        [sg.Text('UI SAVED:', size=(10, None), tooltip='Telemetry updates coalesced or unchanged / received'),
+         sg.Text('0/0', key=EVENT_UI_SAVED, size=(20, None))],
+    ]
+
+    link_col = [
+        [sg.Text('Link', font='Any 15')],
+    ] + [[sg.Text('%s:' % record, size=(12, None)), sg.Text('NONE', key=record, size=(24, None))] for record in link.RECORDS] + [
+        [sg.Text('RTT ms: %s' % link.bucket_labels(link.RTT_BUCKETS), font='Any 7')],
+        [sg.Text('JITTER ms: %s' % link.bucket_labels(link.JITTER_BUCKETS), font='Any 7')],
+        [sg.Text('LOSS RUN: %s' % link.bucket_labels(link.LOSS_BUCKETS), font='Any 7')],
+    ]
 
     layout = [
         [
@@ -107,27 +109,41 @@ def main():
         [
             sg.Column(output_col, vertical_alignment='top', pad=(0, 0)),
             sg.Column(telemetry_col, vertical_alignment='top', pad=(0, 0)),
+            sg.Column(link_col, vertical_alignment='top', pad=(0, 0)),
         ],
         [
             sg.InputText(default_text=CURRENT_HOST, tooltip='IP Address', key=EVENT_IP_ADDRESS_FIELD),
-            sg.Button('Reconnect', key=EVENT_RECONNECT)
+            sg.Button('Reconnect', key=EVENT_RECONNECT),
+            sg.Button('Download Blackbox', key=EVENT_BLACKBOX),
         ],
     ]
 
     WINDOW = sg.Window('RemoteControl', layout, finalize=True)
+    RUNTIME = runtime.Runtime()
+    refresh_interval = 1.0 / TELEMETRY_REFRESH_RATE
+    refresh_deadline = time.monotonic()
 
     # Event Loop
     while True:
-        event, values = WINDOW.read()
+        event, values = WINDOW.read(timeout=GUI_TIMEOUT)
         if event == sg.WIN_CLOSED or event == 'Exit':
             break
 
-        elif event == EVENT_OUTPUT:
-            print(values[EVENT_OUTPUT])
         elif event == EVENT_RECONNECT:
             CURRENT_HOST = values[EVENT_IP_ADDRESS_FIELD]
             connect(CURRENT_HOST, CURRENT_PORT)
 
+        elif event == EVENT_BLACKBOX:
+            RUNTIME.download_blackbox(BLACKBOX_PATH)
+
+        handle_updates()
+
+        now = time.monotonic()
+        if now >= refresh_deadline:
+            refresh_telemetry()
+            refresh_deadline = max(refresh_deadline + refresh_interval, now)
+
+    RUNTIME.disconnect().result()
     WINDOW.close()
 
 
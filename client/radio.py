@@ -1,52 +1,138 @@
+import asyncio
 import logging
-import socket
-from utils.network import BaseConnection, EMPTY_CHAR, NetworkEvent
+from utils import helpers, network
+from utils.network import BaseConnection, EMPTY_CHAR, NetworkEvent, Codec
 logger = logging.Logger(__name__)
 
 
-class ClientConnection(BaseConnection):
+class ClientConnection(BaseConnection, asyncio.Protocol):
     """
     Communication Client for RPI using Wifi
     We first use an arduino to receive radio signal using Wifi, then we read it from serial
+
+    Runs as an asyncio protocol, `open` connects, `established` resolves once the server granted a session
+    and `closed` once the link is gone
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, control_port: int = None, session: network.Session = None, **kwargs):
+        """
+        :param control_port: Send CONTROL as UDP datagrams to this port instead of the TCP session
+        :param session: Session of an earlier connection to resume, it is updated in place
+        """
         super().__init__(*args, **kwargs)
-        self._conn = socket.socket()
-        self._conn.connect((self.host, self.port))
+        self.control_port = control_port
+        self.session = session or network.Session()
+        self.resumed = False
+        self._resuming = False
+        self.transport = None
+        self.udp_transport = None
+        self.established = None
+        self.closed = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.established = loop.create_future()
+        self.closed = loop.create_future()
+        await loop.create_connection(lambda: self, self.host, self.port)
+
+        if self.control_port:
+            self.udp_transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol,
+                remote_addr=(self.host, self.control_port),
+            )
+        print(f'CONNECTED TO {self.host}:{self.port}')
+
+    def close(self):
+        if self.udp_transport:
+            self.udp_transport.close()
+        if self.transport:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.reader.feed(data, self.dispatch)
+
+    def connection_lost(self, exc):
+        if exc:
+            logger.error(exc)
+        self.transport = None
+        if self.udp_transport:
+            self.udp_transport.close()
+        if not self.closed.done():
+            self.closed.set_result(exc)
 
     def send(self, event, data=EMPTY_CHAR):
         """
-        Send message to server
+        Send message to server, must be called from the event loop thread
         """
-        self._send(self._conn, event, data=data)
+        if not self.transport:
+            return
 
-    def listen(self):
-        try:
-            data = self._conn.recv(self.buf_size)
-            print('received data', data)
-        except Exception as e:
-            logger.error(e)
-            print('error', e)
-            return -1
+        if event == NetworkEvent.CONTROL:
+            # Stamp every setpoint so the server can drop stale or reordered ones
+            self.session.sequence = helpers.next_sequence(self.session.sequence)
+            data = (*data[:4], self.session.sequence, helpers.ticks_ms() & helpers.SEQUENCE_MASK)
 
-        message = data.decode(self.encoding)
+            if self.udp_transport:
+                # Latest wins, a lost setpoint is replaced by the next one instead of being retransmitted
+                self._send(self.udp_transport, event, data=data, codec=Codec.BINARY)
+                return
 
-        if not data:
-            return -1
-        self.handle_message(message)
-        return 1
+        # Everything else (STOP included) stays on the reliable TCP session
+        self._send(self.transport, event, data=data)
 
-    def run(self):
-        print(f'CONNECTED TO {self.host}:{self.port}')
-        while True:
-            try:
-                resp = self.listen()
-            except Exception as e:
-                logger.error(e)
-                resp = -1
+    def _write(self, _conn, data):
+        # Transports may hold on to what they are given, never hand them the reused tx buffer
+        # Selector datagram transports don't subclass asyncio.DatagramTransport, compare by identity
+        if _conn is self.udp_transport:
+            _conn.sendto(bytes(data))
+        else:
+            _conn.write(bytes(data))
+
+    def handshake(self):
+        """
+        Resume the session if there is one, otherwise announce ourselves and ask server for the preferred codec
+        """
+        if self.session.token:
+            self._resuming = True
+            self.send(NetworkEvent.SESSION, self.session.token)
+        else:
+            self.send(NetworkEvent.CONNECTED, self.preferred_codec)
+
+    def handle_connected(self, data):
+        # Server acknowledged codec, switch to it
+        if data == self.preferred_codec:
+            self.codec = data
+            self.session.codec = data
+
+    def handle_session(self, data):
+        token, resumed, sequence = network.decode_session(data)
+        if resumed:
+            # Server went straight back to the codec of the session, no handshake needed
+            self.codec = self.session.codec
+            if helpers.sequence_newer(sequence, self.session.sequence):
+                self.session.sequence = sequence
+        elif self._resuming:
+            # Too late, the server forgot about us, start over with a normal handshake
+            self.session.token = token
+            self.session.codec = Codec.TEXT
+            self._resuming = False
+            self.send(NetworkEvent.CONNECTED, self.preferred_codec)
+            return
+        else:
+            self.session.token = token
+            if self.session.subscriptions is not None:
+                self.send(NetworkEvent.SUBSCRIBE, network.encode_subscriptions(self.session.subscriptions))
 
-            if resp == -1:
-                break
+        self._resuming = False
+        self.resumed = resumed
+        if not self.established.done():
+            self.established.set_result(resumed)
 
-        self._conn.close()
+    def dispatch(self, event, data):
+        if event == NetworkEvent.SESSION:
+            self.handle_session(data)
+            return
+        super().dispatch(event, data)
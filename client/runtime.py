@@ -0,0 +1,268 @@
+"""
+Asyncio core of the client
+
+Control link, video feed and input sampling all run as tasks on one event loop in a background thread,
+the GUI only talks to it through `connect` and reads everything back from the `updates` queue,
+except telemetry which is kept as latest values in `telemetry`
+"""
+import asyncio
+import logging
+import queue
+import threading
+from client.controller import KeyboardController
+from client.link import LinkEstimator
+from client.radio import ClientConnection, NetworkEvent
+from client.store import TelemetryStore
+from utils import helpers, network, telemetry
+import config
+
+logger = logging.Logger(__name__)
+
+if config.CAMERA_ENABLED:
+    from utils import camera
+
+# Kinds of updates posted to the GUI
+UPDATE_EVENT = 'EVENT'
+UPDATE_OUTPUT = 'OUTPUT'
+UPDATE_FRAME = 'FRAME'
+
+# Give up on a blackbox download when no chunk arrived for this long
+BLACKBOX_TIMEOUT = 5  # seconds
+# Keep trying to get a lost connection back for this long, about as long as the server keeps the session
+RECONNECT_TIMEOUT = 10  # seconds
+RECONNECT_INTERVAL = 0.2  # seconds
+# Link measurement, a ping is a few dozen bytes each way
+PING_INTERVAL = 0.25  # seconds
+
+
+class Runtime:
+    def __init__(self, controller_class=KeyboardController):
+        self.controller_class = controller_class
+        # (kind, value) tuples for the GUI thread, the only thing shared between both threads
+        self.updates = queue.Queue()
+        # Telemetry skips the queue, the GUI only wants the latest value of each record
+        self.telemetry = TelemetryStore()
+        self.link = LinkEstimator()
+        self.connection = None
+        self.session = None
+        self.host = None
+        self.port = None
+        # Time it took to get the last lost connection back, ms
+        self.reconnect_ms = None
+        self._tasks = []
+        self._camera = None
+        # (file, future) of the blackbox download in progress
+        self._blackbox = None
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def post(self, kind, value):
+        self.updates.put((kind, value))
+
+    def connect(self, host: str, port: int):
+        """
+        Thread safe, drop current connection if any and connect again
+        """
+        return asyncio.run_coroutine_threadsafe(self._connect(host, int(port)), self.loop)
+
+    def disconnect(self):
+        """
+        Thread safe, cancel everything and close connection
+        """
+        return asyncio.run_coroutine_threadsafe(self._disconnect(), self.loop)
+
+    def subscribe(self, records=None):
+        """
+        Thread safe, only receive these telemetry records from now on, None for all of them. Kept across reconnects
+        """
+        return asyncio.run_coroutine_threadsafe(self._subscribe(records), self.loop)
+
+    async def _subscribe(self, records):
+        if self.session:
+            self.session.subscriptions = set(records) if records is not None else None
+        self.send(NetworkEvent.SUBSCRIBE, network.encode_subscriptions(records))
+
+    def download_blackbox(self, path: str):
+        """
+        Thread safe, download the flight log into path, resolves with the number of bytes written
+        """
+        return asyncio.run_coroutine_threadsafe(self._download_blackbox(path), self.loop)
+
+    def _receive(self, event, data):
+        if event == NetworkEvent.PONG:
+            self.link.pong(data, helpers.ticks_us())
+            return
+
+        if event == NetworkEvent.BLACKBOX and self._blackbox:
+            file, future = self._blackbox
+            if data:
+                file.write(data)
+            elif not future.done():
+                future.set_result(file.tell())
+            return
+
+        if event == NetworkEvent.TELEMETRY:
+            self.telemetry.put(*data)
+        elif event == NetworkEvent.SNAPSHOT:
+            for record, value in telemetry.decode_snapshot(data):
+                self.telemetry.put(record, value)
+        else:
+            self.post(UPDATE_EVENT, (event, data))
+
+    async def _download_blackbox(self, path: str) -> int:
+        connection = self.connection
+        if not connection or self._blackbox:
+            return 0
+
+        future = asyncio.get_running_loop().create_future()
+        with open(path, 'wb') as file:
+            self._blackbox = (file, future)
+            try:
+                connection.send(NetworkEvent.BLACKBOX)
+                while not future.done():
+                    size = file.tell()
+                    await asyncio.wait([future, connection.closed], timeout=BLACKBOX_TIMEOUT)
+                    if connection.closed.done() or file.tell() == size:
+                        break
+            finally:
+                self._blackbox = None
+
+        if not future.done():
+            self.post(UPDATE_OUTPUT, 'BLACKBOX DOWNLOAD FAILED')
+            return 0
+
+        self.post(UPDATE_OUTPUT, 'BLACKBOX SAVED %d BYTES TO %s' % (future.result(), path))
+        return future.result()
+
+    async def _connect(self, host: str, port: int) -> bool:
+        await self._disconnect()
+
+        self.post(UPDATE_OUTPUT, 'CONNECTING TO %s:%s' % (host, port))
+        # Asking for a connection is asking for a new session, only drops are resumed
+        self.session = network.Session()
+        self.link = LinkEstimator()
+        self.host = host
+        self.port = port
+        if not await self._open():
+            self.post(UPDATE_OUTPUT, 'CONNECTION FAILED')
+            return False
+
+        self._tasks = [
+            asyncio.create_task(self._sample_input(self.controller_class(self.send))),
+            asyncio.create_task(self._watch()),
+            asyncio.create_task(self._ping()),
+        ]
+        self._start_camera()
+        return True
+
+    async def _open(self):
+        connection = ClientConnection(
+            self._receive,
+            host=self.host,
+            port=self.port,
+            control_port=config.DEFAULT_CONTROL_PORT if config.CONTROL_UDP_ENABLED else None,
+            session=self.session,
+        )
+        try:
+            await connection.open()
+        except OSError as e:
+            logger.error(e)
+            return None
+
+        connection.handshake()
+        self.connection = connection
+        return connection
+
+    def _start_camera(self):
+        if not config.CAMERA_ENABLED or (self._camera and not self._camera.done()):
+            return
+        self._camera = asyncio.create_task(camera.receive(self.host, lambda frame: self.post(UPDATE_FRAME, frame)))
+        self._tasks.append(self._camera)
+
+    def send(self, event, data=network.EMPTY_CHAR):
+        """
+        Send on the current connection, dropped while reconnecting
+        """
+        if self.connection:
+            self.connection.send(event, data)
+
+    async def _disconnect(self):
+        tasks = self._tasks
+        self._tasks = []
+        current = asyncio.current_task()
+        for task in tasks:
+            if task is not current:
+                task.cancel()
+        await asyncio.gather(*[task for task in tasks if task is not current], return_exceptions=True)
+
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    async def _watch(self):
+        """
+        Reconnect whenever the control link is lost, resuming the session while the server still keeps it
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.connection.closed
+            self.connection = None
+            lost_at = loop.time()
+            self.post(UPDATE_OUTPUT, 'CONNECTION LOST, RECONNECTING')
+
+            connection = None
+            while not connection and loop.time() - lost_at < RECONNECT_TIMEOUT:
+                connection = await self._open()
+                if not connection:
+                    await asyncio.sleep(RECONNECT_INTERVAL)
+                    continue
+
+                try:
+                    await asyncio.wait_for(asyncio.shield(connection.established), RECONNECT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    connection.close()
+                    self.connection = connection = None
+
+            if not connection:
+                self.post(UPDATE_OUTPUT, 'RECONNECT FAILED')
+                await self._disconnect()
+                return
+
+            self.reconnect_ms = int((loop.time() - lost_at) * 1000)
+            self.post(UPDATE_OUTPUT, 'RECONNECTED IN %dms (%s)' % (
+                self.reconnect_ms, 'RESUMED' if connection.resumed else 'NEW SESSION',
+            ))
+            self._start_camera()
+
+    async def _ping(self):
+        """
+        Measure the link all the time, pings in flight when the link drops are counted as lost
+        """
+        while True:
+            if self.connection:
+                self.connection.send(NetworkEvent.PING, self.link.ping(helpers.ticks_us()))
+            for record, value in self.link.records().items():
+                self.telemetry.put(record, value)
+            await asyncio.sleep(PING_INTERVAL)
+
+    @staticmethod
+    async def _sample_input(controller):
+        """
+        Run controller loop every cycle_speed seconds on deadlines, so work done in loop doesn't add up as drift
+        """
+        loop = asyncio.get_running_loop()
+        controller.start()
+        try:
+            deadline = loop.time()
+            while True:
+                controller.loop()
+                deadline += controller.cycle_speed
+                await asyncio.sleep(max(0.0, deadline - loop.time()))
+        finally:
+            controller.stop()
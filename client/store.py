@@ -0,0 +1,53 @@
+"""
+Latest value store between the runtime and the GUI
+"""
+import threading
+
+
+class TelemetryStore:
+    """
+    Latest value of every telemetry record, written by the runtime as records arrive and drained by the GUI
+    at its own refresh rate
+
+    A value replaced before the GUI got to it is coalesced, a value equal to what is already shown is skipped,
+    neither of them costs a widget update
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._applied = {}
+        self.received = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+    @property
+    def saved(self) -> int:
+        """
+        Widget updates avoided so far
+        """
+        return self.coalesced + self.unchanged
+
+    def put(self, record: str, value: str):
+        with self._lock:
+            self.received += 1
+            if record in self._pending:
+                self.coalesced += 1
+            self._pending[record] = value
+
+    def drain(self) -> dict:
+        """
+        @return: {record: value} of every record that changed since the last drain
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        changed = {}
+        for record, value in pending.items():
+            if self._applied.get(record) == value:
+                self.unchanged += 1
+                continue
+            self._applied[record] = value
+            changed[record] = value
+        return changed
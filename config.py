@@ -1,7 +1,17 @@
 CAMERA_ENABLED = False
+# JPEG quality of the video feed, None for lossless
+CAMERA_QUALITY = 80
+# Only send the parts of the picture that changed, for a mostly static (grayscale) scene
+CAMERA_DELTA = False
+# Shared memory frame bus the camera is published on for other processes (recorder, vision), None to keep the camera
+# to the relay, see utils.framebus
+CAMERA_BUS = None
 
 DEFAULT_HOST = 'pico1'
 DEFAULT_PORT = 7777
+# Send CONTROL over UDP, latest wins instead of waiting on TCP retransmissions
+CONTROL_UDP_ENABLED = False
+DEFAULT_CONTROL_PORT = 7778
 DEFAULT_WIFI_SSID = ''
 DEFAULT_WIFI_PASSWORD = ''
 
@@ -11,6 +21,17 @@ class Mpu:
     id = 1
     SDA = 2
     SCL = 3
+    # I2C clock, 400kHz is what the MPU6500 is specified for, 1MHz usually works on short wires and halves read time
+    freq = 400000
+    # Hz, sample into the sensor FIFO at this rate and integrate every sample, None to read the latest sample per loop.
+    # The FIFO holds 41 samples and has to last two control loops, so it is capped at 333Hz with the 50ms cycle_speed
+    fifo_rate = None
+    # Pin wired to the INT pin, to only read new samples and time them by the data ready interrupt (without FIFO)
+    INT = None
+    # Hz, sample rate when INT is used
+    rate = 1000
+    # Attitude estimator, one of attitude.ESTIMATORS: complementary, kalman, madgwick or mahony
+    estimator = 'complementary'
 
 
 class ConfigMotor:
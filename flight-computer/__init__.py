@@ -1,42 +1,33 @@
 #!/usr/bin/python3
 """
 FLIGHT COMPUTER ON RPI
-currently it will just run and send video feed to client
+relays telemetry from the flight controller and the camera feed to every connected client
 """
-import threading
+import asyncio
 import config
+import relay
 
 if config.CAMERA_ENABLED:
     from utils import camera
 
 
-def start_server():
-    global TELEMETRY_THREAD, SERVER_THREAD, CAMERA_THREAD, CONTROLLER
-
-    if config.CAMERA_ENABLED:
-        print('STARTING CAMERA STREAM...')
-        camera_handler = camera.Server()
-        VIDEO_THREAD = threading.Thread(target=camera_handler.run, daemon=True)
-        VIDEO_THREAD.start()
-
-
 def main():
     """
     MAIN PROGRAM LOOP
-    launch server, controller and hardware
+    launch relay, runs until interrupted
     """
     print('INITIALIZING RPI...')
-    start_server()
+    relay_handler = relay.Relay(
+        upstream_host=config.DEFAULT_HOST,
+        upstream_port=int(config.DEFAULT_PORT),
+        video_port=camera.PORT if config.CAMERA_ENABLED else None,
+    )
     print('\n...\nREADY TO FLY!')
-
-    # TODO: Maybe move to thread?
-    # Infinite loop
-    CONTROLLER.run()
+    asyncio.run(relay_handler.run())
 
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        CONTROLLER.halt()
         print('\nStopping flight computer')
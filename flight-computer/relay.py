@@ -0,0 +1,367 @@
+"""
+Telemetry and video relay
+
+The flight computer reads telemetry from the flight controller and video from the camera once, and fans both out to
+any number of ground stations. Every subscriber has its own bounded queue, a slow subscriber loses its oldest
+messages and never holds up the flight controller link, the camera or the other subscribers.
+
+The flight controller only keeps one session, so it is held by the relay. Setpoints from the first subscriber that
+sends one (the pilot) are forwarded upstream, everyone else only watches. A blackbox download goes back only to the
+subscriber that asked for it.
+"""
+import asyncio
+import collections
+import logging
+import multiprocessing
+import config
+from client.radio import ClientConnection
+from utils import helpers, network, telemetry
+from utils.network import Codec, FrameReader, NetworkEvent, MAX_FRAME
+
+if config.CAMERA_ENABLED:
+    from utils import camera
+    from utils.bitrate import BitrateController
+    from utils.framebus import FrameBus
+    from utils.pipeline import Pipeline
+
+logger = logging.Logger(__name__)
+
+# Forwarded from the pilot to the flight controller
+PILOT_EVENTS = (NetworkEvent.CONTROL, NetworkEvent.STOP)
+
+
+class Subscriber:
+    """
+    One ground station on one channel, written to by its own task
+    """
+
+    def __init__(self, writer, max_queue: int):
+        self.writer = writer
+        # Like the flight controller, text until the subscriber asks for binary
+        self.codec = Codec.TEXT
+        self.queue = collections.deque(maxlen=max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    @property
+    def address(self):
+        return self.writer.get_extra_info('peername')
+
+    @property
+    def buffered(self) -> int:
+        return self.writer.transport.get_write_buffer_size() + sum([len(x) for x in self.queue])
+
+    def put(self, message: bytes):
+        if len(self.queue) == self.queue.maxlen:
+            # deque drops the oldest on its own, only count it
+            self.dropped += 1
+        self.queue.append(message)
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.queue:
+                self.writer.write(self.queue.popleft())
+                self.sent += 1
+                # Only this subscriber waits on its socket, its queue keeps filling (and dropping) meanwhile
+                await self.writer.drain()
+
+
+class Channel:
+    """
+    Fan out of one stream, every message is encoded once and shared by all subscribers
+    """
+    # Kernel and transport buffers hide a slow subscriber until they are full, keep them small
+    write_buffer = 16 * 1024
+
+    def __init__(self, name: str, max_queue: int):
+        self.name = name
+        self.max_queue = max_queue
+        self.subscribers = set()
+
+    def publish(self, message: bytes):
+        for subscriber in self.subscribers:
+            subscriber.put(message)
+
+    def publish_event(self, encode, event, data):
+        """
+        Same for a network event, encoded once per codec with `encode(event, data, codec)`
+        """
+        encoded = {}
+        for subscriber in self.subscribers:
+            message = encoded.get(subscriber.codec)
+            if message is None:
+                message = encoded[subscriber.codec] = encode(event, data, subscriber.codec)
+            subscriber.put(message)
+
+    async def serve(self, writer, receive=None):
+        """
+        Keep `writer` subscribed until it goes away, `receive` is awaited alongside for anything the subscriber sends
+        """
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        subscriber = Subscriber(writer, self.max_queue)
+        self.subscribers.add(subscriber)
+        print('%s SUBSCRIBED %s (%d)' % (self.name, subscriber.address, len(self.subscribers)))
+
+        tasks = [asyncio.create_task(subscriber.run())]
+        if receive:
+            tasks.append(asyncio.create_task(receive(subscriber)))
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.subscribers.discard(subscriber)
+            writer.close()
+            print('%s UNSUBSCRIBED %s, SENT %d DROPPED %d' % (self.name, subscriber.address, subscriber.sent, subscriber.dropped))
+
+    @property
+    def dropped(self) -> int:
+        return sum(x.dropped for x in self.subscribers)
+
+    @property
+    def buffered(self) -> int:
+        """
+        Bytes waiting to go out to the slowest subscriber
+        """
+        return max([x.buffered for x in self.subscribers] or [0])
+
+
+class Relay:
+    # Reconnect to the flight controller after this long
+    retry_interval = 1  # seconds
+    report_interval = 10  # seconds
+    video_report_interval = 1  # seconds
+    # How soon the camera starts for the first viewer and stops after the last one
+    camera_poll_interval = 0.1  # seconds
+    # For the camera process to open the camera and create the frame bus
+    bus_timeout = 5  # seconds
+
+    def __init__(
+        self, upstream_host: str = config.DEFAULT_HOST, upstream_port: int = network.PORT,
+        host: str = network.HOST, telemetry_port: int = network.PORT, video_port: int = None,
+        telemetry_queue: int = 64, video_queue: int = 2,
+    ):
+        """
+        :param video_port: Serve camera on this port, no video when None
+        :param telemetry_queue: Messages a subscriber may fall behind by before it starts losing the oldest
+        :param video_queue: Same for frames, a viewer only ever wants the latest ones
+        """
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.host = host
+        self.telemetry_port = telemetry_port
+        self.video_port = video_port
+
+        self.telemetry = Channel('TELEMETRY', telemetry_queue)
+        self.video = Channel('VIDEO', video_queue)
+        self.upstream = None
+        # Kept across reconnects so the flight controller resumes it
+        self.upstream_session = network.Session()
+        self.pilot = None
+        # Subscriber the blackbox download in progress goes to
+        self.blackbox_subscriber = None
+        self.capture = None
+        # Video quality, shared by all viewers so it follows the slowest one
+        self.bitrate = None
+        self._tx = bytearray(MAX_FRAME)
+
+    def encode(self, event, data=network.EMPTY_CHAR, codec: str = Codec.BINARY) -> bytes:
+        """
+        Encode event for a subscriber on `codec`, with the same text fallbacks as the flight controller
+        """
+        if codec == Codec.BINARY:
+            size = network.encode_binary(self._tx, event, data)
+            return bytes(self._tx[:size])
+
+        if event == NetworkEvent.SNAPSHOT:
+            return b''.join([network.encode_text(NetworkEvent.TELEMETRY, x) for x in telemetry.decode_snapshot(data)])
+        if event == NetworkEvent.BLACKBOX:
+            return b''.join([
+                network.encode_text(event, data[start:start + network.TEXT_CHUNK])
+                for start in range(0, len(data) or 1, network.TEXT_CHUNK)
+            ])
+        return network.encode_text(event, data)
+
+    def on_upstream(self, event, data):
+        if event == NetworkEvent.CONNECTED:
+            # Part of the relay's own handshake, subscribers get theirs from the relay
+            return
+        if event == NetworkEvent.BLACKBOX:
+            subscriber = self.blackbox_subscriber
+            if not data:
+                # Empty chunk ends the download
+                self.blackbox_subscriber = None
+            if subscriber in self.telemetry.subscribers:
+                # Not queued, the queue drops the oldest and a log with holes is useless
+                subscriber.writer.write(self.encode(event, data, subscriber.codec))
+            return
+        self.telemetry.publish_event(self.encode, event, data)
+
+    async def run_upstream(self):
+        """
+        Hold the flight controller session, reconnect whenever it drops
+        """
+        while True:
+            connection = ClientConnection(
+                self.on_upstream, host=self.upstream_host, port=self.upstream_port, session=self.upstream_session,
+            )
+            try:
+                await connection.open()
+            except OSError as e:
+                logger.error(e)
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            connection.handshake()
+            self.upstream = connection
+            await connection.closed
+            self.upstream = None
+            # Whatever was left of a download is lost with the connection
+            self.blackbox_subscriber = None
+            print('FLIGHT CONTROLLER CONNECTION LOST')
+            await asyncio.sleep(self.retry_interval)
+
+    def handle_subscriber(self, subscriber, token, event, data):
+        """
+        Handle an event sent by a telemetry subscriber
+        """
+        writer = subscriber.writer
+        if event == NetworkEvent.CONNECTED and data in Codec.all():
+            # Acknowledged in text, everything after goes out in the codec it asked for
+            writer.write(network.encode_text(NetworkEvent.CONNECTED, data))
+            writer.write(network.encode_text(NetworkEvent.SESSION, network.encode_session(token, False, 0)))
+            subscriber.codec = data
+        elif event == NetworkEvent.SESSION:
+            # Nothing worth resuming here, send them through a normal handshake
+            writer.write(network.encode_text(NetworkEvent.SESSION, network.encode_session(token, False, 0)))
+        elif event == NetworkEvent.PING:
+            # Answered here, this measures the hop to the relay and not the one behind it
+            pong = network.make_pong(data, helpers.ticks_ms(), helpers.ticks_us())
+            writer.write(self.encode(NetworkEvent.PONG, pong, subscriber.codec))
+        elif event in PILOT_EVENTS:
+            if self.pilot is None:
+                print('PILOT IS %s' % (subscriber.address,))
+                self.pilot = subscriber
+            if self.pilot is subscriber and self.upstream:
+                self.upstream.send(event, data)
+        elif event == NetworkEvent.BLACKBOX:
+            # Doesn't make anyone the pilot, but with one only the pilot may download
+            if self.upstream and self.pilot in (None, subscriber) and self.blackbox_subscriber is None:
+                self.blackbox_subscriber = subscriber
+                self.upstream.send(event)
+            else:
+                # The flight controller only runs one download, end this one right away
+                writer.write(self.encode(event, b'', subscriber.codec))
+
+    async def handle_telemetry(self, reader, writer):
+        # Same greeting the flight controller sends, codec is agreed on below
+        writer.write(network.encode_text(NetworkEvent.CONNECTED))
+
+        token = network.new_token()
+
+        async def receive(subscriber):
+            frames = FrameReader()
+
+            def dispatch(event, data):
+                self.handle_subscriber(subscriber, token, event, data)
+
+            try:
+                while data := await reader.read(1024):
+                    frames.feed(data, dispatch)
+            finally:
+                if self.pilot is subscriber:
+                    self.pilot = None
+                if self.blackbox_subscriber is subscriber:
+                    self.blackbox_subscriber = None
+
+        await self.telemetry.serve(writer, receive)
+
+    def on_video_ack(self, sequence, timestamp):
+        if self.bitrate:
+            self.bitrate.acknowledge(sequence, timestamp)
+
+    async def handle_video(self, reader, writer):
+        async def receive(subscriber):
+            # Viewers only send acks back
+            acks = camera.AckReader(self.on_video_ack)
+            while data := await reader.read(1024):
+                acks.feed(data)
+
+        if self.capture and self.capture.delta:
+            # Delta frames are useless to a viewer until it got a keyframe
+            self.capture.delta.force_keyframe()
+
+        await self.video.serve(writer, receive)
+
+    async def run_camera(self):
+        """
+        Capture, encode and publish on pipeline threads (see utils.pipeline), only while someone is watching
+        """
+        loop = asyncio.get_running_loop()
+        process = None
+        if config.CAMERA_QUALITY is None:
+            kwargs = {'codec': camera.FrameCodec.PNG, 'delta': config.CAMERA_DELTA}
+        else:
+            kwargs = {'codec': camera.FrameCodec.JPEG, 'quality': config.CAMERA_QUALITY, 'delta': config.CAMERA_DELTA}
+
+        if config.CAMERA_BUS:
+            # The camera always runs in its own process, the relay is one more reader of the bus
+            process = multiprocessing.Process(target=camera.run_bus_capture, args=(config.CAMERA_BUS,), daemon=True)
+            process.start()
+            bus = await loop.run_in_executor(None, FrameBus.attach, config.CAMERA_BUS, self.bus_timeout)
+            capture = camera.BusCapture(bus, **kwargs)
+        else:
+            capture = camera.Capture(**kwargs)
+        self.capture = capture
+        self.bitrate = BitrateController(capture)
+
+        pipeline = None
+        reported_at = loop.time()
+        try:
+            while True:
+                if self.video.subscribers and not (pipeline and pipeline.running):
+                    pipeline = Pipeline(capture, lambda data: loop.call_soon_threadsafe(self.video.publish, data))
+                    # Nothing was sent while nobody watched, that is no reason to step down
+                    self.bitrate.reset()
+                    pipeline.start()
+                elif pipeline and not self.video.subscribers:
+                    await loop.run_in_executor(None, pipeline.stop)
+                    pipeline = None
+
+                if pipeline:
+                    self.bitrate.update(self.video.buffered, pipeline.frame_bytes)
+
+                if pipeline and loop.time() - reported_at >= self.video_report_interval:
+                    reported_at = loop.time()
+                    # Subscribers see it next to the flight controller records
+                    value = telemetry.TelemetryRecord.read_value(telemetry.TelemetryRecord.VIDEO, pipeline=pipeline)
+                    record = (telemetry.TelemetryRecord.VIDEO, value)
+                    self.telemetry.publish_event(self.encode, NetworkEvent.TELEMETRY, record)
+                await asyncio.sleep(self.camera_poll_interval)
+        finally:
+            if pipeline:
+                pipeline.stop()
+            if process:
+                process.terminate()
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print('RELAY: %d TELEMETRY (%d DROPPED), %d VIDEO (%d DROPPED)' % (
+                len(self.telemetry.subscribers), self.telemetry.dropped,
+                len(self.video.subscribers), self.video.dropped,
+            ))
+
+    async def run(self):
+        servers = [await asyncio.start_server(self.handle_telemetry, self.host, self.telemetry_port)]
+        tasks = [self.run_upstream(), self.report()]
+        if self.video_port:
+            servers.append(await asyncio.start_server(self.handle_video, self.host, self.video_port))
+            tasks.append(self.run_camera())
+
+        print('RELAY LISTENING ON %s' % ', '.join(str(x.sockets[0].getsockname()) for x in servers))
+        await asyncio.gather(*tasks)
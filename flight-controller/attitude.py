@@ -0,0 +1,304 @@
+"""
+Attitude estimators, fusing gyro (deg/s) and accelerometer (g) samples into roll, pitch and yaw (degrees)
+
+Mpu runs exactly one of them, picked by config.Mpu.estimator. Every estimator keeps its state in attributes and
+works on plain floats, so an update allocates nothing but the floats themselves
+
+- complementary: gyro integrated and pulled towards the accelerometer tilt, the cheapest
+- kalman: a KalmanAngle per axis, which also tracks the gyro bias
+- madgwick, mahony: quaternion filters, no gimbal lock and yaw from the gyro (it drifts without a magnetometer)
+"""
+import math
+
+RAD_TO_DEG = 180 / math.pi
+DEG_TO_RAD = math.pi / 180
+
+
+def accel_roll(ax: float, ay: float, az: float) -> float:
+    return math.atan2(ay, math.sqrt(ax * ax + az * az)) * RAD_TO_DEG
+
+
+def accel_pitch(ax: float, ay: float, az: float) -> float:
+    return math.atan2(-ax, math.sqrt(ay * ay + az * az)) * RAD_TO_DEG
+
+
+class KalmanAngle:
+    def __init__(self):
+        # Q (ANGLE) unknown uncertainty from the environment
+        self.QAngle = 0.001
+        # Q (BIAS) unknown uncertainty from the environment. Here - covariance is degree of correlation
+        # between variances of the angle and its error/bias.
+        self.QBias = 0.003
+        self.RMeasure = 0.1
+        self.angle = 0.0
+        self.bias = 0.0
+        self.rate = 0.0
+        self.P = [[0.0, 0.0], [0.0, 0.0]]
+
+    def get_angle(self, new_angle, new_rate, dt):
+        P = self.P
+        # step 1: Predict new state (for our case - state is angle) from old state + known external influence
+        self.rate = new_rate - self.bias  # new_rate is the latest Gyro measurement
+        self.angle += dt * self.rate
+
+        # step 2: Predict new uncertainty (or covariance) from old uncertainity and unknown uncertainty from the environment.
+        P[0][0] += dt * (dt * P[1][1] - P[0][1] - P[1][0] + self.QAngle)
+        P[0][1] -= dt * P[1][1]
+        P[1][0] -= dt * P[1][1]
+        P[1][1] += self.QBias * dt
+
+        # step 3: Innovation i.e. predict th next measurement
+        y = new_angle - self.angle
+
+        # step 4: Innovation covariance i.e. error in prediction
+        s = P[0][0] + self.RMeasure
+
+        # step 5:  Calculate Kalman Gain
+        k0 = P[0][0] / s
+        k1 = P[1][0] / s
+
+        # step 6: Update the Angle
+        self.angle += k0 * y
+        self.bias += k1 * y
+
+        # step 7: Calculate estimation error covariance - Update the error covariance
+        p00_temp = P[0][0]
+        p01_temp = P[0][1]
+
+        P[0][0] -= k0 * p00_temp
+        P[0][1] -= k0 * p01_temp
+        P[1][0] -= k1 * p00_temp
+        P[1][1] -= k1 * p01_temp
+        return self.angle
+
+
+class Estimator:
+    """
+    Roll, pitch and yaw in degrees, updated with one gyro and accelerometer sample at a time
+    """
+    # Whether yaw is estimated at all, Mpu takes it from the magnetometer otherwise
+    has_yaw = False
+
+    def __init__(self):
+        self.roll = 0.0
+        self.pitch = 0.0
+        self.yaw = 0.0
+
+    def update(self, gx: float, gy: float, gz: float, ax: float, ay: float, az: float, dt: float) -> None:
+        """
+        :param gx: Gyro x, y and z in deg/s, bias removed
+        :param ax: Accelerometer x, y and z, any unit
+        :param dt: Seconds since the previous sample
+        """
+        raise NotImplementedError()
+
+
+class Complementary(Estimator):
+    def __init__(self, alpha: float = 0.9):
+        """
+        :param alpha: Weight of the integrated gyro, the rest goes to the accelerometer tilt
+        """
+        super().__init__()
+        self.alpha = alpha
+
+    def update(self, gx, gy, gz, ax, ay, az, dt):
+        alpha = self.alpha
+        self.roll = alpha * (self.roll + gx * dt) + (1.0 - alpha) * accel_roll(ax, ay, az)
+        self.pitch = alpha * (self.pitch + gy * dt) + (1.0 - alpha) * accel_pitch(ax, ay, az)
+
+
+class Kalman(Estimator):
+    def __init__(self):
+        super().__init__()
+        self._roll = KalmanAngle()
+        self._pitch = KalmanAngle()
+
+    def update(self, gx, gy, gz, ax, ay, az, dt):
+        self.roll = self._roll.get_angle(accel_roll(ax, ay, az), gx, dt)
+        self.pitch = self._pitch.get_angle(accel_pitch(ax, ay, az), gy, dt)
+
+
+class QuaternionEstimator(Estimator):
+    """
+    Orientation kept as a unit quaternion (q0 is the scalar part), angles derived after every update
+    """
+    has_yaw = True
+
+    def __init__(self):
+        super().__init__()
+        self.q0 = 1.0
+        self.q1 = 0.0
+        self.q2 = 0.0
+        self.q3 = 0.0
+        self._started = False
+
+    def _start(self, ax, ay, az):
+        # Start level with gravity instead of converging to it for the first seconds
+        half_roll = math.atan2(ay, az) / 2
+        half_pitch = math.atan2(-ax, math.sqrt(ay * ay + az * az)) / 2
+        cr = math.cos(half_roll)
+        sr = math.sin(half_roll)
+        cp = math.cos(half_pitch)
+        sp = math.sin(half_pitch)
+        self.q0 = cr * cp
+        self.q1 = sr * cp
+        self.q2 = cr * sp
+        self.q3 = -sr * sp
+        self._started = True
+
+    def _normalize(self):
+        norm = math.sqrt(self.q0 * self.q0 + self.q1 * self.q1 + self.q2 * self.q2 + self.q3 * self.q3)
+        self.q0 /= norm
+        self.q1 /= norm
+        self.q2 /= norm
+        self.q3 /= norm
+
+    def _angles(self):
+        q0 = self.q0
+        q1 = self.q1
+        q2 = self.q2
+        q3 = self.q3
+        self.roll = math.atan2(2 * (q0 * q1 + q2 * q3), 1 - 2 * (q1 * q1 + q2 * q2)) * RAD_TO_DEG
+        self.pitch = math.asin(max(-1.0, min(1.0, 2 * (q0 * q2 - q3 * q1)))) * RAD_TO_DEG
+        self.yaw = math.atan2(2 * (q0 * q3 + q1 * q2), 1 - 2 * (q2 * q2 + q3 * q3)) * RAD_TO_DEG
+
+
+class Madgwick(QuaternionEstimator):
+    """
+    Gradient descent orientation filter of S. Madgwick (2010), IMU version
+    """
+
+    def __init__(self, beta: float = 0.1):
+        """
+        :param beta: Gradient step, how hard the accelerometer pulls, higher converges faster but is noisier
+        """
+        super().__init__()
+        self.beta = beta
+
+    def update(self, gx, gy, gz, ax, ay, az, dt):
+        norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if not self._started and norm:
+            self._start(ax, ay, az)
+
+        gx *= DEG_TO_RAD
+        gy *= DEG_TO_RAD
+        gz *= DEG_TO_RAD
+        q0 = self.q0
+        q1 = self.q1
+        q2 = self.q2
+        q3 = self.q3
+
+        # Rate of change of the quaternion from the gyro
+        dq0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        dq1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        dq2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        dq3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        # Free fall or no reading, gyro only
+        if norm:
+            ax /= norm
+            ay /= norm
+            az /= norm
+            _2q0 = 2 * q0
+            _2q1 = 2 * q1
+            _2q2 = 2 * q2
+            _2q3 = 2 * q3
+            _4q0 = 4 * q0
+            _4q1 = 4 * q1
+            _4q2 = 4 * q2
+            _8q1 = 8 * q1
+            _8q2 = 8 * q2
+            q0q0 = q0 * q0
+            q1q1 = q1 * q1
+            q2q2 = q2 * q2
+            q3q3 = q3 * q3
+
+            # Gradient of the error between measured and estimated gravity
+            s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+            s1 = _4q1 * q3q3 - _2q3 * ax + 4 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+            s2 = 4 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+            s3 = 4 * q1q1 * q3 - _2q1 * ax + 4 * q2q2 * q3 - _2q2 * ay
+            norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+            if norm:
+                step = self.beta / norm
+                dq0 -= step * s0
+                dq1 -= step * s1
+                dq2 -= step * s2
+                dq3 -= step * s3
+
+        self.q0 = q0 + dq0 * dt
+        self.q1 = q1 + dq1 * dt
+        self.q2 = q2 + dq2 * dt
+        self.q3 = q3 + dq3 * dt
+        self._normalize()
+        self._angles()
+
+
+class Mahony(QuaternionEstimator):
+    """
+    Nonlinear complementary filter of R. Mahony (2008), the gyro is corrected by a PI controller on the error between
+    measured and estimated gravity, the integral term learns what is left of the gyro bias
+    """
+
+    def __init__(self, kp: float = 1.0, ki: float = 0.01):
+        super().__init__()
+        self.kp = kp
+        self.ki = ki
+        self._ix = 0.0
+        self._iy = 0.0
+        self._iz = 0.0
+
+    def update(self, gx, gy, gz, ax, ay, az, dt):
+        norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if not self._started and norm:
+            self._start(ax, ay, az)
+
+        gx *= DEG_TO_RAD
+        gy *= DEG_TO_RAD
+        gz *= DEG_TO_RAD
+        q0 = self.q0
+        q1 = self.q1
+        q2 = self.q2
+        q3 = self.q3
+
+        if norm:
+            ax /= norm
+            ay /= norm
+            az /= norm
+            # Half of gravity as the quaternion sees it
+            vx = q1 * q3 - q0 * q2
+            vy = q0 * q1 + q2 * q3
+            vz = q0 * q0 - 0.5 + q3 * q3
+            # Cross product with the measured one
+            ex = ay * vz - az * vy
+            ey = az * vx - ax * vz
+            ez = ax * vy - ay * vx
+
+            if self.ki > 0:
+                self._ix += 2 * self.ki * ex * dt
+                self._iy += 2 * self.ki * ey * dt
+                self._iz += 2 * self.ki * ez * dt
+                gx += self._ix
+                gy += self._iy
+                gz += self._iz
+            gx += 2 * self.kp * ex
+            gy += 2 * self.kp * ey
+            gz += 2 * self.kp * ez
+
+        gx *= 0.5 * dt
+        gy *= 0.5 * dt
+        gz *= 0.5 * dt
+        self.q0 = q0 - q1 * gx - q2 * gy - q3 * gz
+        self.q1 = q1 + q0 * gx + q2 * gz - q3 * gy
+        self.q2 = q2 + q0 * gy - q1 * gz + q3 * gx
+        self.q3 = q3 + q0 * gz + q1 * gy - q2 * gx
+        self._normalize()
+        self._angles()
+
+
+ESTIMATORS = {
+    'complementary': Complementary,
+    'kalman': Kalman,
+    'madgwick': Madgwick,
+    'mahony': Mahony,
+}
@@ -0,0 +1,194 @@
+"""
+Blackbox flight recorder
+
+The control loop (core 1) packs one fixed size record per cycle into a preallocated ring of blocks, the event loop
+(core 0) writes whole blocks to flash and serves downloads. Each side only ever moves its own counter forward so
+the two cores never share a lock, and the control loop neither allocates nor waits on flash
+"""
+import os
+import struct
+from utils import helpers
+from utils.blackbox import encode_header, RECORD_SIZE, SENSOR_FORMAT, SENSOR_SIZE, PID_FORMAT, PID_SIZE, MOTOR_FORMAT
+from utils.loop import LoopStats
+from utils.network import NetworkEvent, MAX_PAYLOAD
+
+
+class Blackbox:
+    # Records per flash write, a flash write stalls for a few ms so it is only worth it on big blocks
+    block_records = 32
+    blocks = 4
+    # Time the control loop may spend on one record
+    budget = 200  # us
+    # Current log is moved to `<path>.old` past this size
+    max_file_size = 256 * 1024
+    # Download chunks sent per transfer call
+    chunks_per_transfer = 4
+
+    def __init__(self, path: str = 'blackbox.bin'):
+        self.path = path
+        self.block_size = self.block_records * RECORD_SIZE
+        self.capacity = self.block_records * self.blocks
+        self.buf = bytearray(self.block_size * self.blocks)
+        self.mv = memoryview(self.buf)
+
+        # Records packed by the control loop and records written to flash, written - flushed is what's pending
+        self.written = 0
+        self.flushed = 0
+        # Records lost because flash fell behind, and records that took longer than budget
+        self.dropped = 0
+        self.over_budget = 0
+        self.cost = LoopStats()
+
+        self.file_size = 0
+        self._file = None
+
+        self._chunk = bytearray(MAX_PAYLOAD)
+        self._chunk_mv = memoryview(self._chunk)
+        self._download = None
+        self._download_left = 0
+        self._download_send = None
+        self._download_ready = None
+
+    def record(self, controller):
+        """
+        Called by the control loop once per cycle, packs straight from what the controller already holds
+        """
+        started = helpers.ticks_us()
+        if self.written - self.flushed >= self.capacity:
+            # Losing records beats stalling the control loop on flash
+            self.dropped += 1
+            return
+
+        buf = self.buf
+        offset = (self.written % self.capacity) * RECORD_SIZE
+        # Wraps like the board's ticks, the CPython fallback counts past 32 bits
+        timestamp = started & helpers.SEQUENCE_MASK
+        sensor = controller.sensor
+        if sensor:
+            gyro = sensor.gyro
+            accel = sensor.accel
+            angles = sensor.fused_angles
+            struct.pack_into(
+                SENSOR_FORMAT, buf, offset, timestamp,
+                gyro[0], gyro[1], gyro[2],
+                accel[0], accel[1], accel[2],
+                angles[0], angles[1], angles[2],
+            )
+        else:
+            struct.pack_into(SENSOR_FORMAT, buf, offset, timestamp, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        offset += SENSOR_SIZE
+
+        # Same terms as PID.components, read one by one since the property builds a tuple
+        pid_r = controller.pid_r
+        pid_p = controller.pid_p
+        pid_y = controller.pid_y
+        struct.pack_into(
+            PID_FORMAT, buf, offset,
+            pid_r._proportional, pid_r._integral, pid_r._derivative,
+            pid_p._proportional, pid_p._integral, pid_p._derivative,
+            pid_y._proportional, pid_y._integral, pid_y._derivative,
+        )
+        offset += PID_SIZE
+
+        struct.pack_into(
+            MOTOR_FORMAT, buf, offset,
+            int(controller.motor_fl.throttle),
+            int(controller.motor_fr.throttle),
+            int(controller.motor_br.throttle),
+            int(controller.motor_bl.throttle),
+        )
+        # Only publish the record once it is complete
+        self.written += 1
+
+        elapsed = helpers.ticks_diff(helpers.ticks_us(), started)
+        self.cost.add(elapsed)
+        if elapsed > self.budget:
+            self.over_budget += 1
+
+    def _open(self):
+        try:
+            self.file_size = os.stat(self.path)[6]
+        except OSError:
+            self.file_size = 0
+
+        self._file = open(self.path, 'ab')
+        if not self.file_size:
+            header = encode_header()
+            self._file.write(header)
+            self.file_size = len(header)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        old = self.path + '.old'
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+        os.rename(self.path, old)
+
+    def flush(self):
+        """
+        Write every complete block to flash, a partially filled block waits for the next call
+        """
+        wrote = False
+        while self.written - self.flushed >= self.block_records:
+            if self._file is None:
+                self._open()
+
+            start = (self.flushed % self.capacity) * RECORD_SIZE
+            self._file.write(self.mv[start:start + self.block_size])
+            self.flushed += self.block_records
+            self.file_size += self.block_size
+            wrote = True
+
+            if self.file_size >= self.max_file_size and not self._download:
+                self._rotate()
+
+        if wrote and self._file:
+            self._file.flush()
+
+    def start_download(self, send, ready=None):
+        """
+        Send the current log with `send(NetworkEvent.BLACKBOX, chunk)` over the next transfer calls,
+        an empty chunk marks the end
+        @param ready: Chunks are only sent while ready() is true, lets the link catch up
+        """
+        self.stop_download()
+        self.flush()
+        try:
+            self._download_left = os.stat(self.path)[6]
+            self._download = open(self.path, 'rb')
+        except OSError:
+            self._download_left = 0
+            self._download = None
+        self._download_send = send
+        self._download_ready = ready
+        if not self._download:
+            send(NetworkEvent.BLACKBOX, b'')
+
+    def stop_download(self):
+        if self._download:
+            self._download.close()
+        self._download = None
+        self._download_send = None
+        self._download_ready = None
+
+    def transfer(self):
+        """
+        Send the next few chunks of a running download, only what was on flash when it started is sent
+        """
+        if not self._download:
+            return
+
+        for _ in range(self.chunks_per_transfer):
+            if self._download_ready and not self._download_ready():
+                return
+            size = self._download.readinto(self._chunk_mv[:min(len(self._chunk), self._download_left)])
+            if not size:
+                self._download_send(NetworkEvent.BLACKBOX, b'')
+                self.stop_download()
+                return
+
+            self._download_left -= size
+            self._download_send(NetworkEvent.BLACKBOX, self._chunk_mv[:size])
@@ -62,6 +62,11 @@ class QuadController:
         self.pid_y = None
 
         self.update_timestamp = None
+        # Last applied control sequence, and controls dropped for arriving late or out of order
+        self.control_sequence = 0
+        self.dropped_controls = 0
+        # Flight recorder, see blackbox.Blackbox
+        self.blackbox = None
         self.set_rotation()
 
     def arm_motors(self):
@@ -153,7 +158,8 @@ class QuadController:
         self.motor_fl.pwm(self.throttle + response_p)
         self.motor_br.pwm(self.throttle - response_p)
 
-        print("XYZ ROTATION: ", str(self.sensor.angles))
+        if self.blackbox:
+            self.blackbox.record(self)
 
     def idle(self):
         self.set_throttle(self.throttle_pct_pwm(50))
@@ -173,13 +179,20 @@ class QuadController:
             return
 
         elif event == network.NetworkEvent.CONTROL:
-            throttle_pct, roll, pitch, yaw = helpers.decode_control(data)
+            throttle_pct, roll, pitch, yaw, sequence, _ = data
+            if sequence:
+                if not helpers.sequence_newer(sequence, self.control_sequence):
+                    self.dropped_controls += 1
+                    return
+                self.control_sequence = sequence
+
             self.set_throttle(self.throttle_pct_pwm(throttle_pct))
             self.set_rotation(roll, pitch, yaw)
             return
         elif event in [network.NetworkEvent.CONNECTED]:
             print('\nCONNECTED TO CLIENT\n')
-            # NOOP
+            # New client, new sequence
+            self.control_sequence = 0
             return
 
         raise Exception(f'EVENT {event} UNKNOWN')
@@ -187,7 +200,8 @@ class QuadController:
     def loop(self):
         if config.Mpu.enable:
             self.sensor.loop()
-        if self.update_timestamp and self.update_timestamp + self.time_before_reset > int(utime.ticks_ms()):
+        # No setpoint or keepalive from client for a while, go back to idle
+        if self.update_timestamp is not None and utime.ticks_diff(utime.ticks_ms(), self.update_timestamp) > self.time_before_reset:
             self.idle()
 
         self.control()
@@ -19,6 +19,10 @@ MOTOR GPIO MAPPING - CLOCK WISE
 Y is vertical or YAW
 """
 from utils import telemetry
+from utils.loop import EventLoop
+from utils.network import NetworkEvent
+import blackbox
+import gc
 import machine
 import network
 import sensor
@@ -30,10 +34,21 @@ import config
 import rp2
 import _thread
 
+HOUSEKEEPING_INTERVAL = 1000  # ms
+BLACKBOX_FLUSH_INTERVAL = 100  # ms
+BLACKBOX_TRANSFER_INTERVAL = 10  # ms
+
+
 def listen_server_func(event, data):
     """
     Mapping events to controller actions
     """
+    if event == NetworkEvent.BLACKBOX:
+        # Log download, handled here on the networking core and never by the controller
+        # Chunks wait while half the send buffer is taken, the client would be dropped as too slow otherwise
+        BLACKBOX.start_download(SERVER.send, lambda: SERVER.backlog < SERVER.send_buffer // 2)
+        return
+
     if CONTROLLER:
         CONTROLLER.run_event(event, data)
     else:
@@ -56,27 +71,41 @@ def connect_to_wifi():
 
 def setup_server():
     # TODO Replace network.Server with serial input to communicate between controller and computer
-    global SERVER_THREAD, CONTROLLER
+    global SERVER_THREAD, CONTROLLER, SERVER
 
     print('CONNECTING TO NETWORK')
     connect_to_wifi()
 
     print('STARTING SERVER...')
-    server_handler = radio.ServerConnection(target_func=listen_server_func, host=config.DEFAULT_HOST, port=int(config.DEFAULT_PORT))
+    server_handler = radio.ServerConnection(
+        target_func=listen_server_func,
+        host=config.DEFAULT_HOST,
+        port=int(config.DEFAULT_PORT),
+        control_port=int(config.DEFAULT_CONTROL_PORT),
+    )
 
-    print('STARTING TELEMETRY...')
-    telemetry_handler = telemetry.Telemetry(server_handler.send, controller=CONTROLLER)
+    SERVER = server_handler
 
-    server_handler.connect()
+    print('STARTING TELEMETRY...')
+    telemetry_handler = telemetry.Telemetry(server_handler.send, controller=CONTROLLER, blackbox=BLACKBOX, server=server_handler)
+    server_handler.session_callback = telemetry_handler.subscribe
 
     return server_handler, telemetry_handler
 
 
+def housekeeping():
+    """
+    Collect garbage on our own schedule instead of whenever an allocation happens to trigger it
+    """
+    gc.collect()
+
+
 def setup_controller():
     global CONTROLLER
 
     print('STARTING FLIGHT CONTROLLER...')
     CONTROLLER = controller.QuadController(SENSOR, MOTOR_FL, MOTOR_FR, MOTOR_BR, MOTOR_BL)
+    CONTROLLER.blackbox = BLACKBOX
     print('ARMING MOTORS...')
     CONTROLLER.arm_motors()
     print('FINISHED ARMING!')
@@ -100,10 +129,14 @@ def main():
 
     _thread.start_new_thread(run_controller_loop, ())
 
-    while True:
-        server_handler.loop()
-        telemetry_handler.loop()
-        utime.sleep_ms(telemetry_handler.cycle_speed)
+    # Core 0: accept, receive, telemetry and housekeeping all share one loop, none of them waits on the others
+    event_loop = EventLoop(server_handler.poll)
+    telemetry_handler.options['loop'] = event_loop
+    event_loop.every(telemetry_handler.cycle_speed, telemetry_handler.loop)
+    event_loop.every(BLACKBOX_FLUSH_INTERVAL, BLACKBOX.flush)
+    event_loop.every(BLACKBOX_TRANSFER_INTERVAL, BLACKBOX.transfer)
+    event_loop.every(HOUSEKEEPING_INTERVAL, housekeeping)
+    event_loop.run()
 
 
 if __name__ == "__main__":
@@ -116,10 +149,12 @@ if __name__ == "__main__":
     MOTOR_BL = motor.Motor(config.Motors.BACK_LEFT, code='BL')
 
     if config.Mpu.enable:
-        SENSOR = sensor.Mpu(flip=True, invert_y=True)
+        SENSOR = sensor.Mpu(flip=True, invert_y=True, loop_period=controller.QuadController.cycle_speed)
     else:
         SENSOR = None
 
+    BLACKBOX = blackbox.Blackbox()
+
     # Function exists as to not pollute the global namespace
     try:
         main()
@@ -1,66 +1,393 @@
 import socket
-from utils.network import BaseConnection, NetworkEvent, EMPTY_CHAR
+from utils import helpers, network, telemetry
+from utils.network import BaseConnection, FrameReader, NetworkEvent, Codec, EMPTY_CHAR, MAX_FRAME
+
+try:
+    import select
+except ImportError:
+    import uselect as select
+
+try:
+    import errno
+except ImportError:
+    import uerrno as errno
+
+
+# Connection states
+STATE_IDLE = 'IDLE'  # No client
+STATE_PENDING = 'PENDING'  # Accepted, waiting for the client to ask for a new session or resume one
+STATE_ACTIVE = 'ACTIVE'  # Session established
 
 
 class ServerConnection(BaseConnection):
     """
     Communication Server for RPI using Wifi
+
+    Every client gets a session (codec, last control sequence and telemetry subscriptions), when the connection drops
+    the session is parked for `session_grace` ms so a client coming back with its token resumes it in one round trip
     """
-    def __init__(self, *args, **kwargs):
+    session_grace = 10000  # ms
+    max_parked = 4
+    # Bytes the client may fall behind by, a client that can't keep up with this is dropped
+    send_buffer = 8 * MAX_FRAME
+
+    def __init__(self, *args, control_port: int = None, **kwargs):
+        """
+        :param control_port: Also listen for CONTROL datagrams on this UDP port
+        """
         super().__init__(*args, **kwargs)
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind(('0.0.0.0', self.port))
         self.server.listen(1)
+        self.server.setblocking(False)
         self._conn = None
+        # What the socket didn't take yet, sent as soon as poll reports it writable
+        self._out = bytearray(self.send_buffer)
+        self._out_mv = memoryview(self._out)
+        self._out_size = 0
+        # Set when the client fell too far behind or the socket failed, it is dropped on the next poll
+        self._broken = False
+        # Address of the TCP client, the only one allowed to send CONTROL datagrams
+        self._peer = None
+        self.state = STATE_IDLE
+        self.session = None
+        # Dropped sessions by token
+        self.parked = {}
+        # Called with the session whenever its subscriptions apply
+        self.session_callback = None
+        self.sessions_resumed = 0
+        self.sessions_started = 0
+        # Time between a drop and the resume, ms
+        self.last_reconnect_ms = None
+        # Pings answered and (rtt us, jitter us, loss per mille) as last measured by the client
+        self.pings = 0
+        self.link = None
+        self.poller = select.poll()
+        self.poller.register(self.server, select.POLLIN)
+
+        self._udp = None
+        self._latest_control = None
+        self.control_reader = FrameReader(MAX_FRAME)
+        # Datagrams received, replaced by a newer one before being dispatched and dropped for not coming from the client
+        self.control_received = 0
+        self.control_coalesced = 0
+        self.control_rejected = 0
+        if control_port:
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._udp.bind(('0.0.0.0', control_port))
+            self._udp.setblocking(False)
+            self.poller.register(self._udp, select.POLLIN)
 
     def send(self, event, data=EMPTY_CHAR):
         """
         Send message to client
         """
-        if self._conn:
-            print(f'attempt to send {data}')
-            self._send(self._conn, event, data=data)
+        if not self._conn:
+            return
+
+        if event == NetworkEvent.SNAPSHOT and self.codec != Codec.BINARY:
+            # Text clients predate snapshots, send them one record at a time
+            for record in telemetry.decode_snapshot(data):
+                self._send(self._conn, NetworkEvent.TELEMETRY, data=record)
+            return
+
+        if event == NetworkEvent.BLACKBOX and self.codec != Codec.BINARY:
+            # Hex doubles the size, one chunk becomes a few frames. The empty chunk ending a download still goes out
+            for start in range(0, len(data) or 1, network.TEXT_CHUNK):
+                self._send(self._conn, event, data=data[start:start + network.TEXT_CHUNK])
+            return
+
+        self._send(self._conn, event, data=data)
+
+    @property
+    def backlog(self) -> int:
+        """
+        Bytes waiting for the client to make room
+        """
+        return self._out_size
+
+    def _write(self, _conn, data):
+        """
+        Never waits on the client, whatever the socket doesn't take is queued behind what already is
+        """
+        if self._broken:
+            return
+        sent = 0
+        if not self._out_size:
+            sent = self._send_some(_conn, data)
+        size = len(data) - sent
+        if not size:
+            return
+        if self._out_size + size > len(self._out):
+            print('CLIENT TOO SLOW, %d BYTES BEHIND' % (self._out_size + size))
+            self._broken = True
+            return
+        if not self._out_size:
+            self.poller.modify(_conn, select.POLLIN | select.POLLOUT)
+        self._out_mv[self._out_size:self._out_size + size] = memoryview(data)[sent:]
+        self._out_size += size
+
+    def _send_some(self, _conn, data) -> int:
+        """
+        @return: bytes the socket took, 0 when it is full
+        """
+        try:
+            return _conn.send(data) or 0
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:
+                self._broken = True
+            return 0
+
+    def flush(self):
+        """
+        Send what is queued, called when poll reports the socket writable
+        """
+        sent = self._send_some(self._conn, self._out_mv[:self._out_size])
+        remaining = self._out_size - sent
+        if sent and remaining:
+            self._out_mv[:remaining] = self._out_mv[sent:self._out_size]
+        self._out_size = remaining
+        if not remaining:
+            self.poller.modify(self._conn, select.POLLIN)
+
+    def handle_connected(self, data):
+        """
+        Client asked for a codec, acknowledge it in text so any client can read it then switch over
+        """
+        if data in Codec.all() and data != self.codec:
+            self.send(NetworkEvent.CONNECTED, data)
+            self.codec = data
+
+        if self.state == STATE_PENDING:
+            # Fresh handshake, fresh session
+            self.sessions_started += 1
+            self._activate(resumed=False)
+        if self.session:
+            self.session.codec = self.codec
+
+    def handle_session(self, token):
+        """
+        Client asked to resume, grant the parked session or tell it to go on with the new one
+        """
+        self._expire()
+        session = self.parked.pop(token, None)
+        if session is None:
+            self.send(NetworkEvent.SESSION, network.encode_session(self.session.token, False, 0))
+            return
+
+        self.last_reconnect_ms = helpers.ticks_diff(helpers.ticks_ms(), session.parked_at)
+        self.sessions_resumed += 1
+        print('SESSION RESUMED AFTER %dms' % self.last_reconnect_ms)
+        self.session = session
+        self.session.parked_at = None
+        self._activate(resumed=True)
+        # Acknowledged in text like the codec, then straight back to the codec it had
+        self.codec = session.codec
+
+    def handle_subscribe(self, data):
+        self.session.subscriptions = network.decode_subscriptions(data)
+        if self.session_callback:
+            self.session_callback(self.session)
+
+    def _activate(self, resumed: bool):
+        self.state = STATE_ACTIVE
+        self.send(NetworkEvent.SESSION, network.encode_session(self.session.token, resumed, self.session.sequence))
+        if self.session_callback:
+            self.session_callback(self.session)
+
+    def _expire(self):
+        now = helpers.ticks_ms()
+        for token in list(self.parked):
+            if helpers.ticks_diff(now, self.parked[token].parked_at) > self.session_grace:
+                del self.parked[token]
+
+    def _park(self):
+        self._expire()
+        if self.state != STATE_ACTIVE:
+            return
+        if len(self.parked) >= self.max_parked:
+            # Oldest first out
+            del self.parked[min(self.parked, key=lambda x: self.parked[x].parked_at)]
+        self.session.parked_at = helpers.ticks_ms()
+        self.parked[self.session.token] = self.session
+
+    def handle_ping(self, data):
+        """
+        Answer straight from dispatch, anything the controller would add in between only blurs the round trip
+        """
+        received_ms = helpers.ticks_ms()
+        received_us = helpers.ticks_us()
+        self.pings += 1
+        self.link = data[2:]
+        self.send(NetworkEvent.PONG, network.make_pong(data, received_ms, received_us))
+
+    def dispatch(self, event, data):
+        if event == NetworkEvent.PING:
+            self.handle_ping(data)
+            return
+        if event == NetworkEvent.SESSION:
+            self.handle_session(data)
+            return
+        if event == NetworkEvent.SUBSCRIBE:
+            self.handle_subscribe(data)
+            return
+
+        if event == NetworkEvent.CONTROL and self.session and data[4] and helpers.sequence_newer(data[4], self.session.sequence):
+            self.session.sequence = data[4]
+        super().dispatch(event, data)
+
+    def dispatch_logged(self, event, data):
+        """
+        Dispatch, an event the controller can't handle is logged and the connection stays up
+        """
+        try:
+            self.dispatch(event, data)
+        except Exception as e:
+            print('ERROR HANDLING %s: %s' % (event, e))
 
     def listen(self):
+        """
+        @return: 1 on data, 0 when nothing was ready and -1 when connection is gone
+        """
         try:
-            data = self._conn.recv(self.buf_size)
-        except Exception:
+            size = self.reader.recv_into(self._conn)
+        except OSError as e:
+            # Spurious wake up, nothing to read after all
+            return 0 if e.args[0] == errno.EAGAIN else -1
+
+        if size is None:
+            return 0
+        if not size:
             return -1
+        self.reader.process(self.dispatch_logged)
+        return 1
 
-        message = data.decode(self.encoding)
+    def _collect_control(self, event, data):
+        if event != NetworkEvent.CONTROL:
+            # Only setpoints are allowed on the unreliable channel
+            return
 
-        if not data:
-            return -1
-        self.handle_message(message)
+        self.control_received += 1
+        if self._latest_control is not None:
+            self.control_coalesced += 1
+            if not helpers.sequence_newer(data[4], self._latest_control[4]):
+                return
+        self._latest_control = data
+
+    def listen_control(self):
+        """
+        Drain every pending CONTROL datagram and only dispatch the newest one, older setpoints are worthless
+        """
+        if not self._udp:
+            return 0
+
+        while True:
+            # One frame per datagram, never carry partial data over
+            self.control_reader.reset()
+            try:
+                size, addr = self.control_reader.recvfrom_into(self._udp)
+            except OSError:
+                # Nothing left to read
+                break
+
+            if not size:
+                break
+            # Datagrams are only accepted from the client holding the TCP session
+            if addr[0] != self._peer:
+                self.control_rejected += 1
+                continue
+            self.control_reader.process(self._collect_control)
+
+        latest = self._latest_control
+        self._latest_control = None
+        if latest is None or not self._conn:
+            return 0
+
+        self.dispatch_logged(NetworkEvent.CONTROL, latest)
         return 1
 
     def connect(self):
-        print('WAITING FOR CONNECTION')
-        self._conn, client_addr = self.server.accept()
+        """
+        Accept pending client, a new client replaces the current one
+        """
+        try:
+            conn, client_addr = self.server.accept()
+        except OSError:
+            return 0
+
+        if self._conn:
+            print('NEW CLIENT, DROPPING CURRENT CONNECTION')
+            self.disconnect()
+
+        # Nothing waits on the client, reads happen once poll reports data and writes queue what doesn't fit
+        conn.setblocking(False)
+        self._conn = conn
+        self._out_size = 0
+        self._broken = False
+        self._peer = client_addr[0]
+        self.poller.register(conn, select.POLLIN)
+        # Every new client starts on text until it asks otherwise
+        self.codec = Codec.TEXT
+        self.reader.reset()
+        self.state = STATE_PENDING
+        self.session = network.Session(network.new_token())
 
         print(f'CONNECTED TO {client_addr}')
         # Send finish initializing event to whoever is on the other side
         self.send(NetworkEvent.CONNECTED)
+        return 1
 
-    def loop(self):
-        resp = self.listen()
-        if resp == -1:
-            return -1
+    def disconnect(self):
+        self._park()
+        self.state = STATE_IDLE
+        self.session = None
+        self.poller.unregister(self._conn)
+        self._conn.close()
+        self._conn = None
+        self._peer = None
+        print('CONNECTION RESET, WAITING FOR NEW CONNECTION')
 
-        return 1
+    def poll(self, timeout: int = -1):
+        """
+        Wait up to `timeout` ms for any socket to be ready and handle it, -1 waits forever
+        @return: us spent waiting, the rest went to handling
+        """
+        started = helpers.ticks_us()
+        events = self.poller.poll(timeout)
+        waited = helpers.ticks_diff(helpers.ticks_us(), started)
+        for ready in events:
+            sock, flags = ready[0], ready[1]
+            if _matches(sock, self.server):
+                self.connect()
+            elif self._udp and _matches(sock, self._udp):
+                self.listen_control()
+            elif self._conn and _matches(sock, self._conn):
+                if flags & (select.POLLHUP | select.POLLERR):
+                    self._broken = True
+                    continue
+                if flags & select.POLLOUT:
+                    self.flush()
+                if flags & select.POLLIN and self.listen() == -1:
+                    self._broken = True
 
-    def run(self):
-        self.connect()
+        if self._conn and self._broken:
+            self.disconnect()
+        return waited
+
+    def loop(self):
+        """
+        Handle whatever is ready without waiting
+        """
+        self.poll(0)
 
+    def run(self):
+        # Runs until the end of the universe (or battery), clients come and go in between
         while True:
-            resp = self.listen()
-            if resp == -1:
-                break
+            self.poll(-1)
 
-        self._conn.close()
-        self._conn = None
-        # WAIT FOR CONN AGAIN
-        # YES THIS IS RECURSION THAT's THE POINT IT SHOULD RUN UNTIL THE END OF THE UNIVERSE (or battery)
-        print('CONNECTION RESET, WAITING FOR NEW CONNECTION')
-        # TODO: should be idling on new connection NOT first connection
-        self.run()
+
+def _matches(ready, sock) -> bool:
+    """
+    Micropython poll returns the socket itself, cpython returns its file descriptor
+    """
+    return ready is sock or (isinstance(ready, int) and ready == sock.fileno())
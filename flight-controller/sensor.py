@@ -1,9 +1,11 @@
+import json
 import math
 import ustruct
 import utime
-from machine import I2C
+from machine import I2C, Pin
 from micropython import const
 import config
+from attitude import ESTIMATORS
 
 
 _WIA = const(0x00)
@@ -38,55 +40,77 @@ OUTPUT_16_BIT = 0b00010000
 _SO_14BIT = 0.6
 _SO_16BIT = 0.15
 
+# Accel, temperature and gyro, 0x3B to 0x48, read in one go
+_ACCEL_XOUT_H = const(0x3B)
+_BURST_SIZE = const(14)
+# LSB per unit for range 0-3
+GYRO_SCALES = (131.0, 65.5, 32.8, 16.4)  # deg/s
+ACCEL_SCALES = (16384.0, 8192.0, 4096.0, 2048.0)  # g
+
+_SMPLRT_DIV = const(0x19)
+_CONFIG = const(0x1A)
+_CONFIG_FIFO_MODE = const(0b01000000)  # Keep what is queued when full, new samples are dropped
+_FIFO_EN = const(0x23)
+_FIFO_EN_ACCEL_GYRO = const(0b01111000)
+_USER_CTRL = const(0x6A)
+_USER_CTRL_FIFO_EN = const(0b01000000)
+_USER_CTRL_FIFO_RST = const(0b00000100)
+_FIFO_COUNTH = const(0x72)
+_FIFO_R_W = const(0x74)
+FIFO_SIZE = const(512)
+# Accel x, y, z then gyro x, y, z, big endian
+FIFO_SAMPLE_SIZE = const(12)
+# Whole samples that fit, the FIFO counts as full once one more doesn't
+FIFO_SAMPLES = FIFO_SIZE // FIFO_SAMPLE_SIZE
+# Output rate with the low pass filter on, SMPLRT_DIV divides it down
+_INTERNAL_RATE = const(1000)
+
+# INT pin pulses high for 50us on every new sample, the rest of INT_PIN_CFG is left as is (bypass is in there)
+_INT_PIN_CFG_MODE_MASK = const(0b11110000)
+_INT_ENABLE = const(0x38)
+_INT_ENABLE_RAW_RDY = const(0b00000001)
+
+
+def _decode_into(buf, offset: int, values, scale: float) -> None:
+    """Decodes three big endian shorts at offset into values, divided by scale."""
+    for i in range(3):
+        value = buf[offset + 2 * i] << 8 | buf[offset + 2 * i + 1]
+        values[i] = (value - 0x10000 if value & 0x8000 else value) / scale
+
+
+class GyroStats:
+    """Running mean and variance of the three gyro axes (Welford), constant time and memory per sample."""
 
-class KalmanAngle:
     def __init__(self):
-        # Q (ANGLE) unknown uncertainty from the environment
-        self.QAngle = 0.001
-        # Q (BIAS) unknown uncertainty from the environment. Here - covariance is degree of correlation
-        # between variances of the angle and its error/bias.
-        self.QBias = 0.003
-        self.RMeasure = 0.1
-        self.angle = 0.0
-        self.bias = 0.0
-        self.rate = 0.0
-        self.P = [[0.0, 0.0], [0.0, 0.0]]
-
-    def get_angle(self, new_angle, new_rate, dt):
-        # step 1: Predict new state (for our case - state is angle) from old state + known external influence
-        self.rate = new_rate - self.bias  # new_rate is the latest Gyro measurement
-        self.angle += dt * self.rate
-
-        # step 2: Predict new uncertainty (or covariance) from old uncertainity and unknown uncertainty from the environment.
-        self.P[0][0] += dt * (dt * self.P[1][1] - self.P[0][1] - self.P[1][0] + self.QAngle)
-        self.P[0][1] -= dt * self.P[1][1]
-        self.P[1][0] -= dt * self.P[1][1]
-        self.P[1][1] += self.QBias * dt
-
-        # step 3: Innovation i.e. predict th next measurement
-        y = new_angle - self.angle
-
-        # step 4: Innovation covariance i.e. error in prediction
-        s = self.P[0][0] + self.RMeasure
-
-        # step 5:  Calculate Kalman Gain
-        k = [0.0, 0.0]
-        k[0] = self.P[0][0] / s
-        k[1] = self.P[1][0] / s
-
-        # step 6: Update the Angle
-        self.angle += k[0] * y
-        self.bias += k[1] * y
-
-        # step 7: Calculate estimation error covariance - Update the error covariance
-        p00_temp = self.P[0][0]
-        p01_temp = self.P[0][1]
-
-        self.P[0][0] -= k[0] * p00_temp
-        self.P[0][1] -= k[0] * p01_temp
-        self.P[1][0] -= k[1] * p00_temp
-        self.P[1][1] -= k[1] * p01_temp
-        return self.angle
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self._m2 = [0.0, 0.0, 0.0]
+
+    def add(self, values):
+        self.count += 1
+        for i in range(3):
+            delta = values[i] - self.mean[i]
+            self.mean[i] += delta / self.count
+            self._m2[i] += delta * (values[i] - self.mean[i])
+
+    def moved(self, values, threshold: float) -> bool:
+        """Whether any axis of values is further than threshold from the mean."""
+        for i in range(3):
+            if abs(values[i] - self.mean[i]) > threshold:
+                return True
+        return False
+
+    def settled(self, tolerance: float) -> bool:
+        """Whether the standard error of the mean is within tolerance on every axis."""
+        if self.count < 2:
+            return False
+        for i in range(3):
+            if self._m2[i] / (self.count - 1) / self.count > tolerance * tolerance:
+                return False
+        return True
 
 
 class Ak8963:
@@ -243,6 +267,13 @@ class Mpu6500:
         self.i2c = i2c
         # Wake
         self.i2c.writeto_mem(0x68, 0x6B, bytes([0x01]))
+        # Burst read target, reused for every sample
+        self._burst = bytearray(_BURST_SIZE)
+        # Ranges only change through write_*_range, no need to read them back for every sample
+        self._gyro_scale = GYRO_SCALES[self.read_gyro_range()]
+        self._accel_scale = ACCEL_SCALES[self.read_accel_range()]
+        # Temperature register of the last read_into
+        self.raw_temperature = 0
 
     def sleep(self) -> None:
         """Places MPU-6050 in sleep mode (low power consumption). Stops the internal reading of new data. Any calls to get gyro or accel data while in sleep mode will remain unchanged - the data is not being updated internally within the MPU-6050!"""
@@ -266,6 +297,7 @@ class Mpu6500:
     def write_gyro_range(self, range: int) -> None:
         """Sets the gyroscope range setting."""
         self.i2c.writeto_mem(self.address, 0x1B, bytes([self._index_to_hex(range)]))
+        self._gyro_scale = GYRO_SCALES[range]
 
     def read_gyro_data(self) -> tuple[float, float, float]:
         """Read the gyroscope data, in a (x, y, z) tuple."""
@@ -297,6 +329,7 @@ class Mpu6500:
     def write_accel_range(self, range: int) -> None:
         """Sets the gyro accelerometer setting."""
         self.i2c.writeto_mem(self.address, 0x1C, bytes([self._index_to_hex(range)]))
+        self._accel_scale = ACCEL_SCALES[range]
 
     def read_accel_data(self) -> tuple[float, float, float]:
         """Read the accelerometer data, in a (x, y, z) tuple."""
@@ -321,6 +354,166 @@ class Mpu6500:
 
         return (x, y, z)
 
+    def read_into(self, accel, gyro) -> None:
+        """
+        Read accelerometer, temperature and gyro in a single transaction, straight into the given lists.
+        Nothing is allocated apart from the floats themselves, use this in loops instead of read_*_data.
+        :param accel: List of 3, set to (x, y, z) in g.
+        :param gyro: List of 3, set to (x, y, z) in deg/s.
+        """
+        buf = self._burst
+        self.i2c.readfrom_mem_into(self.address, _ACCEL_XOUT_H, buf)
+        _decode_into(buf, 0, accel, self._accel_scale)
+        value = buf[6] << 8 | buf[7]
+        self.raw_temperature = value - 0x10000 if value & 0x8000 else value
+        _decode_into(buf, 8, gyro, self._gyro_scale)
+
+    def write_sample_rate(self, rate: int, mode: int = 0) -> int:
+        """
+        Sets the output data rate. Turns the low pass filter on when it is off, since the sample rate divider only
+        applies with it on.
+        :param rate: Hz, 1000 divided by a whole number.
+        :param mode: Other bits of the CONFIG register.
+        :return: The rate actually set.
+        """
+        lpf = self.read_lpf_range() & 0b111
+        if lpf == 0 or lpf == 7:
+            lpf = 1
+        divider = max(1, min(256, _INTERNAL_RATE // rate))
+        self.i2c.writeto_mem(self.address, _CONFIG, bytes([mode | lpf]))
+        self.i2c.writeto_mem(self.address, _SMPLRT_DIV, bytes([divider - 1]))
+        return _INTERNAL_RATE // divider
+
+    def enable_data_ready(self, pin: Pin, rate: int = 1000) -> int:
+        """
+        Pulse the INT pin on every new sample and time it from the pin interrupt, read samples with read_ready.
+        :param pin: Input the INT pin is wired to.
+        :param rate: Output data rate in Hz, 1000 divided by a whole number.
+        :return: The rate actually set.
+        """
+        self.ready_rate = self.write_sample_rate(rate)
+        self.ready_period_us = 1000000 // self.ready_rate
+        # Written by the interrupt: utime.ticks_us of the last sample and how many there were
+        self.ready_time = 0
+        self.ready_count = 0
+        # Count and time of the last sample read, samples that came and went unread
+        self._read_count = 0
+        self._read_time = None
+        self.ready_missed = 0
+
+        mode = self.i2c.readfrom_mem(self.address, _INT_PIN_CFG, 1)[0] & ~_INT_PIN_CFG_MODE_MASK
+        self.i2c.writeto_mem(self.address, _INT_PIN_CFG, bytes([mode]))
+        self.i2c.writeto_mem(self.address, _INT_ENABLE, bytes([_INT_ENABLE_RAW_RDY]))
+        pin.irq(handler=self._on_data_ready, trigger=Pin.IRQ_RISING, hard=True)
+        return self.ready_rate
+
+    def _on_data_ready(self, pin) -> None:
+        # Hard interrupt, small ints only, no allocation
+        self.ready_time = utime.ticks_us()
+        self.ready_count = (self.ready_count + 1) & 0x3FFFFFFF
+
+    def read_ready(self, accel, gyro) -> int:
+        """
+        Reads the sample the sensor signalled since the last call, like read_into.
+        A sample landing while it is being read is timed as the one before it, off by a period at most.
+        :return: us between this sample and the previous one read, as timed by the interrupt, 0 when there is no new
+            sample (accel and gyro are left alone then).
+        """
+        count = self.ready_count
+        timestamp = self.ready_time
+        if count != self.ready_count:
+            # Interrupt in between, both are from the same sample now
+            count = self.ready_count
+            timestamp = self.ready_time
+        if count == self._read_count:
+            return 0
+
+        self.read_into(accel, gyro)
+        self.ready_missed += ((count - self._read_count) & 0x3FFFFFFF) - 1
+        self._read_count = count
+        if self._read_time is None:
+            dt = self.ready_period_us
+        else:
+            dt = utime.ticks_diff(timestamp, self._read_time)
+        self._read_time = timestamp
+        return dt
+
+    def enable_fifo(self, rate: int = 1000, drain_period: int = None) -> int:
+        """
+        Let the sensor sample at its own rate into its FIFO, drained with read_fifo.
+        :param rate: Output data rate in Hz, 1000 divided by a whole number.
+        :param drain_period: ms between read_fifo calls, the rate is lowered until two periods of samples fit so one
+            late drain doesn't lose any.
+        :return: The rate actually set.
+        """
+        if drain_period:
+            divider = -(-_INTERNAL_RATE * 2 * drain_period // ((FIFO_SAMPLES - 1) * 1000))
+            if rate > _INTERNAL_RATE // divider:
+                print('FIFO RATE %dHz TOO HIGH FOR %dms BETWEEN READS, USING %dHz' % (
+                    rate, drain_period, _INTERNAL_RATE // divider,
+                ))
+                rate = _INTERNAL_RATE // divider
+        self.fifo_rate = self.write_sample_rate(rate, _CONFIG_FIFO_MODE)
+        self.i2c.writeto_mem(self.address, _FIFO_EN, bytes([_FIFO_EN_ACCEL_GYRO]))
+        self.fifo_period_us = 1000000 // self.fifo_rate
+        # In seconds, the dt of every sample
+        self.fifo_period = 1 / self.fifo_rate
+        self._fifo = bytearray(FIFO_SIZE)
+        # One view per sample count, so draining doesn't even allocate a memoryview
+        view = memoryview(self._fifo)
+        self._fifo_views = [view[:n * FIFO_SAMPLE_SIZE] for n in range(FIFO_SAMPLES + 1)]
+        self._fifo_count = bytearray(2)
+        self.fifo_overflows = 0
+        self.reset_fifo()
+        return self.fifo_rate
+
+    def disable_fifo(self) -> None:
+        self.i2c.writeto_mem(self.address, _USER_CTRL, bytes([0]))
+        self.i2c.writeto_mem(self.address, _FIFO_EN, bytes([0]))
+
+    def reset_fifo(self) -> None:
+        """Empties the FIFO, the timeline of samples starts over from now."""
+        self.i2c.writeto_mem(self.address, _USER_CTRL, bytes([_USER_CTRL_FIFO_EN | _USER_CTRL_FIFO_RST]))
+        # utime.ticks_us of the last sample drained
+        self.fifo_time = utime.ticks_us()
+
+    def read_fifo(self) -> int:
+        """
+        Drains every whole sample queued in the FIFO in one bulk read, decode them with fifo_sample. Samples are
+        timed by the output data rate, the last one was taken at fifo_time and every one before it fifo_period_us
+        earlier. A full FIFO has stopped taking samples, what it holds is still returned but it is reset after, the
+        time it spent full is lost.
+        :return: Number of samples read.
+        """
+        buf = self._fifo_count
+        self.i2c.readfrom_mem_into(self.address, _FIFO_COUNTH, buf)
+        size = (buf[0] & 0x1F) << 8 | buf[1]
+        count = min(size // FIFO_SAMPLE_SIZE, FIFO_SAMPLES)
+        if not count:
+            return 0
+        self.i2c.readfrom_mem_into(self.address, _FIFO_R_W, self._fifo_views[count])
+
+        if count == FIFO_SAMPLES:
+            self.fifo_overflows += 1
+            self.reset_fifo()
+            return count
+
+        period = self.fifo_period_us
+        self.fifo_time = utime.ticks_add(self.fifo_time, count * period)
+        # The sensor clock drifts from ours by a percent or so, keep the last sample within a period of now
+        late = utime.ticks_diff(utime.ticks_us(), self.fifo_time)
+        if late < 0 or late > 2 * period:
+            self.fifo_time = utime.ticks_add(utime.ticks_us(), -period)
+        return count
+
+    def fifo_sample(self, index: int, accel, gyro) -> None:
+        """
+        Decodes sample index of the last read_fifo into the given lists, same units as read_into.
+        """
+        offset = index * FIFO_SAMPLE_SIZE
+        _decode_into(self._fifo, offset, accel, self._accel_scale)
+        _decode_into(self._fifo, offset + 6, gyro, self._gyro_scale)
+
     def read_lpf_range(self) -> int:
         return self.i2c.readfrom_mem(self.address, 0x1A, 1)[0]
 
@@ -379,17 +572,40 @@ class Mpu:
     ZERO = [0.0, 0.0, 0.0]
     DELTA_TIME = 0.1
 
-    def __init__(self, flip=False, invert_x=False, invert_y=False):
+    # Gyro bias of the last full calibration and the temperature it was taken at
+    calibration_path = 'gyro_bias.json'
+    calibration_interval = 1  # ms between samples
+    calibration_min_samples = 100
+    calibration_max_samples = 2000
+    # Done once the bias is known this well (standard error of the mean), deg/s
+    calibration_tolerance = 0.01
+    # A sample this far from the mean so far means the board moved, calibration starts over, deg/s
+    calibration_motion = 2.0
+    # The cached bias is only used within this much of its temperature, celsius
+    calibration_temperature_delta = 5.0
+    # Check of the cached bias on boot, it is kept when the samples average within verify_tolerance of it
+    verify_samples = 100
+    verify_tolerance = 0.2  # deg/s
+
+    def __init__(
+        self, flip=False, invert_x=False, invert_y=False, i2c=None, int_pin=None, estimator=None, loop_period=None,
+    ):
         """
         :param flip: Flip X, Y axis
         :param invert_x: Invert X
         :param invert_y: Invert Y
+        :param i2c: Bus the sensor is on, set up from config.Mpu when not given
+        :param int_pin: Pin the INT pin of the sensor is wired to, set up from config.Mpu.INT when not given
+        :param estimator: attitude.Estimator fusing the samples, the one named by config.Mpu.estimator when not given
+        :param loop_period: ms between calls to loop, limits config.Mpu.fifo_rate to what the FIFO holds in between
         """
-        i2c: I2C = I2C(
-            config.Mpu.id,
-            sda=config.Mpu.SDA,
-            scl=config.Mpu.SCL,
-        )
+        if i2c is None:
+            i2c = I2C(
+                config.Mpu.id,
+                sda=config.Mpu.SDA,
+                scl=config.Mpu.SCL,
+                freq=config.Mpu.freq,
+            )
         # TODO: Enable Magnetometer
         self.ak8963 = None # Ak8963(i2c)
         self.mpu6500 = Mpu6500(i2c)
@@ -406,16 +622,30 @@ class Mpu:
         self.__gyro_calibration = self.__zero()
         # Last read in nanoseconds
         self.last_read = 0
-        self.__kalman_x = KalmanAngle()
-        self.__kalman_y = KalmanAngle()
+        # Only the selected one runs
+        self.estimator = estimator or ESTIMATORS[config.Mpu.estimator]()
         self.calibrate()
 
+        # Sample in the sensor FIFO and integrate every sample, however often loop is called
+        self.fifo = bool(config.Mpu.fifo_rate)
+        # Or only read when the sensor signals a new sample, timed by the interrupt
+        self.data_ready = not self.fifo and (int_pin is not None or config.Mpu.INT is not None)
+        if self.fifo:
+            self.mpu6500.enable_fifo(config.Mpu.fifo_rate, loop_period)
+        elif self.data_ready:
+            self.mpu6500.enable_data_ready(int_pin or Pin(config.Mpu.INT, Pin.IN), config.Mpu.rate)
+
     @property
     def angles(self):
+        """
+        Angles with flip and invert applied, always a copy: telemetry keeps the last one sent to compare against
+        """
         angles = self._angles
 
         if self.flip:
             angles = [angles[1], angles[0], angles[2]]
+        else:
+            angles = [angles[0], angles[1], angles[2]]
 
         if self.invert_x:
             angles[0] *= -1
@@ -425,6 +655,27 @@ class Mpu:
 
         return angles
 
+    @property
+    def gyro(self):
+        """
+        Last gyro reading, no copy is made so don't modify it
+        """
+        return self.__gyro
+
+    @property
+    def accel(self):
+        """
+        Last accelerometer reading, no copy is made so don't modify it
+        """
+        return self.__accel
+
+    @property
+    def fused_angles(self):
+        """
+        Filtered angles as computed, before flip and invert are applied
+        """
+        return self._angles
+
     def raw_gyro(self):
         """
         Gyro measured by the sensor. By default will return a 3-tuple of
@@ -460,44 +711,87 @@ class Mpu:
         return self.mpu6500.who_am_i()
 
     def calibrate(self):
+        """
+        Find the gyro bias. A cached bias taken at about the same temperature only gets a short check, otherwise
+        samples are taken until their mean settles, starting over whenever the board moves. A bias found while
+        still is cached for the next boot
+        """
         if self.ak8963:
             self.ak8963.calibrate()
 
-        # Run this code 2000 times
-        for i in range(0, 2000):
-            gyro_data = self.raw_gyro()
-
-            # add gyro offset vector to calibration vector
-            self.__add(self.__gyro_calibration, gyro_data)
-            utime.sleep_ms(3)  # Delay 3us to simulate the 250Hz program loop
-
-        self.__div(self.__gyro_calibration, 2000)
-
-    def acc_angle(self, ax, ay, az):
-        rad_to_deg = 180 / 3.14159
-        ax_angle = math.atan(ay / math.sqrt(math.pow(ax, 2) + math.pow(az, 2))) * rad_to_deg
-        ay_angle = math.atan((-1 * ax) / math.sqrt(math.pow(ay, 2) + math.pow(az, 2))) * rad_to_deg
-        return ax_angle, ay_angle
-
-    def gyr_angle(self, gx, gy, gz, dt):
-        gx_angle = gx * dt + self._angles[0]
-        gy_angle = gy * dt + self._angles[1]
-        gz_angle = gz * dt + self._angles[2]
-        return gx_angle, gy_angle, gz_angle
-
-    def c_filtered_angle(self, ax_angle, ay_angle, gx_angle, gy_angle):
-        alpha = 0.90
-        c_angle_x = alpha * gx_angle + (1.0 - alpha) * ax_angle
-        c_angle_y = alpha * gy_angle + (1.0 - alpha) * ay_angle
-        return c_angle_x, c_angle_y
-
-    def k_filtered_angle(self, ax_angle, ay_angle, gx, gy, dt):
+        started = utime.ticks_ms()
+        temperature = self.temperature()
+        cached = self.load_calibration()
+        if cached and abs(cached[1] - temperature) > self.calibration_temperature_delta:
+            cached = None
+
+        if cached:
+            bias, still = self.measure_bias(self.verify_samples, self.verify_samples, None)
+            # Moving on boot says nothing about the bias, the cache beats a bias taken while moving
+            if not still or all(abs(bias[i] - cached[0][i]) <= self.verify_tolerance for i in range(3)):
+                self.__set_calibration(cached[0])
+                print('GYRO CALIBRATION CACHED: %.3f %.3f %.3f deg/s AT %.1fC, %s IN %dms' % (
+                    cached[0][0], cached[0][1], cached[0][2], cached[1],
+                    'VERIFIED' if still else 'NOT VERIFIED (MOVING)', utime.ticks_diff(utime.ticks_ms(), started),
+                ))
+                return
+
+        bias, still = self.measure_bias(
+            self.calibration_min_samples, self.calibration_max_samples, self.calibration_tolerance,
+        )
+        if still:
+            self.save_calibration(bias, temperature)
+        elif cached:
+            bias = cached[0]
+        self.__set_calibration(bias)
+        print('GYRO CALIBRATION%s: %.3f %.3f %.3f deg/s AT %.1fC IN %dms' % (
+            '' if still else ' (MOVING)', bias[0], bias[1], bias[2], temperature,
+            utime.ticks_diff(utime.ticks_ms(), started),
+        ))
+
+    def measure_bias(self, min_samples: int, max_samples: int, tolerance):
         """
-        Kalman filter to determine the change in angle by combining accelerometer and gyro values.
+        Average gyro samples until the mean settles within tolerance, or max_samples were taken
+        :param tolerance: deg/s, None to always take min_samples
+        :return: (mean of the samples since the board last moved, True when there were at least min_samples of them)
         """
-        k_angle_x = self.__kalman_x.get_angle(ax_angle, gx, dt)
-        k_angle_y = self.__kalman_y.get_angle(ay_angle, gy, dt)
-        return k_angle_x, k_angle_y
+        stats = GyroStats()
+        accel = self.__zero()
+        gyro = self.__zero()
+        for _ in range(max_samples):
+            self.mpu6500.read_into(accel, gyro)
+            # A few samples in so the mean means something
+            if stats.count >= 10 and stats.moved(gyro, self.calibration_motion):
+                stats.reset()
+            stats.add(gyro)
+            if stats.count >= min_samples and (tolerance is None or stats.settled(tolerance)):
+                break
+            utime.sleep_ms(self.calibration_interval)
+        return stats.mean, stats.count >= min_samples
+
+    def load_calibration(self):
+        """
+        :return: (gyro bias, temperature) cached by the last calibration, None without a usable one
+        """
+        try:
+            with open(self.calibration_path) as f:
+                data = json.load(f)
+            if data['range'] != self.mpu6500.read_gyro_range():
+                return None
+            return data['bias'], data['temperature']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save_calibration(self, bias, temperature: float):
+        try:
+            with open(self.calibration_path, 'w') as f:
+                json.dump({'bias': bias, 'temperature': temperature, 'range': self.mpu6500.read_gyro_range()}, f)
+        except OSError as e:
+            print('GYRO CALIBRATION NOT SAVED: %s' % e)
+
+    def __set_calibration(self, bias):
+        for i in range(3):
+            self.__gyro_calibration[i] = bias[i]
 
     def m_filtered_angle(self, mx_angle, my_angle):
         """
@@ -522,38 +816,71 @@ class Mpu:
         return heading_angle_in_degrees_plus_declination
 
     def loop(self, *args, **kwargs):
+        if self.fifo:
+            self.loop_fifo()
+            return
+        if self.data_ready:
+            self.loop_data_ready()
+            return
+
         now = utime.time_ns()
         # Get time difference in seconds
         dt = (now - self.last_read) / (10**9 * 1.0)
-        self.__gyro = self.raw_gyro()
-        self.__accel = self.raw_accel()
+        self.mpu6500.read_into(self.__accel, self.__gyro)
         self.__magnetic = self.raw_magnetic()
+        self.update(dt)
+        self.last_read = now
 
-        ax = self.__accel[0]
-        ay = self.__accel[1]
-        az = self.__accel[2]
+    def loop_fifo(self):
+        """
+        Integrate every sample the sensor queued since the last call, each one with the exact sample period as dt
+        """
+        mpu6500 = self.mpu6500
+        count = mpu6500.read_fifo()
+        if not count:
+            return
 
-        # This is angular velocity in each of the 3 directions
-        gx = (self.__gyro[0] - self.__gyro_calibration[0])
-        gy = (self.__gyro[1] - self.__gyro_calibration[1])
-        gz = (self.__gyro[2] - self.__gyro_calibration[2])
+        self.__magnetic = self.raw_magnetic()
+        dt = mpu6500.fifo_period
+        for i in range(count):
+            mpu6500.fifo_sample(i, self.__accel, self.__gyro)
+            self.update(dt)
+        self.last_read = utime.time_ns()
 
-        mx = self.__magnetic[0]
-        my = self.__magnetic[1]
+    def loop_data_ready(self):
+        """
+        Integrate the newest sample if there is one, dt is the time between the interrupts of the samples
+        """
+        dt_us = self.mpu6500.read_ready(self.__accel, self.__gyro)
+        if not dt_us:
+            return
 
-        # Calculate angle of inclination or tilt for the x and y axes with acquired acceleration vectors
-        acc_angles = self.acc_angle(ax, ay, az)
-        # Calculate angle of inclination or tilt for x,y and z axes with angular rates and dt
-        gyr_angles = self.gyr_angle(gx, gy, gz, dt)
-        # filtered tilt angle i.e. what we're after
-        c_angle_x, c_angle_y = self.c_filtered_angle(acc_angles[0], acc_angles[1], gyr_angles[0], gyr_angles[1])
-        k_angle_x, k_angle_y = self.k_filtered_angle(acc_angles[0], acc_angles[1], gx, gy, dt)
+        self.__magnetic = self.raw_magnetic()
+        self.update(dt_us / 1000000)
+        self.last_read = utime.time_ns()
 
-        # Use magnetometer to calculate yaw / z axis
-        c_angle_z = self.m_filtered_angle(mx, my)
+    def update(self, dt):
+        """
+        Fuse the current gyro, accelerometer and magnetometer readings into the angles
+        :param dt: Seconds since the previous readings
+        """
+        gyro = self.__gyro
+        accel = self.__accel
+        calibration = self.__gyro_calibration
+        estimator = self.estimator
+        estimator.update(
+            gyro[0] - calibration[0], gyro[1] - calibration[1], gyro[2] - calibration[2],
+            accel[0], accel[1], accel[2], dt,
+        )
 
-        self._angles = [c_angle_x, c_angle_y, c_angle_z]
-        self.last_read = now
+        angles = self._angles
+        angles[0] = estimator.roll
+        angles[1] = estimator.pitch
+        if estimator.has_yaw:
+            angles[2] = estimator.yaw
+        else:
+            # Use magnetometer to calculate yaw / z axis
+            angles[2] = self.m_filtered_angle(self.__magnetic[0], self.__magnetic[1])
 
     @classmethod
     def __zero(cls):
@@ -0,0 +1,44 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+import attitude  # noqa: E402
+
+
+def tilted(roll, pitch):
+    roll *= attitude.DEG_TO_RAD
+    pitch *= attitude.DEG_TO_RAD
+    return -math.sin(pitch), math.sin(roll) * math.cos(pitch), math.cos(roll) * math.cos(pitch)
+
+
+def test_still():
+    """Test every estimator settles on the tilt of a still board"""
+    for roll, pitch in ((20, 0), (0, -10)):
+        ax, ay, az = tilted(roll, pitch)
+        for name, estimator in attitude.ESTIMATORS.items():
+            estimator = estimator()
+            # Kalman takes its time with the stock tuning at 1kHz
+            for _ in range(5000):
+                estimator.update(0.0, 0.0, 0.0, ax, ay, az, 0.001)
+            assert abs(estimator.roll - roll) < 0.1, name
+            assert abs(estimator.pitch - pitch) < 0.1, name
+
+
+def test_rotation():
+    """Test the quaternion estimators start from the accelerometer and follow the gyro, yaw included"""
+    for estimator in (attitude.Madgwick(), attitude.Mahony()):
+        estimator.update(0.0, 0.0, 0.0, *tilted(30, 0), 0.001)
+        assert abs(estimator.roll - 30) < 0.1
+
+        estimator = type(estimator)()
+        estimator.update(0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.001)
+        # No accelerometer, gyro only: 90 deg/s about z then -30 deg/s about x, for a second each
+        for _ in range(1000):
+            estimator.update(0.0, 0.0, 90.0, 0.0, 0.0, 0.0, 0.001)
+        assert abs(estimator.yaw - 90) < 0.1
+        for _ in range(1000):
+            estimator.update(-30.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.001)
+        assert abs(estimator.roll + 30) < 0.1
+        assert abs(estimator.pitch) < 0.1
+        assert abs(estimator.yaw - 90) < 0.1
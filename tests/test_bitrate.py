@@ -0,0 +1,54 @@
+import time
+from utils.bitrate import BitrateController, DEFAULT_LEVEL, LEVELS
+
+
+class FakeCapture:
+    width = 320
+    height = 240
+    fps = 24
+    quality = 70
+
+
+def test_steps_down_and_up():
+    """
+    Test a backed up send buffer or late acks step quality down, and a good link steps it back up after a while
+    """
+    capture = FakeCapture()
+    controller = BitrateController(capture)
+    assert controller.level == DEFAULT_LEVEL
+    # Never above the quality it was created with
+    assert capture.quality == 70
+
+    now = controller.changed_at + controller.hold
+    controller.acknowledge(1, time.time_ns() // 1000)
+    assert controller.update(buffered=50000, frame_bytes=10000, now=now)
+    assert controller.level == DEFAULT_LEVEL + 1
+    # Changes get some time before they are judged
+    assert not controller.update(buffered=50000, frame_bytes=10000, now=now + 1)
+
+    now += controller.hold
+    controller.latency = controller.latency_target * 2
+    controller.acked_at = now
+    assert controller.update(buffered=0, frame_bytes=10000, now=now)
+    assert (capture.width, capture.height, capture.fps) == LEVELS[DEFAULT_LEVEL + 2][:3]
+
+    controller.latency = 10
+    now += controller.hold
+    controller.acked_at = now + controller.step_up_after
+    assert not controller.update(buffered=0, frame_bytes=10000, now=now)
+    assert controller.update(buffered=0, frame_bytes=10000, now=now + controller.step_up_after)
+    assert controller.level == DEFAULT_LEVEL + 1
+    assert (controller.steps_down, controller.steps_up) == (2, 1)
+
+
+def test_reset():
+    """
+    Test a stream starting after a pause is not stepped down for the acks it could not get meanwhile
+    """
+    controller = BitrateController(FakeCapture())
+    controller.latency = controller.latency_target * 2
+    now = controller.acked_at + controller.ack_timeout * 10
+    controller.reset(now)
+    assert not controller.update(buffered=0, frame_bytes=10000, now=now + controller.hold)
+    assert controller.level == DEFAULT_LEVEL
+    assert controller.update(buffered=0, frame_bytes=10000, now=now + controller.hold + controller.ack_timeout + 1)
@@ -0,0 +1,74 @@
+import os
+import sys
+from types import SimpleNamespace
+from utils import blackbox as log_format
+from utils.network import NetworkEvent
+from utils.pid import PID
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+import blackbox  # noqa: E402
+
+
+def fake_controller():
+    motors = [SimpleNamespace(throttle=1000 + i) for i in range(4)]
+    sensor = SimpleNamespace(gyro=[1.0, 2.0, 3.0], accel=[0.0, 0.0, 1.0], fused_angles=[5.0, -5.0, 0.0])
+    return SimpleNamespace(
+        sensor=sensor,
+        pid_r=PID(Kp=5.0), pid_p=PID(Kp=5.0), pid_y=PID(Kp=0.5),
+        motor_fl=motors[0], motor_fr=motors[1], motor_br=motors[2], motor_bl=motors[3],
+    )
+
+
+def test_record_flush_download(tmp_path):
+    """
+    Test records make it to flash in whole blocks and come back intact through a download
+    """
+    recorder = blackbox.Blackbox(path=str(tmp_path / 'blackbox.bin'))
+    controller = fake_controller()
+    controller.pid_r(1.0)
+    records = recorder.block_records * 2 + 5
+    for _ in range(records):
+        recorder.record(controller)
+    recorder.flush()
+    assert recorder.flushed == recorder.block_records * 2
+
+    chunks = []
+    recorder.start_download(lambda event, data: chunks.append((event, bytes(data))))
+    while recorder._download:
+        recorder.transfer()
+
+    assert all(event == NetworkEvent.BLACKBOX for event, _ in chunks)
+    assert chunks[-1][1] == b''
+    decoded = log_format.decode(b''.join(data for _, data in chunks))
+    assert len(decoded) == recorder.flushed
+    assert decoded[0]['gyro_y'] == 2.0
+    assert decoded[0]['roll_p'] == -5.0
+    assert decoded[0]['motor_bl'] == 1003
+
+
+def test_ring_full_drops():
+    """
+    Test the control loop drops records instead of overwriting ones not on flash yet
+    """
+    recorder = blackbox.Blackbox()
+    controller = fake_controller()
+    for _ in range(recorder.capacity + 3):
+        recorder.record(controller)
+    assert recorder.written == recorder.capacity
+    assert recorder.dropped == 3
+
+
+def test_large_ticks(monkeypatch):
+    """
+    Test timestamps past 32 bits wrap instead of failing to pack, like after a long uptime on CPython
+    """
+    offset = 5000 * 1000000
+    monkeypatch.setattr(blackbox.helpers, 'ticks_us', lambda: offset)
+    recorder = blackbox.Blackbox()
+    controller = fake_controller()
+    recorder.record(controller)
+    controller.sensor = None
+    recorder.record(controller)
+    assert recorder.written == 2
+    decoded = log_format.decode(log_format.encode_header() + bytes(recorder.buf[:2 * log_format.RECORD_SIZE]))
+    assert [x['timestamp'] for x in decoded] == [offset & 0xFFFFFFFF] * 2
@@ -0,0 +1,116 @@
+import asyncio
+import struct
+import numpy
+from utils import camera, delta
+from utils.camera import FrameCodec
+
+
+def make_frame(x):
+    frame = numpy.tile(numpy.arange(100, dtype=numpy.uint8), (60, 1))
+    frame[10:20, x:x + 10] = 255
+    return frame
+
+
+def feed(receiver, data):
+    # Like a socket would, never more than the receiver asks for
+    while data:
+        view = receiver.buffer()
+        size = min(len(view), len(data))
+        view[:size] = data[:size]
+        data = data[size:]
+        receiver.advance(size)
+
+
+def test_tiles_round_trip():
+    """
+    Test only changed tiles are picked and putting them back rebuilds the frame, sizes that are not whole tiles too
+    """
+    key = delta.pad(make_frame(0), delta.TILE)
+    frame = delta.pad(make_frame(40), delta.TILE)
+    mask = delta.changed_tiles(frame, key, delta.TILE)
+    assert 0 < mask.sum() < mask.size // 2
+
+    rebuilt = key.copy()
+    delta.scatter(rebuilt, mask, delta.gather(frame, mask, delta.TILE), delta.TILE)
+    assert (rebuilt == frame).all()
+    assert (delta.unpack_mask(delta.pack_mask(mask), *mask.shape) == mask).all()
+
+
+def test_delta_frames():
+    """
+    Test the client rebuilds full frames from lossless delta frames, and skips deltas of a keyframe it never got
+    """
+    encoder = delta.DeltaEncoder()
+    params = camera.encode_params(FrameCodec.PNG)
+    frames = [make_frame(x) for x in range(0, 50, 5)]
+    sent = [camera.encode_delta_frame(x, encoder, FrameCodec.PNG, params, i + 1) for i, x in enumerate(frames)]
+    assert encoder.keyframes == 1 and encoder.deltas == len(frames) - 1
+    assert encoder.ratio > 1
+
+    received = []
+    receiver = camera.FrameReceiver(received.append)
+    for data in sent:
+        feed(receiver, data)
+    assert len(received) == len(frames)
+    assert all((a == b).all() for a, b in zip(received, frames))
+
+    late = camera.FrameReceiver(received.append)
+    for data in sent[1:]:
+        feed(late, data)
+    assert late.skipped == len(frames) - 1
+
+
+def test_frame_too_large():
+    """
+    Test a header claiming more than any frame can be is refused before anything is allocated for it
+    """
+    frame = bytearray(camera.encode_frame(make_frame(0), FrameCodec.PNG, camera.encode_params(FrameCodec.PNG), 1))
+    struct.pack_into('<I', frame, camera.FRAME_HEADER_SIZE - 4, 0xFFFFFFFF)
+    receiver = camera.FrameReceiver(lambda image: None)
+    try:
+        feed(receiver, bytes(frame[:camera.FRAME_HEADER_SIZE]))
+        assert False
+    except ValueError:
+        pass
+    assert len(receiver._body) == camera.BUFFER_SIZE
+
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_decode_off_loop():
+    """
+    Test the asyncio receiver decodes on a worker, in order, and the loop carries on meanwhile
+    """
+    encoder = delta.DeltaEncoder()
+    params = camera.encode_params(FrameCodec.PNG)
+    frames = [make_frame(x) for x in range(0, 50, 5)]
+    sent = [camera.encode_delta_frame(x, encoder, FrameCodec.PNG, params, i + 1) for i, x in enumerate(frames)]
+
+    async def run():
+        received = []
+        protocol = camera.FrameProtocol(received.append)
+        protocol.max_pending = len(sent)
+        protocol.connection_made(Transport())
+        for data in sent:
+            while data:
+                view = protocol.get_buffer(-1)
+                size = min(len(view), len(data))
+                view[:size] = data[:size]
+                data = data[size:]
+                protocol.buffer_updated(size)
+        # Nothing decoded on the loop itself
+        assert received == []
+        while protocol.pending:
+            await asyncio.sleep(0.01)
+        protocol.connection_lost(None)
+        return received
+
+    received = asyncio.run(run())
+    assert len(received) == len(frames)
+    assert all((a == b).all() for a, b in zip(received, frames))
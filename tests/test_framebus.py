@@ -0,0 +1,35 @@
+import numpy
+from utils.framebus import FrameBus
+
+
+def test_framebus():
+    """Test readers get the latest frame in place and see when it was overwritten"""
+    bus = FrameBus.create('test_framebus', 8, 4, channels=1, slots=2)
+    reader = FrameBus.attach('test_framebus')
+    try:
+        assert (reader.width, reader.height, reader.channels, reader.slots) == (8, 4, 1, 2)
+        assert reader.read() is None
+
+        bus.write(numpy.full((4, 8, 1), 1, numpy.uint8), 100)
+        bus.write(numpy.full((4, 8, 1), 2, numpy.uint8), 200)
+        sequence, timestamp, frame = reader.read()
+        assert (sequence, timestamp) == (2, 200)
+        assert (frame == 2).all()
+        assert reader.read(after=2) is None
+
+        # Two slots, frame 2 is gone after two more
+        bus.begin()[:] = 3
+        assert reader.read(after=2) is None
+        bus.commit(300)
+        bus.write(numpy.full((4, 8, 1), 4, numpy.uint8), 400)
+        assert not reader.valid(sequence)
+
+        sequence, timestamp, frame = reader.wait(after=2, timeout=0.1, copy=True)
+        assert (sequence, timestamp) == (4, 400)
+        bus.write(numpy.full((4, 8, 1), 5, numpy.uint8), 500)
+        bus.write(numpy.full((4, 8, 1), 6, numpy.uint8), 600)
+        assert (frame == 4).all()
+        assert reader.wait(after=6, timeout=0.01) is None
+    finally:
+        reader.close()
+        bus.close()
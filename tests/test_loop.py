@@ -0,0 +1,28 @@
+import time
+from utils.loop import EventLoop, LoopStats
+
+
+def test_loop_time():
+    """Test the iteration time covers handlers in poll and the tasks but not the wait for sockets"""
+    ran = []
+
+    def poll(timeout):
+        time.sleep(0.1)
+        # Handling what came in
+        time.sleep(0.03)
+        return 100000
+
+    loop = EventLoop(poll)
+    loop.every(1000, lambda: ran.append(1))
+    loop.loop()
+    assert ran == [1]
+    assert 30000 <= loop.stats.last_us < 80000
+
+
+def test_average_small():
+    """Test the average follows costs of a few microseconds"""
+    stats = LoopStats()
+    for _ in range(100):
+        stats.add(5)
+    assert 4.5 < stats.avg_us <= 5
+    assert str(stats) == '5.0/5/5us'
@@ -0,0 +1,410 @@
+import os
+import socket
+import struct
+import sys
+import time
+from utils import network, helpers
+from utils.network import NetworkEvent, Codec
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+import radio  # noqa: E402
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = bytearray()
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+
+class Connection(network.BaseConnection):
+    def __init__(self, codec=Codec.TEXT):
+        self.events = []
+        super().__init__(lambda event, data: self.events.append((event, data)))
+        self.codec = codec
+
+
+def send_all(codec, messages):
+    sock = FakeSocket()
+    connection = Connection(codec)
+    for event, data in messages:
+        connection._send(sock, event, data)
+    return bytes(sock.sent)
+
+
+MESSAGES = [
+    (NetworkEvent.CONNECTED, Codec.BINARY),
+    (NetworkEvent.CONTROL, (50.0, -15, 15, 90, 0, 0)),
+    (NetworkEvent.TELEMETRY, ('ROTATION', '1.00,2.00,0.00')),
+    (NetworkEvent.STOP, network.EMPTY_CHAR),
+]
+
+
+def test_codecs_round_trip():
+    """
+    Test both codecs decode to the same events
+    """
+    for codec in Codec.all():
+        receiver = Connection()
+        data = send_all(codec, MESSAGES)
+        assert receiver.handle_message(data) == len(data)
+        assert receiver.events == MESSAGES
+
+
+def test_telemetry_with_separator():
+    """
+    Test telemetry values with `/` in them survive both codecs
+    """
+    records = [
+        (NetworkEvent.TELEMETRY, ('LOOP_TIME', '120/900/80us')),
+        (NetworkEvent.TELEMETRY, ('BLACKBOX', '10/0 3/7/2us')),
+        (NetworkEvent.TELEMETRY, ('LINK', '4.2/0.3ms 0.0%')),
+    ]
+    for codec in Codec.all():
+        receiver = Connection()
+        receiver.handle_message(send_all(codec, records))
+        assert receiver.events == records
+
+
+def test_text_blackbox():
+    """
+    Test log chunks reach text clients whole, split to fit their receive buffer
+    """
+    server = radio.ServerConnection(lambda event, data: None, port=0)
+    server._conn = FakeSocket()
+    chunk = bytes(range(256)) * 2
+    server.send(NetworkEvent.BLACKBOX, memoryview(chunk))
+    server.send(NetworkEvent.BLACKBOX, b'')
+    server.server.close()
+
+    receiver = Connection()
+    # Through the receive buffer, which a frame must fit
+    receiver.reader.feed(server._conn.sent, receiver.dispatch)
+    assert [event for event, _ in receiver.events] == [NetworkEvent.BLACKBOX] * 3
+    assert b''.join(data for _, data in receiver.events) == chunk
+    assert receiver.events[-1][1] == b''
+
+
+def test_mixed_stream():
+    """
+    Test text and binary frames on the same stream, as seen while a codec is being negotiated
+    """
+    receiver = Connection()
+    receiver.handle_message(send_all(Codec.TEXT, MESSAGES[:2]) + send_all(Codec.BINARY, MESSAGES[2:]))
+    assert receiver.events == MESSAGES
+
+
+def test_incomplete_frame():
+    """
+    Test partial frames are left unconsumed
+    """
+    data = send_all(Codec.BINARY, MESSAGES[1:2])
+    receiver = Connection()
+    assert receiver.handle_message(data[:-1]) == 0
+    assert receiver.events == []
+
+
+def test_bad_checksum():
+    """
+    Test corrupted frames are skipped without losing the next one
+    """
+    corrupted = bytearray(send_all(Codec.BINARY, MESSAGES[1:2]))
+    corrupted[network.HEADER_SIZE] ^= 0x0F
+    receiver = Connection()
+    receiver.handle_message(bytes(corrupted) + send_all(Codec.BINARY, MESSAGES[3:]))
+    assert receiver.events == MESSAGES[3:]
+
+
+def test_malformed_text():
+    """
+    Test malformed text frames are dropped without losing the next one
+    """
+    receiver = Connection()
+    data = b'garbage$$CONTROL##1/2$$STOP##a##b$$' + bytes([0xFF]) + b'$$' + send_all(Codec.TEXT, MESSAGES[3:])
+    assert receiver.handle_message(data) == len(data)
+    assert receiver.events == MESSAGES[3:]
+
+
+def test_payload_too_large():
+    """
+    Test oversized payloads are refused without growing the send buffer
+    """
+    buf = bytearray(network.MAX_FRAME)
+    for event, data in (
+        (NetworkEvent.TELEMETRY, ('LOG', 'x' * network.MAX_PAYLOAD)),
+        (NetworkEvent.SESSION, 'x' * (network.MAX_PAYLOAD + 1)),
+    ):
+        try:
+            network.encode_binary(buf, event, data)
+            assert False
+        except ValueError:
+            pass
+        assert len(buf) == network.MAX_FRAME
+
+
+def make_frame(event, payload):
+    buf = bytearray(network.HEADER_SIZE) + payload + bytearray(network.CHECKSUM_SIZE)
+    code = NetworkEvent.CODES[event]
+    struct.pack_into(network.HEADER_FORMAT, buf, 0, network.FRAME_MAGIC, network.PROTOCOL_VERSION, code, len(payload))
+    end = network.HEADER_SIZE + len(payload)
+    struct.pack_into(network.CHECKSUM_FORMAT, buf, end, network.checksum(buf, 0, end))
+    return bytes(buf)
+
+
+def test_malformed_binary():
+    """
+    Test binary frames with a good checksum but a payload that doesn't fit their event are dropped alone
+    """
+    data = (
+        make_frame(NetworkEvent.CONTROL, b'\x01\x02')
+        + make_frame(NetworkEvent.PING, bytes(network.PING_SIZE + 1))
+        + make_frame(NetworkEvent.TELEMETRY, b'\x09ROT')
+        + make_frame(NetworkEvent.TELEMETRY, b'\x03ROT\xff')
+        + make_frame(NetworkEvent.SESSION, b'\xfe')
+        + send_all(Codec.BINARY, MESSAGES[3:])
+    )
+    receiver = Connection()
+    assert receiver.handle_message(data) == len(data)
+    assert receiver.events == MESSAGES[3:]
+
+
+class ChunkedSocket:
+    """
+    Socket handing out data a few bytes at a time
+    """
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+
+    def recv_into(self, buf):
+        size = min(self.chunk, len(buf), len(self.data))
+        buf[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+def test_fragmented_stream():
+    """
+    Test frames split across reads are reassembled, for every split size
+    """
+    data = send_all(Codec.TEXT, MESSAGES) + send_all(Codec.BINARY, MESSAGES)
+    for chunk in range(1, 20):
+        receiver = Connection()
+        sock = ChunkedSocket(data, chunk)
+        while receiver.receive(sock):
+            pass
+        assert receiver.events == MESSAGES + MESSAGES
+        assert receiver.reader.end == 0
+
+
+def test_sequence_wrap():
+    """
+    Test sequence comparison across the 32 bit wrap
+    """
+    assert helpers.sequence_newer(1, 0)
+    assert helpers.sequence_newer(2, 1)
+    assert not helpers.sequence_newer(1, 2)
+    assert not helpers.sequence_newer(5, 5)
+    assert helpers.sequence_newer(helpers.next_sequence(helpers.SEQUENCE_MASK), helpers.SEQUENCE_MASK)
+
+
+def test_udp_latest_control():
+    """
+    Test only the newest of the pending CONTROL datagrams is dispatched
+    """
+    events = []
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    control_port = probe.getsockname()[1]
+    probe.close()
+
+    server = radio.ServerConnection(lambda event, data: events.append((event, data)), port=0, control_port=control_port)
+    server._conn = FakeSocket()
+    server._peer = '127.0.0.1'
+    sender = Connection(Codec.BINARY)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', control_port))
+    for sequence in [1, 3, 2]:
+        sender._send(sock, NetworkEvent.CONTROL, (50.0, sequence, 0, 0, sequence, 0))
+
+    time.sleep(0.05)
+    assert server.listen_control() == 1
+    assert events == [(NetworkEvent.CONTROL, (50.0, 3, 0, 0, 3, 0))]
+    assert server.control_received == 3
+    assert server.listen_control() == 0
+
+    # Anyone but the TCP client is ignored
+    server._peer = '10.0.0.1'
+    sender._send(sock, NetworkEvent.CONTROL, (50.0, 4, 0, 0, 4, 0))
+    time.sleep(0.05)
+    assert server.listen_control() == 0
+    assert server.control_rejected == 1
+    assert len(events) == 1
+
+    sock.close()
+    server._udp.close()
+    server.server.close()
+
+
+def test_server_poll():
+    """
+    Test accept and receive are driven by poll without blocking in between
+    """
+    events = []
+    server = radio.ServerConnection(lambda event, data: events.append((event, data)), port=0)
+    server.poll(0)
+    assert server._conn is None
+
+    client = socket.create_connection(('127.0.0.1', server.server.getsockname()[1]))
+    server.poll(500)
+    assert server._conn is not None
+
+    client.sendall(send_all(Codec.BINARY, MESSAGES[3:]))
+    server.poll(500)
+    assert events == MESSAGES[3:]
+
+    client.close()
+    server.poll(500)
+    assert server._conn is None
+    server.server.close()
+
+
+def test_slow_client():
+    """
+    Test sending never blocks on a client that doesn't read, what doesn't fit is queued and flushed once it reads
+    again, and a client that falls too far behind is dropped
+    """
+    server = radio.ServerConnection(lambda event, data: None, port=0)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.connect(('127.0.0.1', server.server.getsockname()[1]))
+    server.poll(500)
+    server._conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    server.codec = Codec.BINARY
+
+    expected = send_all(Codec.BINARY, MESSAGES[2:3])
+    sent = 0
+    while not server.backlog:
+        server.send(*MESSAGES[2])
+        sent += 1
+
+    # The socket is not writable until the client reads, everything comes out in order after
+    received = bytearray()
+    client.settimeout(1)
+    while len(received) < len(expected) * sent:
+        server.poll(10)
+        received += client.recv(65536)
+    assert received.endswith(expected * sent)
+    assert not server.backlog
+
+    while server._conn:
+        server.send(*MESSAGES[2])
+        server.poll(0)
+    assert server.state == radio.STATE_IDLE
+
+    client.close()
+    server.server.close()
+
+
+def test_handler_error():
+    """
+    Test an event the handler fails on doesn't cost the client its connection
+    """
+    events = []
+
+    def handler(event, data):
+        if event == NetworkEvent.CONTROL:
+            raise Exception('EVENT %s UNKNOWN' % event)
+        events.append((event, data))
+
+    server = radio.ServerConnection(handler, port=0)
+    client = socket.create_connection(('127.0.0.1', server.server.getsockname()[1]))
+    server.poll(500)
+    client.sendall(send_all(Codec.BINARY, MESSAGES[1:]))
+    server.poll(500)
+    assert server._conn is not None
+    assert events == MESSAGES[2:]
+
+    client.close()
+    server.poll(500)
+    server.server.close()
+
+
+def test_session_resume():
+    """
+    Test a client coming back with its token gets codec and sequence back without a new handshake
+    """
+    events = []
+    server = radio.ServerConnection(lambda event, data: events.append((event, data)), port=0)
+    address = ('127.0.0.1', server.server.getsockname()[1])
+
+    def session(sock, messages):
+        for event, data in messages:
+            Connection()._send(sock, event, data)
+        server.poll(500)
+        server.poll(500)
+        receiver = Connection()
+        receiver.handle_message(sock.recv(1024))
+        return [network.decode_session(data) for event, data in receiver.events if event == NetworkEvent.SESSION]
+
+    client = socket.create_connection(address)
+    server.poll(500)
+    [(token, resumed, _)] = session(client, [(NetworkEvent.CONNECTED, Codec.BINARY)])
+    assert not resumed
+    sender = Connection(Codec.BINARY)
+    sender._send(client, NetworkEvent.CONTROL, (50.0, 0, 0, 0, 5, 0))
+    server.poll(500)
+    client.close()
+    server.poll(500)
+    assert server._conn is None
+
+    events.clear()
+    client = socket.create_connection(address)
+    server.poll(500)
+    assert session(client, [(NetworkEvent.SESSION, token)]) == [(token, True, 5)]
+    assert server.codec == Codec.BINARY
+    assert server.sessions_resumed == 1
+    assert [event for event, _ in events] == []
+
+    client.close()
+    server.poll(500)
+    client = socket.create_connection(address)
+    server.poll(500)
+    [(new_token, resumed, _)] = session(client, [(NetworkEvent.SESSION, 'unknown')])
+    assert not resumed and new_token != token
+    client.close()
+    server.poll(500)
+    server.server.close()
+
+
+def test_ping_pong():
+    """
+    Test the server answers a PING with its timestamps and the client turns them into round trip and offset
+    """
+    from client.link import LinkEstimator
+
+    server = radio.ServerConnection(None, port=0)
+    server._conn = FakeSocket()
+    server.codec = Codec.BINARY
+    link = LinkEstimator()
+    server.dispatch(NetworkEvent.PING, link.ping(1000))
+
+    receiver = Connection()
+    receiver.handle_message(bytes(server._conn.sent))
+    [(event, pong)] = receiver.events
+    assert event == NetworkEvent.PONG and pong[0] == 1
+    assert server.pings == 1
+
+    # Server held it for 50us out of a 3050us round trip
+    ping_id, echoed, server_ms, _ = pong
+    assert link.pong((ping_id, echoed, server_ms, 50), 4050)
+    assert link.rtt == 3000
+    assert link.offset == server_ms * 1000 - 2500
+    assert not link.pong((ping_id, echoed, server_ms, 50), 5000)
+
+    link.ping(10000)
+    link.ping(link.timeout + 20000)
+    assert link.lost == 1 and link.loss == 0.5
+    server.server.close()
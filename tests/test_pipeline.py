@@ -0,0 +1,107 @@
+import threading
+import time
+from utils.pipeline import DropQueue, Pipeline
+
+
+class FakeCapture:
+    fps = 200
+
+    def grab(self):
+        return b'frame', time.time_ns() // 1000
+
+    def encode(self, frame, timestamp, sequence):
+        time.sleep(0.002)
+        return bytes(sequence % 256 for _ in range(100))
+
+
+def test_drop_queue():
+    """
+    Test a full queue drops its oldest item instead of blocking
+    """
+    queue = DropQueue(2)
+    for item in range(3):
+        queue.put(item)
+    assert queue.dropped == 1
+    assert queue.get(0) == 1
+    assert queue.get(0) == 2
+    assert queue.get(0) is None
+
+
+def test_drop_queue_keep():
+    """
+    Test a full queue drops the oldest item it doesn't have to keep, and the oldest of all when it keeps them all
+    """
+    queue = DropQueue(2, keep=lambda item: item < 0)
+    for item in (-1, 1, 2, -2, 3):
+        queue.put(item)
+    assert queue.dropped == 3
+    assert (queue.get(0), queue.get(0)) == (-2, 3)
+
+    for item in (-1, -2, -3):
+        queue.put(item)
+    assert (queue.get(0), queue.get(0)) == (-2, -3)
+
+
+class DeltaCapture(FakeCapture):
+    """
+    Every 4th frame encoded is a keyframe, slow enough to finish after the delta following it
+    """
+    fps = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.keyframes = []
+
+    def encode(self, frame, timestamp, sequence):
+        with self.lock:
+            keyframe = not self.count % 4
+            self.count += 1
+        if keyframe:
+            time.sleep(0.03)
+            self.keyframes.append(sequence)
+        return bytes([keyframe, sequence % 256])
+
+    def is_keyframe(self, data):
+        return bool(data[0])
+
+
+def test_keyframes_never_stale():
+    """
+    Test keyframes go out even when they finish after a newer frame was sent
+    """
+    sent = []
+    capture = DeltaCapture()
+    pipeline = Pipeline(capture, sent.append)
+    pipeline.start()
+    time.sleep(0.4)
+    pipeline.stop()
+
+    keyframes = [data[1] for data in sent if data[0]]
+    sequences = [data[1] for data in sent]
+    # Some went out after a newer frame, which would have made them stale
+    assert sequences != sorted(sequences)
+    assert len(capture.keyframes) > 2
+    # The last one may still have been queued when the pipeline stopped
+    assert [x % 256 for x in capture.keyframes[:-1]] == keyframes[:len(capture.keyframes) - 1]
+
+
+def test_slow_send_drops():
+    """
+    Test a slow send loses frames but never stalls capture, and frames are sent in order
+    """
+    sent = []
+
+    def send(data):
+        time.sleep(0.02)
+        sent.append(data)
+
+    pipeline = Pipeline(FakeCapture(), send)
+    pipeline.start()
+    time.sleep(0.3)
+    pipeline.stop()
+
+    assert pipeline.captured > 2 * len(sent) > 0
+    assert pipeline.dropped > 0
+    assert sent == sorted(sent)
+    assert 'fps' in pipeline.report()
@@ -0,0 +1,97 @@
+import os
+import sys
+from utils import network, telemetry
+from utils.network import Codec, NetworkEvent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-computer'))
+import relay  # noqa: E402
+
+
+class Writer:
+    def __init__(self):
+        self.written = b''
+
+    def write(self, data):
+        self.written += data
+
+    def get_extra_info(self, name):
+        return '127.0.0.1', 0
+
+
+def test_publish_per_codec():
+    """
+    Test every subscriber gets events in the codec it negotiated, encoded once per codec
+    """
+    server = relay.Relay()
+    channel = relay.Channel('TELEMETRY', 4)
+    subscribers = [relay.Subscriber(Writer(), 4) for _ in range(3)]
+    subscribers[1].codec = Codec.BINARY
+    channel.subscribers = set(subscribers)
+
+    codecs = []
+
+    def encode(event, data, codec):
+        codecs.append(codec)
+        return server.encode(event, data, codec)
+
+    buf = bytearray(64)
+    size = telemetry.encode_snapshot_record(buf, 0, 1, '12.5')
+    records = telemetry.TelemetryRecord.all()
+    channel.publish_event(encode, NetworkEvent.SNAPSHOT, bytes(buf[:size]))
+    channel.publish_event(encode, NetworkEvent.TELEMETRY, ('ROTATION', '1.0,2.0,0.0'))
+    assert sorted(codecs) == sorted(Codec.all() * 2)
+
+    for subscriber in subscribers:
+        messages = b''.join(subscriber.queue)
+        # Text frames start with the event name, binary ones with the magic byte
+        assert messages.startswith(b'TELEMETRY') == (subscriber.codec == Codec.TEXT)
+        events = []
+        receiver = network.BaseConnection(lambda event, data: events.append((event, data)))
+        assert receiver.handle_message(messages) == len(messages)
+        expected = [(NetworkEvent.TELEMETRY, (records[1], '12.5'))]
+        if subscriber.codec == Codec.BINARY:
+            expected = [(NetworkEvent.SNAPSHOT, bytes(buf[:size]))]
+        assert events == expected + [(NetworkEvent.TELEMETRY, ('ROTATION', '1.0,2.0,0.0'))]
+
+
+class Upstream:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, event, data=network.EMPTY_CHAR):
+        self.sent.append(event)
+
+
+def decode(data):
+    events = []
+    receiver = network.BaseConnection(lambda event, data: events.append((event, data)))
+    assert receiver.handle_message(data) == len(data)
+    return events
+
+
+def test_blackbox_to_requester():
+    """
+    Test a blackbox download is forwarded upstream and only goes back to the subscriber that asked
+    """
+    server = relay.Relay()
+    server.upstream = Upstream()
+    requester, other = relay.Subscriber(Writer(), 4), relay.Subscriber(Writer(), 4)
+    requester.codec = Codec.BINARY
+    server.telemetry.subscribers = {requester, other}
+
+    server.handle_subscriber(requester, 1, NetworkEvent.BLACKBOX, network.EMPTY_CHAR)
+    assert server.upstream.sent == [NetworkEvent.BLACKBOX]
+
+    # Only one download at a time, the second one ends right away
+    server.handle_subscriber(other, 2, NetworkEvent.BLACKBOX, network.EMPTY_CHAR)
+    assert server.upstream.sent == [NetworkEvent.BLACKBOX]
+    assert decode(other.writer.written) == [(NetworkEvent.BLACKBOX, b'')]
+    other.writer.written = b''
+
+    # More chunks than the queue holds, none of them may be dropped
+    chunks = [bytes([x]) * 100 for x in range(8)] + [b'']
+    for chunk in chunks:
+        server.on_upstream(NetworkEvent.BLACKBOX, chunk)
+    assert decode(requester.writer.written) == [(NetworkEvent.BLACKBOX, x) for x in chunks]
+    assert not requester.queue and not other.queue and not other.writer.written
+    assert server.blackbox_subscriber is None
@@ -0,0 +1,241 @@
+import os
+import struct
+import sys
+from benchmarks import stand_ins
+
+stand_ins.install()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flight-controller'))
+import attitude  # noqa: E402
+import sensor  # noqa: E402
+
+
+def make_bus():
+    bus = stand_ins.RegisterBus()
+    struct.pack_into('>hhhhhhh', bus.registers, 0x3B, 120, -80, 16384, 3000, 12, -7, -32768)
+    return bus
+
+
+def test_read_into():
+    """Test the burst read decodes the same values as the separate reads, in one transaction"""
+    bus = make_bus()
+    mpu = sensor.Mpu6500(bus)
+    mpu.write_gyro_range(1)
+    accel = [0.0, 0.0, 0.0]
+    gyro = [0.0, 0.0, 0.0]
+    bus.reset_counters()
+    mpu.read_into(accel, gyro)
+    assert bus.transactions == 1
+    assert accel == list(mpu.read_accel_data())
+    assert gyro == list(mpu.read_gyro_data())
+    assert gyro[2] == -32768 / 65.5
+    assert mpu.raw_temperature == 3000
+
+
+def test_fifo():
+    """Test every queued sample comes out of one bulk read, in order, and a full FIFO is drained then starts over"""
+    bus = stand_ins.Mpu6500Bus()
+    mpu = sensor.Mpu6500(bus)
+    assert mpu.enable_fifo(250) == 250
+    assert bus.registers[0x19] == 3
+    assert mpu.enable_fifo(1000) == 1000
+    assert mpu.fifo_period_us == 1000
+
+    for i in range(5):
+        bus.sample(accel=(0, i, 16384), gyro=(131 * i, 0, -131))
+    bus.reset_counters()
+    assert mpu.read_fifo() == 5
+    assert bus.transactions == 2
+    accel = [0.0, 0.0, 0.0]
+    gyro = [0.0, 0.0, 0.0]
+    for i in range(5):
+        mpu.fifo_sample(i, accel, gyro)
+        assert accel == [0.0, i / 16384, 1.0]
+        assert gyro == [float(i), 0.0, -1.0]
+    assert mpu.read_fifo() == 0
+
+    for i in range(sensor.FIFO_SAMPLES + 1):
+        bus.sample(gyro=(131 * i, 0, 0))
+    assert mpu.read_fifo() == sensor.FIFO_SAMPLES
+    mpu.fifo_sample(sensor.FIFO_SAMPLES - 1, accel, gyro)
+    assert gyro[0] == sensor.FIFO_SAMPLES - 1
+    assert mpu.fifo_overflows == 1
+    assert not bus.fifo
+
+    # Two 50ms loops of samples have to fit
+    assert mpu.enable_fifo(1000, 50) == 333
+    assert mpu.enable_fifo(200, 50) == 200
+
+
+def test_mpu_fifo(monkeypatch):
+    """Test Mpu integrates every sample the FIFO queued with the sample period as dt"""
+    dts = []
+
+    class Mpu(sensor.Mpu):
+        def calibrate(self):
+            pass
+
+        def update(self, dt):
+            dts.append(dt)
+
+    monkeypatch.setattr(sensor.config.Mpu, 'fifo_rate', 500)
+    bus = stand_ins.Mpu6500Bus()
+    mpu = Mpu(i2c=bus)
+    for _ in range(7):
+        bus.sample()
+    mpu.loop()
+    assert dts == [0.002] * 7
+
+
+def test_data_ready(monkeypatch):
+    """Test only fresh samples are read, timed by the interrupt and not by when they are read"""
+    now = [0]
+    monkeypatch.setattr(sensor.utime, 'ticks_us', lambda: now[0])
+    pin = stand_ins.Pin(7)
+    bus = stand_ins.Mpu6500Bus(int_pin=pin)
+    # Bypass to the magnetometer stays on
+    bus.registers[0x37] = 0b10100010
+    mpu = sensor.Mpu6500(bus)
+    assert mpu.enable_data_ready(pin, 500) == 500
+    assert bus.registers[0x37] == 0b00000010
+    assert bus.registers[0x38] == 0x01
+
+    accel = [0.0, 0.0, 0.0]
+    gyro = [9.0, 9.0, 9.0]
+    bus.reset_counters()
+    assert mpu.read_ready(accel, gyro) == 0
+    assert bus.transactions == 0
+    assert gyro == [9.0, 9.0, 9.0]
+
+    # First one has no previous sample, it gets the sample period
+    now[0] = 1000
+    bus.sample(gyro=(131, 0, 0))
+    now[0] = 1700
+    assert mpu.read_ready(accel, gyro) == 2000
+    assert gyro == [1.0, 0.0, 0.0]
+
+    for at in (3010, 5000, 7000):
+        now[0] = at
+        bus.sample(gyro=(262, 0, 0))
+    now[0] = 8000
+    assert mpu.read_ready(accel, gyro) == 7000 - 1000
+    assert mpu.ready_missed == 2
+    assert mpu.read_ready(accel, gyro) == 0
+
+
+def test_mpu_data_ready(monkeypatch):
+    """Test Mpu integrates the new samples only, with dt from the interrupt"""
+    now = [0]
+    monkeypatch.setattr(sensor.utime, 'ticks_us', lambda: now[0])
+    dts = []
+
+    class Mpu(sensor.Mpu):
+        def calibrate(self):
+            pass
+
+        def update(self, dt):
+            dts.append(dt)
+
+    pin = stand_ins.Pin(7)
+    bus = stand_ins.Mpu6500Bus(int_pin=pin)
+    mpu = Mpu(i2c=bus, int_pin=pin)
+    for at in (1000, 2000, 3100):
+        now[0] = at
+        bus.sample()
+        mpu.loop()
+        mpu.loop()
+    assert dts == [0.001, 0.001, 0.0011]
+
+
+class ScriptedBus(stand_ins.Mpu6500Bus):
+    """
+    Mpu6500Bus latching gyro(n) on the n-th burst read
+    """
+
+    def __init__(self, gyro):
+        super().__init__()
+        self.gyro = gyro
+        self.reads = 0
+        struct.pack_into('>h', self.registers, 0x41, 340)
+
+    def read(self, register, size):
+        if register == 0x3B:
+            self.sample(temperature=340, gyro=self.gyro(self.reads))
+            self.reads += 1
+        return super().read(register, size)
+
+
+def calibrated(monkeypatch, tmp_path, gyro):
+    monkeypatch.setattr(sensor.utime, 'sleep_ms', lambda ms: None)
+    monkeypatch.setattr(sensor.Mpu, 'calibration_path', str(tmp_path / 'gyro_bias.json'))
+    bus = ScriptedBus(gyro)
+    mpu = sensor.Mpu(i2c=bus)
+    # In LSB, like the scripted samples
+    return bus, mpu, [x * 131 for x in mpu._Mpu__gyro_calibration]
+
+
+def noise(n):
+    # Deterministic +-1 LSB around a bias of (100, -50, 10) LSB
+    return 100 + n % 3 - 1, -50 + n % 2, 10
+
+
+def test_calibrate(monkeypatch, tmp_path):
+    """Test calibration stops once the bias settles, starts over on motion and is cached"""
+    bus, mpu, bias = calibrated(monkeypatch, tmp_path, noise)
+    assert sensor.Mpu.calibration_min_samples <= bus.reads < sensor.Mpu.calibration_max_samples
+    assert [round(x) for x in bias] == [100, -50, 10]
+    assert abs(bias[1] + 49.5) < 0.1
+
+    def moving(n):
+        # Turned by hand at sample 50
+        return (5000, 0, 0) if n == 50 else noise(n)
+
+    (tmp_path / 'moving').mkdir()
+    bus, mpu, bias = calibrated(monkeypatch, tmp_path / 'moving', moving)
+    assert bus.reads >= 51 + sensor.Mpu.calibration_min_samples
+    assert abs(bias[0] - 100) < 1
+
+    saved = mpu.load_calibration()
+    assert saved is not None
+    assert saved[1] == mpu.temperature()
+
+
+def test_calibrate_cached(monkeypatch, tmp_path):
+    """Test a cached bias is only verified, and replaced when the gyro disagrees with it"""
+    calibrated(monkeypatch, tmp_path, noise)
+    bus, mpu, bias = calibrated(monkeypatch, tmp_path, lambda n: (101, -50, 10))
+    assert bus.reads == sensor.Mpu.verify_samples
+    assert abs(bias[0] - 100) < 1
+
+    bus, mpu, bias = calibrated(monkeypatch, tmp_path, lambda n: (300, -50, 10))
+    assert bus.reads > sensor.Mpu.verify_samples
+    assert round(bias[0]) == 300
+    assert round(mpu.load_calibration()[0][0] * 131) == 300
+
+
+def test_mpu_estimator():
+    """Test Mpu only runs the selected estimator and takes its angles"""
+    calls = []
+
+    class Estimator(attitude.Estimator):
+        has_yaw = True
+
+        def update(self, *args):
+            calls.append(args)
+            self.roll = 1.0
+            self.pitch = 2.0
+            self.yaw = 3.0
+
+    class Mpu(sensor.Mpu):
+        def calibrate(self):
+            pass
+
+    bus = stand_ins.Mpu6500Bus()
+    mpu = Mpu(i2c=bus, estimator=Estimator())
+    bus.sample(accel=(0, 0, 16384), gyro=(131, 0, 0))
+    mpu.loop()
+    assert len(calls) == 1
+    assert calls[0][:6] == (1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+    assert mpu.fused_angles == [1.0, 2.0, 3.0]
+    # Never the live list, even with nothing to flip or invert
+    assert mpu.angles == [1.0, 2.0, 3.0]
+    assert mpu.angles is not mpu.fused_angles
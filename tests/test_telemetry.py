@@ -0,0 +1,80 @@
+from utils import telemetry, helpers
+from utils.network import NetworkEvent
+from client.store import TelemetryStore
+
+
+def test_snapshot():
+    """
+    Test every record available here goes out in a single frame and decodes back
+    """
+    sent = []
+    handler = telemetry.Telemetry(lambda event, data: sent.append((event, bytes(data))))
+    handler.loop()
+
+    assert len(sent) == 1
+    event, data = sent[0]
+    assert event == NetworkEvent.SNAPSHOT
+    assert dict(telemetry.decode_snapshot(data)) == {
+        record: telemetry.format_value(telemetry.TelemetryRecord.read_value(record))
+        for record in telemetry.TelemetryRecord.all()
+        if telemetry.TelemetryRecord.read_value(record) is not None
+    }
+    assert telemetry.TelemetryRecord.VIDEO not in dict(telemetry.decode_snapshot(data))
+
+
+def test_schedule():
+    """
+    Test records are only sent when due and changed past their deadband
+    """
+    angles = [0.0, 0.0, 0.0]
+    handler = telemetry.Telemetry(None)
+    handler.sources = []
+    source = handler.register(telemetry.TelemetryRecord.ROTATION, lambda **kwargs: angles, 1000, deadband=0.5)
+
+    assert telemetry.decode_snapshot(handler.collect()) == [(telemetry.TelemetryRecord.ROTATION, '0.00,0.00,0.00')]
+
+    angles = [0.2, 0.0, 0.0]
+    source.deadline = 0
+    assert len(handler.collect()) == 0
+
+    angles = [0.6, 0.0, 0.0]
+    source.deadline = 0
+    assert telemetry.decode_snapshot(handler.collect()) == [(telemetry.TelemetryRecord.ROTATION, '0.60,0.00,0.00')]
+
+    # Not due yet, not even read
+    source.deadline = helpers.ticks_add(helpers.ticks_ms(), 1000)
+    angles = [10.0, 0.0, 0.0]
+    assert len(handler.collect()) == 0
+    assert source.cost.count == 3
+
+
+def test_throttle_on_overrun():
+    """
+    Test expensive low priority sources are slowed down first
+    """
+    handler = telemetry.Telemetry(None)
+    handler.balance(handler.budget + 1)
+    throttled = [x for x in handler.sources if x.throttle > 1]
+    assert len(throttled) == 1
+    assert throttled[0].priority == telemetry.PRIORITY_LOW
+
+    for _ in range(handler.release_after):
+        handler.balance(0)
+    assert all(x.throttle == 1 for x in handler.sources)
+
+
+def test_store_coalesces():
+    """
+    Test the client store only hands out the latest changed values and counts the rest
+    """
+    store = TelemetryStore()
+    store.put('ROTATION', '1.00')
+    store.put('ROTATION', '2.00')
+    store.put('THROTTLE', '50')
+    assert store.drain() == {'ROTATION': '2.00', 'THROTTLE': '50'}
+    assert store.coalesced == 1
+
+    store.put('THROTTLE', '50')
+    assert store.drain() == {}
+    assert store.saved == 2
+    assert store.received == 4
@@ -0,0 +1,136 @@
+"""
+Adaptive quality of the camera stream
+
+The stream steps down a ladder of (resolution, fps, JPEG quality) as soon as the link shows it can't keep up, and
+back up once it has been well under the latency target for a while. Two signals are watched: bytes sitting unsent
+in front of the socket, which grow the moment the link is slower than the stream, and the acknowledgements the
+client sends back for every frame, which echo the capture timestamp so latency is measured on the server clock
+"""
+import time
+
+# (width, height, fps, JPEG quality), best first
+LEVELS = [
+    (640, 480, 24, 80),
+    (640, 480, 24, 60),
+    (320, 240, 24, 80),
+    (320, 240, 24, 60),
+    (320, 240, 15, 50),
+    (320, 240, 10, 40),
+    (160, 120, 10, 40),
+]
+# What Capture defaults to
+DEFAULT_LEVEL = 2
+
+
+def _now_ms() -> int:
+    return int(time.monotonic() * 1000)
+
+
+class BitrateController:
+    """
+    Picks the level of `capture` (see utils.camera.Capture), call `acknowledge` for every ack and `update`
+    periodically with the send buffer occupancy
+    """
+    # Capture to acknowledged
+    latency_target = 150  # ms
+    # Only step up while latency stays under latency_target * headroom
+    headroom = 0.5
+    # Unsent bytes worth more than this many frames means the link is slower than the stream
+    buffer_frames = 2
+    # No ack for this long counts as over target, the acks are stuck behind the frames
+    ack_timeout = 1000  # ms
+    # Time a change gets before it is judged, and time under target before stepping back up
+    hold = 1000  # ms
+    step_up_after = 5000  # ms
+
+    def __init__(self, capture, levels=LEVELS, level: int = DEFAULT_LEVEL):
+        """
+        :param capture: Its quality when created is the best the controller will ever use
+        """
+        self.capture = capture
+        self.levels = levels
+        self.max_quality = capture.quality
+        self.level = None
+        # Smoothed ack latency, ms
+        self.latency = None
+        self.acked_at = _now_ms()
+        self.changed_at = self.acked_at
+        self._good_since = None
+        self.steps_down = 0
+        self.steps_up = 0
+        self.apply(level)
+
+    def reset(self, now: int = None):
+        """
+        Stream (re)starts, no ack can be expected from before now and the last latency belongs to a past viewer
+        """
+        now = _now_ms() if now is None else now
+        self.acked_at = now
+        self.changed_at = now
+        self.latency = None
+        self._good_since = None
+
+    def apply(self, level: int):
+        width, height, fps, quality = self.levels[level]
+        self.level = level
+        self.capture.width = width
+        self.capture.height = height
+        self.capture.fps = fps
+        if quality is not None and self.max_quality is not None:
+            self.capture.quality = min(quality, self.max_quality)
+
+    def acknowledge(self, sequence: int, timestamp: int):
+        """
+        Client got frame `sequence` captured at `timestamp` (us since the epoch)
+        """
+        latency = (time.time_ns() // 1000 - timestamp) / 1000
+        self.latency = latency if self.latency is None else self.latency + (latency - self.latency) / 4
+        self.acked_at = _now_ms()
+
+    def _step(self, step: int, reason: str, now: int):
+        self.apply(self.level + step)
+        self.changed_at = now
+        self._good_since = None
+        if step > 0:
+            self.steps_down += 1
+        else:
+            self.steps_up += 1
+        capture = self.capture
+        print('VIDEO %s TO %dx%d@%d Q%s: %s' % (
+            'DOWN' if step > 0 else 'UP', capture.width, capture.height, capture.fps, capture.quality, reason,
+        ))
+
+    def update(self, buffered: int, frame_bytes: int, now: int = None) -> bool:
+        """
+        @param buffered: Bytes encoded but not on the wire yet
+        @param frame_bytes: Average size of a frame
+        @return: True when the level changed
+        """
+        now = _now_ms() if now is None else now
+        if now - self.changed_at < self.hold:
+            return False
+
+        reason = None
+        if buffered > self.buffer_frames * max(frame_bytes, 1):
+            reason = 'BUFFER %dB' % buffered
+        elif now - self.acked_at > self.ack_timeout:
+            reason = 'NO ACK FOR %dms' % (now - self.acked_at)
+        elif self.latency is not None and self.latency > self.latency_target:
+            reason = 'LATENCY %dms' % self.latency
+
+        if reason:
+            if self.level < len(self.levels) - 1:
+                self._step(1, reason, now)
+                return True
+            return False
+
+        if self.latency is None or self.latency > self.latency_target * self.headroom or not self.level:
+            self._good_since = None
+            return False
+
+        if self._good_since is None:
+            self._good_since = now
+        if now - self._good_since >= self.step_up_after:
+            self._step(-1, 'LATENCY %dms FOR %dms' % (self.latency, now - self._good_since), now)
+            return True
+        return False
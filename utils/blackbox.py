@@ -0,0 +1,54 @@
+"""
+Blackbox log format, shared between the recorder on the flight controller and whoever reads the logs
+
+File is a header followed by fixed size records, little endian
+
+    | MAGIC 4s | VERSION u8 | RECORD SIZE u16 |
+    | TIMESTAMP us u32 | GYRO xyz 3f | ACCEL xyz 3f | ANGLES rpy 3f | PID rpy (P, I, D) 9f | MOTORS FL FR BR BL 4H |
+"""
+import struct
+
+MAGIC = b'BBOX'
+VERSION = 1
+HEADER_FORMAT = '<4sBH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Record is packed in parts so each part can be written straight from what the controller already has
+SENSOR_FORMAT = '<I3f3f3f'
+PID_FORMAT = '<9f'
+MOTOR_FORMAT = '<4H'
+SENSOR_SIZE = struct.calcsize(SENSOR_FORMAT)
+PID_SIZE = struct.calcsize(PID_FORMAT)
+MOTOR_SIZE = struct.calcsize(MOTOR_FORMAT)
+RECORD_FORMAT = '<I3f3f3f9f4H'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+FIELDS = [
+    'timestamp',
+    'gyro_x', 'gyro_y', 'gyro_z',
+    'accel_x', 'accel_y', 'accel_z',
+    'roll', 'pitch', 'yaw',
+    'roll_p', 'roll_i', 'roll_d',
+    'pitch_p', 'pitch_i', 'pitch_d',
+    'yaw_p', 'yaw_i', 'yaw_d',
+    'motor_fl', 'motor_fr', 'motor_br', 'motor_bl',
+]
+
+
+def encode_header() -> bytes:
+    return struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE)
+
+
+def decode(data):
+    """
+    Decode a whole log
+    @return: list of records as dicts
+    """
+    magic, version, record_size = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+        raise ValueError('Unknown blackbox log')
+
+    records = []
+    for offset in range(HEADER_SIZE, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        records.append(dict(zip(FIELDS, struct.unpack_from(RECORD_FORMAT, data, offset))))
+    return records
@@ -0,0 +1,591 @@
+import asyncio
+import time
+import datetime
+import struct
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy
+from utils.bitrate import BitrateController, LEVELS
+from utils.delta import DeltaDecoder, DeltaEncoder, gather, pack_mask, unpack_mask
+from utils.framebus import FrameBus
+from utils.pipeline import Pipeline
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+BUFFER_SIZE = 2 ** 12
+HOST = '0.0.0.0'
+PORT = 7801
+
+"""
+Video frame layout (little endian), the encoded image follows as is
+
+    | MAGIC u8 | CODEC u8 | CHANNELS u8 | FLAGS u8 | WIDTH u16 | HEIGHT u16 | TIMESTAMP u64 | SEQUENCE u32 | LENGTH u32 |
+
+TIMESTAMP is the capture time in us since the epoch, MAGIC only catches a receiver that lost track of the stream
+
+Delta frames (see utils.delta) carry the tiles that changed since a keyframe instead of the image
+
+    | KEY SEQUENCE u32 | TILE u8 | CHANGED TILES bitmap, row by row | changed tiles stacked in one encoded image |
+"""
+FRAME_MAGIC = 0xA6
+FRAME_HEADER_FORMAT = '<BBBBHHQII'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+# FLAGS, keyframes are only flagged while sending delta frames
+FLAG_KEYFRAME = 1
+FLAG_DELTA = 2
+DELTA_FORMAT = '<IB'
+DELTA_SIZE = struct.calcsize(DELTA_FORMAT)
+# Sent back by the client for every frame: SEQUENCE u32, TIMESTAMP u64 echoed so the server measures on its own clock
+ACK_FORMAT = '<IQ'
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+# Largest encoded frame a receiver accepts: the biggest level uncompressed, plus room for PNG and delta overhead
+MAX_FRAME_SIZE = max([width * height for width, height, _, _ in LEVELS]) * 3 + 64 * 1024
+
+
+class FrameCodec:
+    """
+    How the image of a frame is encoded, a stream of JPEG frames is plain MJPEG
+    """
+    JPEG = 1
+    # Lossless
+    PNG = 2
+
+    EXTENSIONS = {
+        JPEG: '.jpg',
+        PNG: '.png',
+    }
+
+    @classmethod
+    def all(cls):
+        return [
+            cls.JPEG,
+            cls.PNG,
+        ]
+
+
+class FrameHeader:
+    def __init__(self, codec: int, channels: int, width: int, height: int, timestamp: int, sequence: int, length: int,
+                 flags: int = 0):
+        self.codec = codec
+        self.flags = flags
+        self.channels = channels
+        self.width = width
+        self.height = height
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self.length = length
+
+
+def encode_params(codec: int, quality: int = 80, compression: int = 1):
+    """
+    @param quality: JPEG quality 0-100
+    @param compression: PNG compression level 0-9, lossless either way, higher is smaller and slower
+    """
+    if codec == FrameCodec.JPEG:
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    return [cv2.IMWRITE_PNG_COMPRESSION, compression]
+
+
+def encode_image(image, codec: int, params) -> bytes:
+    ok, data = cv2.imencode(FrameCodec.EXTENSIONS[codec], image, params)
+    if not ok:
+        raise ValueError('could not encode frame')
+    return data.tobytes()
+
+
+def pack_header(image, codec: int, sequence: int, timestamp: int, length: int, flags: int = 0) -> bytes:
+    height, width = image.shape[:2]
+    channels = image.shape[2] if image.ndim > 2 else 1
+    if timestamp is None:
+        timestamp = time.time_ns() // 1000
+    return struct.pack(
+        FRAME_HEADER_FORMAT, FRAME_MAGIC, codec, channels, flags, width, height, timestamp, sequence, length,
+    )
+
+
+def encode_frame(image, codec: int, params, sequence: int, timestamp: int = None, flags: int = 0) -> bytes:
+    """
+    Encode image as one video frame, header included
+    """
+    data = encode_image(image, codec, params)
+    return pack_header(image, codec, sequence, timestamp, len(data), flags) + data
+
+
+def encode_delta_frame(image, encoder: DeltaEncoder, codec: int, params, sequence: int, timestamp: int = None) -> bytes:
+    """
+    Encode a grayscale image as a keyframe or as the tiles that changed since the last one, `encoder` decides
+    """
+    padded, key_sequence, mask = encoder.prepare(image, sequence)
+    if mask is None:
+        frame = encode_frame(image, codec, params, sequence, timestamp, FLAG_KEYFRAME)
+    else:
+        payload = struct.pack(DELTA_FORMAT, key_sequence, encoder.tile) + pack_mask(mask)
+        if mask.any():
+            payload += encode_image(gather(padded, mask, encoder.tile), codec, params)
+        frame = pack_header(image, codec, sequence, timestamp, len(payload), FLAG_DELTA) + payload
+    encoder.record(mask is None, len(frame))
+    return frame
+
+
+def decode_header(data) -> FrameHeader:
+    magic, codec, channels, flags, width, height, timestamp, sequence, length = struct.unpack_from(
+        FRAME_HEADER_FORMAT, data,
+    )
+    if magic != FRAME_MAGIC or codec not in FrameCodec.all():
+        raise ValueError('not a video frame')
+    if length > MAX_FRAME_SIZE:
+        raise ValueError('video frame of %d bytes is too large' % length)
+    return FrameHeader(codec, channels, width, height, timestamp, sequence, length, flags)
+
+
+def encode_ack(header: FrameHeader) -> bytes:
+    return struct.pack(ACK_FORMAT, header.sequence, header.timestamp)
+
+
+class AckReader:
+    """
+    Split the stream coming back from a client into acks, `callback(sequence, timestamp)` runs for each
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf += data
+        count = len(self._buf) // ACK_SIZE
+        for i in range(count):
+            self.callback(*struct.unpack_from(ACK_FORMAT, self._buf, i * ACK_SIZE))
+        del self._buf[:count * ACK_SIZE]
+
+
+def unsent_bytes(sock) -> int:
+    """
+    Bytes written to the socket that the kernel has not sent yet, 0 where that can't be asked
+    """
+    if fcntl is None:
+        return 0
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except OSError:
+        return 0
+
+
+def decode_image(data):
+    """
+    Decode the encoded image of a frame, anything exposing the buffer protocol works so no copy is needed
+    """
+    image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError('could not decode frame')
+    return image
+
+
+def decode_delta(header: FrameHeader, data, decoder: DeltaDecoder):
+    """
+    Rebuild the full image of a delta frame
+    @return: image, None when the keyframe it is based on never arrived
+    """
+    key_sequence, tile = struct.unpack_from(DELTA_FORMAT, data)
+    rows = -(-header.height // tile)
+    cols = -(-header.width // tile)
+    mask_end = DELTA_SIZE + -(-rows * cols // 8)
+    if len(data) < mask_end:
+        raise ValueError('delta frame too short')
+
+    mask = unpack_mask(data[DELTA_SIZE:mask_end], rows, cols)
+    mosaic = decode_image(data[mask_end:]) if len(data) > mask_end else None
+    return decoder.apply(key_sequence, tile, mask, mosaic, header.width, header.height)
+
+
+class Capture:
+    """
+    Camera and frame encoding, one encoded message per call to `read`
+    """
+
+    def __init__(self, src=0, fps=24, width=320, height=240, codec: int = FrameCodec.JPEG, quality: int = 80,
+                 delta: bool = False):
+        """
+        :param src: Camera, None when frames come from somewhere else (see BusCapture)
+        :param codec: FrameCodec, JPEG at `quality` or lossless PNG
+        :param delta: Only send the tiles that changed since the last keyframe, see utils.delta
+        """
+        self.width = width
+        self.height = height
+        self.video = cv2.VideoCapture(src) if src is not None else None
+        self.fps = fps
+        self.codec = codec
+        self.quality = quality
+        self.sequence = 0
+        self.delta = DeltaEncoder() if delta else None
+
+    @property
+    def quality(self) -> int:
+        return self._quality
+
+    @quality.setter
+    def quality(self, value: int):
+        self._quality = value
+        self.params = encode_params(self.codec, value)
+
+    def process_frame(self, frame):
+        frame = cv2.resize(frame, [self.width, self.height])
+
+        # Convert to grayscale
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        # Add timestamp
+        return cv2.putText(
+            frame,
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            (10, frame.shape[0] - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.35, (0, 0, 255), 1
+        )
+
+    def grab(self):
+        """
+        @return: (raw frame or None when the camera had nothing, capture timestamp in us)
+        """
+        ok, frame = self.video.read()
+        return (frame if ok else None), time.time_ns() // 1000
+
+    def encode(self, frame, timestamp: int, sequence: int) -> bytes:
+        """
+        Process and encode a grabbed frame, safe to call from several threads at once
+        """
+        image = self.process_frame(frame)
+        if self.delta:
+            return encode_delta_frame(image, self.delta, self.codec, self.params, sequence, timestamp)
+        return encode_frame(image, self.codec, self.params, sequence, timestamp)
+
+    def is_keyframe(self, data) -> bool:
+        """
+        Whether an encoded frame is a keyframe the following delta frames depend on
+        """
+        # FLAGS is the fourth byte of the header
+        return bool(data[3] & FLAG_KEYFRAME)
+
+    def read(self) -> bytes:
+        """
+        Capture and encode one frame, ready to be written to any number of sockets
+        """
+        frame, timestamp = self.grab()
+        self.sequence += 1
+        return self.encode(frame, timestamp, self.sequence)
+
+
+def run_bus_capture(name: str, src=0, fps=24, width=640, height=480, slots: int = 4):
+    """
+    Capture process of a FrameBus, the only one to open the camera, every frame is resized straight into the bus
+    """
+    bus = FrameBus.create(name, width, height, channels=3, slots=slots)
+    video = cv2.VideoCapture(src)
+    interval = 1 / fps
+    deadline = time.monotonic()
+    try:
+        while True:
+            ok, frame = video.read()
+            timestamp = time.time_ns() // 1000
+            if ok:
+                cv2.resize(frame, (width, height), dst=bus.begin())
+                bus.commit(timestamp)
+
+            deadline += interval
+            now = time.monotonic()
+            if now - deadline > interval:
+                deadline = now
+            else:
+                time.sleep(max(0.0, deadline - now))
+    finally:
+        video.release()
+        bus.close()
+
+
+class BusCapture(Capture):
+    """
+    Capture reading the latest frame of a FrameBus (see run_bus_capture) instead of opening the camera itself
+    """
+
+    def __init__(self, bus: FrameBus, fps=24, width=320, height=240, **kwargs):
+        super().__init__(None, fps=fps, width=width, height=height, **kwargs)
+        self.bus = bus
+        self._last = 0
+
+    def grab(self):
+        # Copied since encoding happens later on another thread, by then the slot may be written again
+        item = self.bus.wait(self._last, timeout=1 / self.fps, copy=True)
+        if item is None:
+            return None, time.time_ns() // 1000
+        self._last, timestamp, frame = item
+        return frame, timestamp
+
+
+class Server(Capture):
+    """
+    Camera TX Interface to get and transmit live video feed
+    this is a custom class for easier extensibility and conversion to other languages if needed
+
+    Capture, encode and send are pipelined on their own threads (see utils.pipeline), and quality follows what the
+    link can carry (see utils.bitrate)
+    """
+    report_interval = 10  # seconds
+    adapt_interval = 0.25  # seconds
+
+    def __init__(self, src=0, fps=24, width=320, height=240, host=HOST, port: int = PORT, **kwargs):
+        super().__init__(src, fps=fps, width=width, height=height, **kwargs)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.sock = None
+
+    def loop(self):
+        self.sock.sendall(self.read())
+
+    def run(self):
+        # Runs until the end of the universe (or battery), clients come and go in between
+        while True:
+            self.sock, client_addr = self.server.accept()
+            print(f'CAMERA CONNECTED TO {client_addr}')
+            if self.delta:
+                # Whatever keyframe there was, this client never got it
+                self.delta.force_keyframe()
+            controller = BitrateController(self)
+            pipeline = Pipeline(self, self.sock.sendall)
+            pipeline.start()
+            acks = threading.Thread(target=self._read_acks, args=(AckReader(controller.acknowledge),), daemon=True)
+            acks.start()
+
+            reported_at = time.monotonic()
+            # Runs until sending fails
+            while not pipeline.wait(self.adapt_interval):
+                buffered = unsent_bytes(self.sock) + len(pipeline.encoded) * pipeline.frame_bytes
+                controller.update(buffered, pipeline.frame_bytes)
+                if time.monotonic() - reported_at >= self.report_interval:
+                    reported_at = time.monotonic()
+                    print('CAMERA: %s%s' % (pipeline.report(), ' %s' % self.delta if self.delta else ''))
+            pipeline.stop()
+
+            try:
+                # Wakes the ack thread up
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def _read_acks(self, reader):
+        while True:
+            try:
+                data = self.sock.recv(BUFFER_SIZE)
+            except (OSError, AttributeError):
+                return
+            if not data:
+                return
+            reader.feed(data)
+
+
+class FrameReceiver:
+    """
+    Reassembles frames from a stream straight into reusable buffers, no copies and no allocation per frame
+
+    The socket fills `buffer()` and reports what it read with `advance`: first the fixed header, then a body buffer
+    sized from it, which is only reallocated when a bigger frame comes in
+    """
+
+    def __init__(self, receive_callback, decode: bool = True, acknowledge=None):
+        """
+        :param decode: Hand over the decoded image, otherwise (header, memoryview of the encoded image) which is only
+            valid during the callback
+        :param acknowledge: Called with the header of every frame as soon as it is complete, to send the ack
+        """
+        self.receive_callback = receive_callback
+        self.decode = decode
+        self.acknowledge = acknowledge
+        self.delta = DeltaDecoder()
+        # Delta frames that came without their keyframe
+        self.skipped = 0
+        self._header = bytearray(FRAME_HEADER_SIZE)
+        self._body = bytearray(BUFFER_SIZE)
+        self._target = memoryview(self._header)
+        self._filled = 0
+        # Header of the frame whose body is being received
+        self._frame = None
+        self.frames = 0
+        self.bytes = 0
+
+    def buffer(self) -> memoryview:
+        """
+        Free space to receive into, never empty
+        """
+        return self._target[self._filled:]
+
+    def advance(self, size: int):
+        """
+        `size` bytes were received into `buffer()`, hand over the frame once it is complete
+        @raise ValueError: on anything that is not a frame, the stream can't be trusted after that
+        """
+        self._filled += size
+        self.bytes += size
+        if self._filled < len(self._target):
+            return
+        self._filled = 0
+
+        if self._frame is None:
+            header = decode_header(self._header)
+            if not header.length:
+                raise ValueError('empty video frame')
+            if header.length > len(self._body):
+                self._body = bytearray(header.length)
+            self._frame = header
+            self._target = memoryview(self._body)[:header.length]
+            return
+
+        header = self._frame
+        data = self._target
+        self._frame = None
+        self._target = memoryview(self._header)
+        self.frames += 1
+        if self.acknowledge:
+            self.acknowledge(header)
+        if not self.decode:
+            self.receive_callback((header, data))
+            return
+
+        image = self.decode_frame(header, data)
+        if image is None:
+            self.skipped += 1
+            return
+        self.receive_callback(image)
+
+    def decode_frame(self, header: FrameHeader, data):
+        if header.flags & FLAG_DELTA:
+            return decode_delta(header, data, self.delta)
+        image = decode_image(data)
+        if header.flags & FLAG_KEYFRAME:
+            self.delta.keyframe(image, header.sequence)
+        return image
+
+
+class Client:
+    """
+    Camera RX to receive video feed
+    """
+    def __init__(self, receive_callback, address: str = '127.0.0.1:8000', decode: bool = True):
+        host, port = address.split(':')
+        self.receiver = FrameReceiver(receive_callback, decode=decode, acknowledge=self.acknowledge)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((host, int(port)))
+
+    def acknowledge(self, header):
+        self.sock.sendall(encode_ack(header))
+
+    def loop(self) -> bool:
+        """
+        Receive whatever is available, frames completed by it are handed over right away
+        @return: False once the server went away
+        """
+        size = self.sock.recv_into(self.receiver.buffer())
+        if not size:
+            return False
+        self.receiver.advance(size)
+        return True
+
+    def run(self):
+        try:
+            while self.loop():
+                pass
+            print('CAMERA CONNECTION CLOSED')
+        except (OSError, ValueError) as e:
+            print('CAMERA CONNECTION BROKEN: %s' % e)
+        finally:
+            self.sock.close()
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    asyncio side of FrameReceiver, the transport receives straight into its buffers
+
+    Images are decoded on a worker thread so the event loop (control link included) never waits on a decode,
+    one at a time and in order since delta frames need their keyframe first
+    """
+    # Delta frames received while this many wait for the worker are dropped, keyframes never are
+    max_pending = 2
+
+    def __init__(self, receive_callback, decode: bool = True):
+        self.receive_callback = receive_callback
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1) if decode else None
+        self.receiver = FrameReceiver(
+            self.decode_later if decode else receive_callback, decode=False, acknowledge=self.acknowledge,
+        )
+        # Frames handed to the worker and not decoded yet
+        self.pending = 0
+        self.transport = None
+        self.closed = self.loop.create_future()
+
+    def decode_later(self, frame):
+        header, data = frame
+        if self.pending >= self.max_pending and not header.flags & FLAG_KEYFRAME:
+            self.receiver.skipped += 1
+            return
+        self.pending += 1
+        # The receive buffer is reused for the next frame, the worker gets its own copy
+        future = self.loop.run_in_executor(self.executor, self.receiver.decode_frame, header, bytes(data))
+        future.add_done_callback(self.decoded)
+
+    def decoded(self, future):
+        self.pending -= 1
+        if future.cancelled():
+            return
+        try:
+            image = future.result()
+        except ValueError as e:
+            print('CAMERA FRAME BROKEN: %s' % e)
+            return
+        if image is None:
+            self.receiver.skipped += 1
+            return
+        self.receive_callback(image)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def acknowledge(self, header):
+        self.transport.write(encode_ack(header))
+
+    def get_buffer(self, sizehint):
+        return self.receiver.buffer()
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.receiver.advance(nbytes)
+        except ValueError as e:
+            print('CAMERA STREAM BROKEN: %s' % e)
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+async def receive(host: str, receive_callback, port: int = PORT, decode: bool = True):
+    """
+    Asyncio version of `Client`, reads frames until the server goes away or the task is cancelled
+    """
+    protocol = FrameProtocol(receive_callback, decode=decode)
+    transport, _ = await asyncio.get_running_loop().create_connection(lambda: protocol, host, port)
+    try:
+        await protocol.closed
+        print('CAMERA CONNECTION CLOSED')
+    finally:
+        transport.close()
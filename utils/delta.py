@@ -0,0 +1,178 @@
+"""
+Tile based delta frames for the grayscale camera feed
+
+Frames are cut in square tiles and compared with the last keyframe, a delta frame only carries the tiles that
+changed. Comparing with the keyframe (and not the previous frame) means a lost delta frame costs nothing, the next
+one is complete again, and the client rebuilds any frame from the keyframe alone. Keyframes go out periodically,
+when most of the picture changed, and whenever someone asks for one (e.g. a new viewer)
+"""
+import threading
+import numpy
+
+TILE = 16
+# Mean absolute difference of gray levels past which a tile counts as changed
+THRESHOLD = 4
+
+
+def pad(frame, tile: int):
+    """
+    Grow frame to whole tiles by repeating its edges
+    """
+    height, width = frame.shape
+    rows = -(-height // tile)
+    cols = -(-width // tile)
+    if rows * tile == height and cols * tile == width:
+        return frame
+    return numpy.pad(frame, ((0, rows * tile - height), (0, cols * tile - width)), mode='edge')
+
+
+def tiles(frame, tile: int):
+    """
+    View of a padded frame as (rows, cols, tile, tile), writes go to the frame
+    """
+    height, width = frame.shape
+    return frame.reshape(height // tile, tile, width // tile, tile).swapaxes(1, 2)
+
+
+def changed_tiles(frame, reference, tile: int, threshold: float = THRESHOLD):
+    """
+    @return: (rows, cols) bool mask of the tiles of frame that differ from reference
+    """
+    diff = numpy.abs(frame.astype(numpy.int16) - reference.astype(numpy.int16))
+    return tiles(diff, tile).mean(axis=(2, 3)) > threshold
+
+
+def gather(frame, mask, tile: int):
+    """
+    Changed tiles stacked in one (count * tile, tile) image, ready to encode like any frame
+    """
+    return tiles(frame, tile)[mask].reshape(-1, tile)
+
+
+def scatter(frame, mask, mosaic, tile: int):
+    """
+    Put the tiles of a mosaic back in place, in frame
+    """
+    tiles(frame, tile)[mask] = mosaic.reshape(-1, tile, tile)
+
+
+def pack_mask(mask) -> bytes:
+    return numpy.packbits(mask.ravel()).tobytes()
+
+
+def unpack_mask(data, rows: int, cols: int):
+    return numpy.unpackbits(numpy.frombuffer(data, numpy.uint8), count=rows * cols).astype(bool).reshape(rows, cols)
+
+
+class DeltaEncoder:
+    """
+    Decides keyframe or delta for every frame and keeps the reference, safe to use from several encoder threads
+    """
+
+    def __init__(self, tile: int = TILE, threshold: float = THRESHOLD, keyframe_interval: int = 48,
+                 max_changed: float = 0.5):
+        """
+        :param keyframe_interval: Frames between keyframes, bounds how long a lost keyframe blanks the picture
+        :param max_changed: Send a keyframe when more than this fraction of the tiles changed
+        """
+        self.tile = tile
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.max_changed = max_changed
+        self._lock = threading.Lock()
+        self._reference = None
+        self._key_sequence = 0
+        self._force = False
+
+        self.keyframes = 0
+        self.deltas = 0
+        self.key_bytes = 0
+        self.delta_bytes = 0
+        self.tiles_sent = 0
+        self.tiles_total = 0
+
+    def force_keyframe(self):
+        self._force = True
+
+    def prepare(self, frame, sequence: int):
+        """
+        @return: (padded frame, sequence of the keyframe it is relative to, changed tiles mask or None on keyframe)
+        """
+        padded = pad(frame, self.tile)
+        with self._lock:
+            reference = self._reference
+            key_sequence = self._key_sequence
+            keyframe = (
+                self._force or reference is None or reference.shape != padded.shape
+                or sequence - key_sequence >= self.keyframe_interval or sequence < key_sequence
+            )
+            mask = None
+            if not keyframe:
+                mask = changed_tiles(padded, reference, self.tile, self.threshold)
+                keyframe = mask.mean() > self.max_changed
+
+            if keyframe:
+                self._force = False
+                self._reference = padded
+                self._key_sequence = sequence
+                return padded, sequence, None
+
+        self.tiles_sent += int(mask.sum())
+        self.tiles_total += mask.size
+        return padded, key_sequence, mask
+
+    def record(self, keyframe: bool, size: int):
+        if keyframe:
+            self.keyframes += 1
+            self.key_bytes += size
+        else:
+            self.deltas += 1
+            self.delta_bytes += size
+
+    @property
+    def ratio(self) -> float:
+        """
+        Bytes every frame would have taken as a keyframe over bytes actually sent
+        """
+        frames = self.keyframes + self.deltas
+        if not self.keyframes or not frames:
+            return 1.0
+        return self.key_bytes / self.keyframes * frames / (self.key_bytes + self.delta_bytes)
+
+    def __str__(self):
+        changed = self.tiles_sent / self.tiles_total * 100 if self.tiles_total else 0
+        return 'x%.1f %d%% tiles' % (self.ratio, changed)
+
+
+class DeltaDecoder:
+    """
+    Keeps the last keyframe and rebuilds full frames from delta frames
+    """
+
+    def __init__(self):
+        self._key = None
+        self._key_sequence = None
+        # Keyframe padded to the tile size of the delta frames, only done once per keyframe
+        self._padded = None
+
+    def keyframe(self, image, sequence: int):
+        self._key = image
+        self._key_sequence = sequence
+        self._padded = None
+
+    def apply(self, key_sequence: int, tile: int, mask, mosaic, width: int, height: int):
+        """
+        @return: full frame, None when the keyframe it needs never arrived
+        """
+        if self._key is None or key_sequence != self._key_sequence:
+            return None
+        rows, cols = mask.shape
+        if self._padded is None or self._padded.shape != (rows * tile, cols * tile):
+            self._padded = pad(self._key, tile)
+            if self._padded.shape != (rows * tile, cols * tile):
+                return None
+
+        frame = self._padded.copy()
+        if mosaic is not None:
+            scatter(frame, mask, mosaic, tile)
+        return frame[:height, :width]
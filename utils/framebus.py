@@ -0,0 +1,197 @@
+"""
+Shared memory frame bus
+
+One capture process writes camera frames into a ring of slots in shared memory, any number of other processes
+attach to it by name and use the latest frame in place, nothing is pickled or copied on the way. Every slot has a
+sequence counter that is odd while the slot is being written (a seqlock), a reader checks it again once done with a
+frame to know it was not overwritten in the meantime
+
+    | MAGIC u32 | WIDTH u16 | HEIGHT u16 | CHANNELS u8 | SLOTS u8 | RESERVED u16 | LATEST SEQUENCE u64 | ...
+    | SLOT SEQUENCE u64 | SLOT TIMESTAMP u64 | x SLOTS ...
+    | FRAME (HEIGHT x WIDTH x CHANNELS u8) | x SLOTS
+
+Header and slot table are padded to 64 bytes so every frame starts on a cache line
+"""
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+import numpy
+
+MAGIC = 0x53554246
+HEADER_FORMAT = '<IHHBBH'
+LATEST_OFFSET = struct.calcsize(HEADER_FORMAT)
+HEADER_SIZE = 64
+ALIGN = 64
+
+
+def _align(size: int) -> int:
+    return -(-size // ALIGN) * ALIGN
+
+
+def bus_size(width: int, height: int, channels: int, slots: int) -> int:
+    return HEADER_SIZE + _align(slots * 16) + slots * width * height * channels
+
+
+def _open(name: str):
+    """
+    Map an existing segment without handing it to the resource tracker, which would unlink it when the reader exits
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13 attaching registers it as well. Taking it back out also drops the registration of the
+        # writer when both share a tracker (forked from one process), see close
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class FrameBus:
+    """
+    Ring of frame slots in shared memory, written by one process and read by any number of them
+    """
+    # How often `wait` looks for a new frame, there is no cross process notification that can be attached by name
+    poll_interval = 0.001  # seconds
+
+    def __init__(self, shm, owner: bool = False):
+        self.shm = shm
+        self.owner = owner
+        magic, self.width, self.height, self.channels, self.slots, _ = struct.unpack_from(HEADER_FORMAT, shm.buf)
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame bus' % shm.name)
+
+        buf = shm.buf
+        self._latest = numpy.ndarray((1,), numpy.uint64, buffer=buf, offset=LATEST_OFFSET)
+        # (sequence, timestamp) of every slot
+        self._table = numpy.ndarray((self.slots, 2), numpy.uint64, buffer=buf, offset=HEADER_SIZE)
+        self.frames = numpy.ndarray(
+            (self.slots, self.height, self.width, self.channels), numpy.uint8,
+            buffer=buf, offset=HEADER_SIZE + _align(self.slots * 16),
+        )
+        self._writing = None
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @classmethod
+    def create(cls, name: str, width: int, height: int, channels: int = 3, slots: int = 4):
+        """
+        Create the bus, done once by the writer which also unlinks it in the end
+        """
+        shm = shared_memory.SharedMemory(name=name, create=True, size=bus_size(width, height, channels, slots))
+        shm.buf[:HEADER_SIZE + _align(slots * 16)] = bytes(HEADER_SIZE + _align(slots * 16))
+        struct.pack_into(HEADER_FORMAT, shm.buf, 0, MAGIC, width, height, channels, slots, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str, timeout: float = 0):
+        """
+        Map a bus created by another process, waiting up to `timeout` seconds for it to show up
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return cls(_open(name))
+            except FileNotFoundError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    @property
+    def latest(self) -> int:
+        """
+        Sequence of the last complete frame, 0 before the first one
+        """
+        return int(self._latest[0])
+
+    def begin(self):
+        """
+        Start writing the next frame
+        @return: the slot to write it in, e.g. as the `dst` of cv2.resize
+        """
+        sequence = self.latest + 1
+        slot = sequence % self.slots
+        # Odd while being written
+        self._table[slot, 0] = 2 * sequence - 1
+        self._writing = sequence
+        return self.frames[slot]
+
+    def commit(self, timestamp: int = 0) -> int:
+        """
+        Publish the frame written since `begin`
+        @param timestamp: Capture time, passed as is to readers
+        @return: its sequence
+        """
+        sequence = self._writing
+        slot = sequence % self.slots
+        self._table[slot, 1] = timestamp
+        self._table[slot, 0] = 2 * sequence
+        self._latest[0] = sequence
+        self._writing = None
+        return sequence
+
+    def write(self, frame, timestamp: int = 0) -> int:
+        numpy.copyto(self.begin(), frame)
+        return self.commit(timestamp)
+
+    def read(self, after: int = 0):
+        """
+        Latest frame, in place
+
+        @param after: Sequence of the last frame seen, only newer frames are returned
+        @return: (sequence, timestamp, frame) or None when there is nothing newer, the frame is only valid as long as
+            `valid(sequence)` says so
+        """
+        sequence = self.latest
+        if sequence <= after:
+            return None
+
+        slot = sequence % self.slots
+        timestamp = int(self._table[slot, 1])
+        if int(self._table[slot, 0]) != 2 * sequence:
+            # Lapped by the writer already, the next call gets a newer one
+            return None
+        return sequence, timestamp, self.frames[slot]
+
+    def valid(self, sequence: int) -> bool:
+        """
+        Frame `sequence` was not overwritten (yet)
+        """
+        return int(self._table[sequence % self.slots, 0]) == 2 * sequence
+
+    def copy(self, after: int = 0):
+        """
+        Same as read but with a copy of the frame, for holding on to it
+        """
+        item = self.read(after)
+        if item is None:
+            return None
+        sequence, timestamp, frame = item
+        frame = frame.copy()
+        if not self.valid(sequence):
+            return None
+        return sequence, timestamp, frame
+
+    def wait(self, after: int = 0, timeout: float = None, copy: bool = False):
+        """
+        Block until there is a frame newer than `after`
+        @return: same as read, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = self.copy(after) if copy else self.read(after)
+            if item is not None:
+                return item
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        # Views into the buffer must go before it can be released
+        self._latest = self._table = self.frames = None
+        self.shm.close()
+        if self.owner:
+            # A reader sharing our resource tracker may have unregistered it, unlink expects it registered
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
@@ -1,4 +1,23 @@
 import math
+import time
+
+try:
+    # Micropython has wrapping tick counters built in
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:
+    def ticks_ms() -> int:
+        return int(time.monotonic() * 1000)
+
+    def ticks_us() -> int:
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(new, old) -> int:
+        return new - old
+
+    def ticks_add(ticks, delta) -> int:
+        return ticks + delta
+
+SEQUENCE_MASK = 0xFFFFFFFF
 
 
 def rotate_on_z(vector, angle) -> list:
@@ -34,18 +53,34 @@ def clamp(value, minn, maxn):
 
 
 def decode_control(data):
-    # Data should always have 4 keys
+    # Data should always have 4 keys, text controls are never sequenced
     throttle, roll, pitch, yaw = data.split('/')
-    return float(throttle), int(roll), int(pitch), int(yaw)
+    return float(throttle), int(roll), int(pitch), int(yaw), 0, 0
 
 
-def encode_control(throttle, roll, pitch, yaw):
+def encode_control(throttle, roll, pitch, yaw, *args):
     return '%d/%d/%d/%d' % (throttle, roll, pitch, yaw)
 
 
+def next_sequence(sequence: int) -> int:
+    """
+    Increment a wrapping sequence number, 0 is reserved for unsequenced messages
+    """
+    return (sequence + 1) & SEQUENCE_MASK or 1
+
+
+def sequence_newer(sequence: int, last: int) -> bool:
+    """
+    Check if `sequence` comes after `last`, accounting for wrap around
+    """
+    if not last:
+        return True
+    return 0 < ((sequence - last) & SEQUENCE_MASK) < 0x80000000
+
+
 def decode_telemetry_record(data):
-    # Data should always have 2 keys
-    name, data = data.split('/')
+    # Names never have a `/`, values can (e.g. LOOP_TIME avg/max/last)
+    name, data = data.split('/', 1)
     return name, data
 
 
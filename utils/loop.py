@@ -0,0 +1,95 @@
+"""
+Cooperative single threaded event loop, everything that is not the flight control loop
+shares one thread and runs on deadlines instead of sleeping
+"""
+from utils import helpers
+
+
+class LoopStats:
+    """
+    Rolling statistics of a duration in microseconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last_us = 0
+        self.max_us = 0
+        self.avg_us = 0.0
+
+    def add(self, us: int):
+        self.count += 1
+        self.last_us = us
+        self.max_us = max(self.max_us, us)
+        # Moving average, 1/16 weight for the new sample. Float, integer steps would never move for costs under 16us
+        self.avg_us += (us - self.avg_us) / 16
+
+    def reset(self):
+        self.max_us = 0
+
+    def __str__(self):
+        return '%.1f/%d/%dus' % (self.avg_us, self.max_us, self.last_us)
+
+
+class Task:
+    def __init__(self, func, interval_ms: int, deadline: int):
+        self.func = func
+        self.interval_ms = interval_ms
+        self.deadline = deadline
+
+
+class EventLoop:
+    """
+    Runs `poll(timeout_ms)` until the next task is due, then runs all due tasks.
+    `poll` should block on sockets for at most timeout_ms, handle whatever is ready and return the us it spent
+    waiting (None counts as all of it).
+    """
+
+    def __init__(self, poll, max_timeout: int = 100):
+        self.poll = poll
+        self.max_timeout = max_timeout
+        self.tasks = []
+        # Time spent working per iteration (handlers in poll and tasks, not the wait for sockets) and how late tasks
+        # ran compared to their deadline
+        self.stats = LoopStats()
+        self.lateness = LoopStats()
+
+    def every(self, interval_ms: int, func) -> Task:
+        """
+        Run func every interval_ms, first run is right away
+        """
+        task = Task(func, interval_ms, helpers.ticks_ms())
+        self.tasks.append(task)
+        return task
+
+    def timeout(self, now: int) -> int:
+        timeout = self.max_timeout
+        for task in self.tasks:
+            timeout = min(timeout, helpers.ticks_diff(task.deadline, now))
+        return max(timeout, 0)
+
+    def loop(self):
+        started = helpers.ticks_us()
+        waited = self.poll(self.timeout(helpers.ticks_ms()))
+        if waited is None:
+            # Can't tell waiting from work, only tasks count
+            started = helpers.ticks_us()
+            waited = 0
+
+        now = helpers.ticks_ms()
+        for task in self.tasks:
+            late = helpers.ticks_diff(now, task.deadline)
+            if late < 0:
+                continue
+
+            self.lateness.add(late * 1000)
+            task.func()
+            task.deadline = helpers.ticks_add(task.deadline, task.interval_ms)
+            if helpers.ticks_diff(now, task.deadline) >= 0:
+                # Fell more than a whole interval behind, don't try to catch up
+                task.deadline = helpers.ticks_add(now, task.interval_ms)
+
+        self.stats.add(helpers.ticks_diff(helpers.ticks_us(), started) - waited)
+
+    def run(self):
+        while True:
+            self.loop()
@@ -1,4 +1,11 @@
-import random
+import os
+import struct
+from utils import helpers
+
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
 
 
 HOST = "0.0.0.0"
@@ -7,6 +14,37 @@ PORT = 7777
 SEP_CHAR = '##'
 EMPTY_CHAR = '__'
 END_CHAR = '$$'
+END_BYTES = END_CHAR.encode('ascii')
+
+"""
+Binary frame layout (little endian)
+
+    | MAGIC u8 | VERSION u8 | EVENT u8 | LENGTH u16 | PAYLOAD ... | CHECKSUM u16 |
+
+MAGIC is never a valid ascii character so text and binary frames can share the same stream,
+CHECKSUM is a fletcher-16 over header and payload
+"""
+FRAME_MAGIC = 0xA5
+MAGIC_BYTES = bytes([FRAME_MAGIC])
+PROTOCOL_VERSION = 2
+HEADER_FORMAT = '<BBBH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHECKSUM_FORMAT = '<H'
+CHECKSUM_SIZE = struct.calcsize(CHECKSUM_FORMAT)
+MAX_PAYLOAD = 512
+MAX_FRAME = HEADER_SIZE + MAX_PAYLOAD + CHECKSUM_SIZE
+# BLACKBOX chunks are hex on the text codec, split to this size so a frame still fits the receive buffer
+TEXT_CHUNK = 256
+
+# THROTTLE, ROLL, PITCH, YAW, SEQUENCE, SENDER TIMESTAMP (ms)
+CONTROL_FORMAT = '<fhhhII'
+CONTROL_SIZE = struct.calcsize(CONTROL_FORMAT)
+# PING ID, CLIENT TIMESTAMP (us), then what the client measured so far: RTT (us), JITTER (us), LOSS (per mille)
+PING_FORMAT = '<IIIIH'
+PING_SIZE = struct.calcsize(PING_FORMAT)
+# PING ID, CLIENT TIMESTAMP (us) echoed, SERVER TIMESTAMP (ms) on receive, TIME HELD BY SERVER (us)
+PONG_FORMAT = '<IIII'
+PONG_SIZE = struct.calcsize(PONG_FORMAT)
 
 
 class NetworkEvent:
@@ -14,6 +52,38 @@ class NetworkEvent:
     CONTROL = 'CONTROL'
     STOP = 'STOP'
     TELEMETRY = 'TELEMETRY'
+    # Every telemetry record of a cycle in one frame, see utils.telemetry for the payload
+    SNAPSHOT = 'SNAPSHOT'
+    # Request for the flight log from client, chunks of the log from server, an empty chunk ends it
+    BLACKBOX = 'BLACKBOX'
+    # Resume request (token) from client, session granted (token/resumed/last sequence) from server
+    SESSION = 'SESSION'
+    # Telemetry records the client wants, comma separated, empty for all of them
+    SUBSCRIBE = 'SUBSCRIBE'
+    # Link measurement, PING from client is answered right away by a PONG from server
+    PING = 'PING'
+    PONG = 'PONG'
+
+    # Event ids on the binary codec, never reuse an id
+    CODES = {
+        CONNECTED: 1,
+        CONTROL: 2,
+        STOP: 3,
+        TELEMETRY: 4,
+        SNAPSHOT: 5,
+        BLACKBOX: 6,
+        SESSION: 7,
+        SUBSCRIBE: 8,
+        PING: 9,
+        PONG: 10,
+    }
+    NAMES = {code: name for name, code in CODES.items()}
+    # Payload is raw bytes, SNAPSHOT only exists on the binary codec and BLACKBOX is hex on the text codec
+    RAW = (SNAPSHOT, BLACKBOX)
+    # Payload is ascii as is
+    ASCII = (CONNECTED, SESSION, SUBSCRIBE)
+    # Payload is a tuple of integers, `/` separated on the text codec
+    STRUCTS = {PING: (PING_FORMAT, PING_SIZE), PONG: (PONG_FORMAT, PONG_SIZE)}
 
     @property
     def all(self):
@@ -22,43 +92,406 @@ class NetworkEvent:
             self.CONTROL,
             self.STOP,
             self.TELEMETRY,
+            self.SNAPSHOT,
+            self.BLACKBOX,
+            self.SESSION,
+            self.SUBSCRIBE,
+            self.PING,
+            self.PONG,
+        ]
+
+
+class Codec:
+    """
+    Codecs a connection can send with, the receiving side always understands both
+    """
+    TEXT = 'TEXT'
+    BINARY = 'BIN%d' % PROTOCOL_VERSION
+
+    @classmethod
+    def all(cls):
+        return [
+            cls.TEXT,
+            cls.BINARY,
         ]
 
 
+def checksum(buf, start, end) -> int:
+    """
+    Fletcher-16 checksum of buf[start:end]
+    """
+    a = 0
+    b = 0
+    for i in range(start, end):
+        a = (a + buf[i]) % 255
+        b = (b + a) % 255
+    return (b << 8) | a
+
+
+def encode_text(event, data=EMPTY_CHAR) -> bytes:
+    """
+    Encode event using the legacy `EVENT##DATA$$` format
+    """
+    if event == NetworkEvent.CONTROL:
+        data = helpers.encode_control(*data)
+    elif event == NetworkEvent.TELEMETRY:
+        data = helpers.encode_telemetry_record(*data)
+    elif event in NetworkEvent.STRUCTS:
+        data = '/'.join([str(x) for x in data])
+    elif event == NetworkEvent.BLACKBOX:
+        data = str(binascii.hexlify(data), 'ascii') if len(data) and data != EMPTY_CHAR else EMPTY_CHAR
+    return ('%s%s%s%s' % (event, SEP_CHAR, data, END_CHAR)).encode('ascii')
+
+
+def encode_binary(buf, event, data=EMPTY_CHAR) -> int:
+    """
+    Encode event as a binary frame into `buf`
+    @return: frame length
+    """
+    offset = HEADER_SIZE
+    if event == NetworkEvent.CONTROL:
+        struct.pack_into(CONTROL_FORMAT, buf, offset, *data)
+        offset += CONTROL_SIZE
+    elif event == NetworkEvent.TELEMETRY:
+        name, value = data
+        name = name.encode('ascii')
+        value = str(value).encode('ascii')
+        # Checked before writing, slice assignment past the end would grow buf
+        if 1 + len(name) + len(value) > MAX_PAYLOAD:
+            raise ValueError('payload of %d bytes is too large' % (1 + len(name) + len(value)))
+        buf[offset] = len(name)
+        offset += 1
+        buf[offset:offset + len(name)] = name
+        offset += len(name)
+        buf[offset:offset + len(value)] = value
+        offset += len(value)
+    elif event in NetworkEvent.STRUCTS:
+        fmt, size = NetworkEvent.STRUCTS[event]
+        struct.pack_into(fmt, buf, offset, *data)
+        offset += size
+    elif event in NetworkEvent.RAW:
+        if data == EMPTY_CHAR:
+            data = b''
+        if len(data) > MAX_PAYLOAD:
+            raise ValueError('payload of %d bytes is too large' % len(data))
+        buf[offset:offset + len(data)] = data
+        offset += len(data)
+    elif event in NetworkEvent.ASCII and data != EMPTY_CHAR:
+        data = data.encode('ascii')
+        if len(data) > MAX_PAYLOAD:
+            raise ValueError('payload of %d bytes is too large' % len(data))
+        buf[offset:offset + len(data)] = data
+        offset += len(data)
+
+    length = offset - HEADER_SIZE
+    if length > MAX_PAYLOAD:
+        raise ValueError('payload of %d bytes is too large' % length)
+
+    struct.pack_into(HEADER_FORMAT, buf, 0, FRAME_MAGIC, PROTOCOL_VERSION, NetworkEvent.CODES[event], length)
+    struct.pack_into(CHECKSUM_FORMAT, buf, offset, checksum(buf, 0, offset))
+    return offset + CHECKSUM_SIZE
+
+
+def decode_binary_payload(code, buf, mv, start, length):
+    """
+    Decode payload of a binary frame, reads straight from the receive buffer
+    @raise ValueError: when the payload doesn't have the size or encoding of its event
+    """
+    event = NetworkEvent.NAMES[code]
+    if event == NetworkEvent.CONTROL:
+        if length != CONTROL_SIZE:
+            raise ValueError('%s payload of %d bytes' % (event, length))
+        return event, struct.unpack_from(CONTROL_FORMAT, buf, start)
+    elif event == NetworkEvent.TELEMETRY:
+        if not length or 1 + buf[start] > length:
+            raise ValueError('%s payload of %d bytes' % (event, length))
+        name_end = start + 1 + buf[start]
+        return event, (str(mv[start + 1:name_end], 'ascii'), str(mv[name_end:start + length], 'ascii'))
+    elif event in NetworkEvent.STRUCTS:
+        fmt, size = NetworkEvent.STRUCTS[event]
+        if length != size:
+            raise ValueError('%s payload of %d bytes' % (event, length))
+        return event, struct.unpack_from(fmt, buf, start)
+    elif event in NetworkEvent.RAW:
+        # Receive buffer gets reused, these are usually handed over to another thread
+        return event, bytes(mv[start:start + length])
+    elif event in NetworkEvent.ASCII and length:
+        return event, str(mv[start:start + length], 'ascii')
+    return event, EMPTY_CHAR
+
+
+def decode_text_data(event, data):
+    if event == NetworkEvent.CONTROL:
+        return helpers.decode_control(data)
+    elif event == NetworkEvent.TELEMETRY:
+        return helpers.decode_telemetry_record(data)
+    elif event in NetworkEvent.STRUCTS:
+        return tuple([int(x) for x in data.split('/')])
+    elif event == NetworkEvent.BLACKBOX:
+        return b'' if data == EMPTY_CHAR else binascii.unhexlify(data)
+    return data
+
+
+def decode_frame(buf, mv, start, end):
+    """
+    Decode first frame found in buf[start:end], text or binary
+
+    @return: (consumed bytes, event, data), consumed is 0 when the frame is incomplete
+        and event is None when the bytes were skipped
+    """
+    if buf[start] == FRAME_MAGIC:
+        if end - start < HEADER_SIZE:
+            return 0, None, None
+
+        _, version, code, length = struct.unpack_from(HEADER_FORMAT, buf, start)
+        if version != PROTOCOL_VERSION or length > MAX_PAYLOAD or code not in NetworkEvent.NAMES:
+            # Not a frame we understand, skip the magic byte and resync on the next one
+            return 1, None, None
+
+        size = HEADER_SIZE + length + CHECKSUM_SIZE
+        if end - start < size:
+            return 0, None, None
+
+        payload_end = start + HEADER_SIZE + length
+        if struct.unpack_from(CHECKSUM_FORMAT, buf, payload_end)[0] != checksum(buf, start, payload_end):
+            print('ERROR ON FRAME: BAD CHECKSUM')
+            return 1, None, None
+
+        try:
+            event, data = decode_binary_payload(code, buf, mv, start + HEADER_SIZE, length)
+        except ValueError as e:
+            # Checksum was fine so the frame boundaries are too, only this frame is dropped
+            print('ERROR ON FRAME: %s' % e)
+            return size, None, None
+        return size, event, data
+
+    index = buf.find(END_BYTES, start, end)
+    magic = buf.find(MAGIC_BYTES, start, end if index == -1 else index)
+    if magic != -1:
+        # Leftovers of a broken frame, drop everything up to the next binary frame
+        return magic - start, None, None
+
+    if index == -1:
+        return 0, None, None
+
+    size = index - start + len(END_BYTES)
+    if index == start:
+        return size, None, None
+
+    try:
+        message = str(mv[start:index], 'ascii')
+        event, data = message.split(SEP_CHAR)
+        data = decode_text_data(event, data)
+    except ValueError:
+        # Drop the malformed frame only, the stream is still in sync on END_CHAR
+        print('ERROR ON MESSAGE: %s' % bytes(mv[start:index]))
+        return size, None, None
+
+    return size, event, data
+
+
+def decode_frames(buf, mv, start, end, callback) -> int:
+    """
+    Run callback for every complete frame in buf[start:end]
+    @return: index of the first byte not consumed
+    """
+    # This loop will handle if the socket sent multiple messages at once
+    while start < end:
+        size, event, data = decode_frame(buf, mv, start, end)
+        if not size:
+            break
+
+        start += size
+        if event is not None:
+            callback(event, data)
+
+    return start
+
+
+class Session:
+    """
+    What a client and server agreed on, outlives the connection so a client that drops can pick up where it left off
+    """
+
+    def __init__(self, token: str = None):
+        self.token = token
+        self.codec = Codec.TEXT
+        # Last CONTROL sequence, sent by client or applied by server
+        self.sequence = 0
+        # Telemetry records to send, None for all of them
+        self.subscriptions = None
+        # When the connection dropped, in ticks_ms
+        self.parked_at = None
+
+
+def new_token() -> str:
+    return ''.join(['%02x' % x for x in os.urandom(6)])
+
+
+def encode_session(token: str, resumed: bool, sequence: int) -> str:
+    return '%s/%d/%d' % (token, resumed, sequence)
+
+
+def decode_session(data: str):
+    """
+    @return: (token, resumed, last sequence)
+    """
+    token, resumed, sequence = data.split('/')
+    return token, resumed == '1', int(sequence)
+
+
+def encode_subscriptions(records) -> str:
+    return ','.join(records) if records else EMPTY_CHAR
+
+
+def decode_subscriptions(data: str):
+    if not data or data == EMPTY_CHAR:
+        return None
+    return set(data.split(','))
+
+
+def make_pong(ping, received_ms: int, received_us: int):
+    """
+    Answer to `ping`, received at `received_ms`/`received_us` ticks, call it right before sending so the hold time
+    covers everything between receive and send
+    """
+    return ping[0], ping[1], received_ms & helpers.SEQUENCE_MASK, helpers.ticks_diff(helpers.ticks_us(), received_us)
+
+
+class FrameReader:
+    """
+    Reassemble frames from a stream into a fixed receive buffer
+
+    Sockets read straight into the free space after the last partial frame, complete frames are decoded in place
+    and the partial frame left over is moved back to the start of the buffer, so nothing is allocated per read
+    """
+
+    def __init__(self, size: int = 2 * MAX_FRAME):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def recv_into(self, sock):
+        """
+        Read whatever is available on socket into the buffer
+        @return: number of bytes read, 0 on closed socket and None when nothing is available on a non blocking socket
+        """
+        if hasattr(sock, 'recv_into'):
+            size = sock.recv_into(self.mv[self.end:])
+        else:
+            # Micropython sockets only have readinto
+            size = sock.readinto(self.mv[self.end:])
+
+        if size:
+            self.end += size
+        return size
+
+    def recvfrom_into(self, sock):
+        """
+        Read one datagram into the buffer
+        @return: (number of bytes read, sender address)
+        """
+        if hasattr(sock, 'recvfrom_into'):
+            size, addr = sock.recvfrom_into(self.mv[self.end:])
+        else:
+            # Micropython sockets only have recvfrom
+            data, addr = sock.recvfrom(len(self.buf) - self.end)
+            size = len(data)
+            self.mv[self.end:self.end + size] = data
+
+        self.end += size
+        return size, addr
+
+    def feed(self, data, callback):
+        """
+        Copy data read by someone else (e.g. an asyncio transport) and dispatch every complete frame
+        """
+        view = memoryview(data)
+        while len(view):
+            size = min(len(view), len(self.buf) - self.end)
+            self.mv[self.end:self.end + size] = view[:size]
+            self.end += size
+            view = view[size:]
+            self.process(callback)
+
+    def process(self, callback):
+        """
+        Dispatch every complete frame and keep the partial one for the next read
+        """
+        self.start = decode_frames(self.buf, self.mv, self.start, self.end, callback)
+
+        remaining = self.end - self.start
+        if not remaining:
+            self.start = self.end = 0
+        elif self.start:
+            self.mv[:remaining] = self.mv[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        elif self.end == len(self.buf):
+            # Whole buffer and still no complete frame, this is garbage
+            print('ERROR ON MESSAGE: FRAME TOO LARGE, DROPPING %d BYTES' % self.end)
+            self.start = self.end = 0
+
+
 class BaseConnection:
     buf_size = 1024
     encoding = 'ascii'
 
-    def __init__(self, target_func, host: str = HOST, port: int = PORT, *args, **kwargs):
+    def __init__(self, target_func, host: str = HOST, port: int = PORT, codec: str = Codec.BINARY, *args, **kwargs):
+        """
+        :param codec: Preferred codec, connections always start on text until the other side agrees to it
+        """
         super().__init__(*args, **kwargs)
         self.target_func = target_func
         self.host = host
         self.port = port
+        self.preferred_codec = codec
+        self.codec = Codec.TEXT
+        self._tx = bytearray(MAX_FRAME)
+        self.reader = FrameReader(self.buf_size)
 
-    def handle_message(self, messages):
+    def handle_connected(self, data):
         """
-        Handle Incoming event and run whatever in response
+        Codec negotiation, implemented by client and server
         """
 
-        # This For loop will handle if the socket sent multiple messages at once
-        print('MESSAGES', messages)
-        for message in messages.split(END_CHAR):
-            message = message.strip('')
+    def dispatch(self, event, data):
+        if event == NetworkEvent.CONNECTED:
+            self.handle_connected(data)
+        self.target_func(event, data)
 
-            if not message or message == '':
-                continue
-            try:
-                event, data = message.split(SEP_CHAR)
-            except ValueError as e:
-                print(f'ERROR ON MESSAGE: {message}')
-                raise e
+    def handle_message(self, messages):
+        """
+        Handle Incoming event and run whatever in response
 
-            self.target_func(event, data)
+        @return: number of bytes consumed, anything after is an incomplete frame
+        """
+        return decode_frames(messages, memoryview(messages), 0, len(messages), self.dispatch)
 
-    @classmethod
-    def _send(cls, _conn, event, data=EMPTY_CHAR):
+    def receive(self, _conn):
+        """
+        Read from socket and dispatch all complete frames, partial frames are kept for the next read
+        @return: number of bytes read, 0 when socket is closed
+        """
+        size = self.reader.recv_into(_conn)
+        if size:
+            self.reader.process(self.dispatch)
+        return size
+
+    def _send(self, _conn, event, data=EMPTY_CHAR, codec=None):
         """
         Send message to socket
         """
-        message = '%s%s%s%s' % (event, SEP_CHAR, data, END_CHAR)
-        _conn.send(message.encode(cls.encoding))
+        if (codec or self.codec) == Codec.BINARY:
+            size = encode_binary(self._tx, event, data)
+            self._write(_conn, memoryview(self._tx)[:size])
+        else:
+            self._write(_conn, encode_text(event, data))
+
+    def _write(self, _conn, data):
+        _conn.send(data)
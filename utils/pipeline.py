@@ -0,0 +1,220 @@
+"""
+Camera pipeline, capture, encode and send each on their own threads
+
+OpenCV releases the GIL while it grabs, resizes and encodes, so the stages (and the encoder threads) really run on
+separate cores. Stages are joined by small queues that drop their oldest frame instead of blocking, a slow encoder
+or socket only ever costs the frames it could not keep up with and never holds up capture
+"""
+import collections
+import threading
+import time
+from utils.loop import LoopStats
+
+
+def _elapsed_us(started: float) -> int:
+    return int((time.perf_counter() - started) * 1000000)
+
+
+class DropQueue:
+    """
+    Bounded queue between two stages, putting into a full queue drops the oldest item
+    """
+
+    def __init__(self, size: int, keep=None):
+        """
+        :param keep: Items keep(item) is true for are only dropped when everything queued is one of them
+        """
+        self.size = size
+        self.keep = keep
+        self._items = collections.deque()
+        self._ready = threading.Condition()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._ready:
+            if len(self._items) >= self.size:
+                self.dropped += 1
+                self._drop()
+            self._items.append(item)
+            self._ready.notify()
+
+    def _drop(self):
+        if self.keep:
+            for i, queued in enumerate(self._items):
+                if not self.keep(queued):
+                    del self._items[i]
+                    return
+        self._items.popleft()
+
+    def get(self, timeout: float = None):
+        """
+        @return: oldest item, None when nothing came in within timeout seconds
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+
+class Pipeline:
+    """
+    Runs `capture` (see utils.camera.Capture) at its fps and hands every encoded frame to `send`
+
+    Capture is paced on deadlines, so time spent grabbing doesn't add up as drift. With more than one encoder frames
+    can finish out of order, a frame finishing after a newer one was sent is dropped as stale.
+
+    Keyframes of delta frames are never stale, and a full queue only drops one when a newer keyframe is queued, since
+    every delta until the next keyframe depends on it
+    """
+    # Stages check for stop this often while their queue is empty
+    wait_timeout = 0.1  # seconds
+
+    def __init__(self, capture, send, encoders: int = 2, queue_size: int = 2):
+        """
+        :param send: Called with every encoded frame from the send thread, stops the pipeline when it raises OSError
+        :param encoders: Encoder threads
+        :param queue_size: Frames each queue holds before it starts dropping the oldest
+        """
+        self.capture = capture
+        self.send = send
+        self.encoders = encoders
+        # Captured frames waiting for an encoder, encoded frames waiting to be sent
+        self.frames = DropQueue(queue_size)
+        # Capture.is_keyframe, nothing is a keyframe without delta frames
+        self._is_keyframe = getattr(capture, 'is_keyframe', None)
+        self.encoded = DropQueue(queue_size, keep=self._keyframe_item if self._is_keyframe else None)
+
+        self.captured = 0
+        self.sent = 0
+        # Capture deadlines missed by more than a frame, frames encoded after a newer one was sent
+        self.late = 0
+        self.stale = 0
+        # Time spent in each stage, and from capture until sent
+        self.capture_cost = LoopStats()
+        self.encode_cost = LoopStats()
+        self.send_cost = LoopStats()
+        self.latency = LoopStats()
+        # Average size of a sent frame
+        self.frame_bytes = 0
+
+        self._last_sent = 0
+        self._running = threading.Event()
+        self._threads = []
+        self._reported_at = time.monotonic()
+        self._reported_sent = 0
+
+    def _keyframe_item(self, item) -> bool:
+        return self._is_keyframe(item[2])
+
+    @property
+    def running(self) -> bool:
+        return self._running.is_set()
+
+    @property
+    def dropped(self) -> int:
+        return self.frames.dropped + self.encoded.dropped + self.stale
+
+    def start(self):
+        self._running.set()
+        self._threads = [threading.Thread(target=self._capture, daemon=True)]
+        self._threads += [threading.Thread(target=self._encode, daemon=True) for _ in range(self.encoders)]
+        self._threads.append(threading.Thread(target=self._send, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._running.clear()
+        current = threading.current_thread()
+        for thread in self._threads:
+            if thread is not current:
+                thread.join()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until the pipeline stops by itself
+        @return: True once stopped, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.wait_timeout)
+        return True
+
+    def report(self) -> str:
+        """
+        fps achieved since the last report, average capture/encode/send and capture to sent time in ms,
+        and frames dropped so far
+        """
+        now = time.monotonic()
+        fps = (self.sent - self._reported_sent) / max(now - self._reported_at, 1e-6)
+        self._reported_at = now
+        self._reported_sent = self.sent
+        value = '%.1ffps %d/%d/%d/%dms %d drop' % (
+            fps, self.capture_cost.avg_us // 1000, self.encode_cost.avg_us // 1000, self.send_cost.avg_us // 1000,
+            self.latency.avg_us // 1000, self.dropped,
+        )
+        for stats in (self.capture_cost, self.encode_cost, self.send_cost, self.latency):
+            stats.reset()
+        return value
+
+    def _capture(self):
+        deadline = time.monotonic()
+        while self.running:
+            # fps may change while running
+            interval = 1 / self.capture.fps
+            started = time.perf_counter()
+            frame, timestamp = self.capture.grab()
+            self.capture_cost.add(_elapsed_us(started))
+            if frame is not None:
+                self.captured += 1
+                self.frames.put((self.captured, timestamp, frame))
+
+            deadline += interval
+            now = time.monotonic()
+            if now - deadline > interval:
+                # Fell more than a whole frame behind, don't try to catch up with a burst
+                self.late += 1
+                deadline = now
+            else:
+                time.sleep(max(0.0, deadline - now))
+
+    def _encode(self):
+        while self.running:
+            item = self.frames.get(self.wait_timeout)
+            if item is None:
+                continue
+
+            sequence, timestamp, frame = item
+            started = time.perf_counter()
+            data = self.capture.encode(frame, timestamp, sequence)
+            self.encode_cost.add(_elapsed_us(started))
+            self.encoded.put((sequence, timestamp, data))
+
+    def _send(self):
+        while self.running:
+            item = self.encoded.get(self.wait_timeout)
+            if item is None:
+                continue
+
+            sequence, timestamp, data = item
+            if sequence <= self._last_sent and not (self._is_keyframe and self._is_keyframe(data)):
+                # A late keyframe still goes, the deltas sent before it were useless without it anyway
+                self.stale += 1
+                continue
+
+            started = time.perf_counter()
+            try:
+                self.send(data)
+            except OSError as e:
+                print('ERROR CONNECTION %s' % e)
+                self._running.clear()
+                return
+            self.send_cost.add(_elapsed_us(started))
+            self.latency.add(time.time_ns() // 1000 - timestamp)
+            self.frame_bytes += (len(data) - self.frame_bytes) // 8
+            self._last_sent = max(self._last_sent, sequence)
+            self.sent += 1
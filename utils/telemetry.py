@@ -1,5 +1,6 @@
 import time
 from utils import network, helpers
+from utils.loop import LoopStats
 
 
 def get_cpu_temperature(**kwargs):
@@ -33,13 +34,13 @@ def get_signal_strength(**kwargs):
 
 def get_battery_percent(**kwargs):
     # TODO: DO THIS SOMEHOW
-    return str(0.0)
+    return 0.0
 
 
 def get_rotation(controller=None, **kwargs):
     if not controller:
-        return '0,0,0'
-    return ','.join(['%.2f' % x for x in controller.sensor.angles])
+        return [0.0, 0.0, 0.0]
+    return controller.sensor.angles
 
 
 def get_throttle(controller=None, **kwargs):
@@ -48,6 +49,60 @@ def get_throttle(controller=None, **kwargs):
     return ','.join([str(f'{x.code}={x.throttle}') for x in controller.motors])
 
 
+def get_loop_time(loop=None, **kwargs):
+    """
+    Average/max/last work time of a networking loop iteration, waiting for sockets excluded
+    """
+    if not loop:
+        return 'None'
+    value = str(loop.stats)
+    loop.stats.reset()
+    return value
+
+
+def get_blackbox(blackbox=None, **kwargs):
+    """
+    Records written/dropped and time spent recording in the control loop
+    """
+    if not blackbox:
+        return 'None'
+    value = '%d/%d %s' % (blackbox.written, blackbox.dropped, blackbox.cost)
+    blackbox.cost.reset()
+    return value
+
+
+def get_session(server=None, **kwargs):
+    """
+    Sessions resumed/started and how long the last resume took
+    """
+    if not server:
+        return 'None'
+    return '%d/%d %sms' % (server.sessions_resumed, server.sessions_started, server.last_reconnect_ms)
+
+
+def get_link(server=None, **kwargs):
+    """
+    Round trip/jitter and loss of the link, as measured by the client and reported with its pings
+    """
+    if not server or not server.link:
+        return 'None'
+    rtt, jitter, loss = server.link
+    return '%.1f/%.1fms %.1f%%' % (rtt / 1000, jitter / 1000, loss / 10)
+
+
+def get_video(pipeline=None, **kwargs):
+    """
+    Camera pipeline fps, stage times and drops, and compression of delta frames, None where there is no camera
+    so nothing is sent
+    """
+    if not pipeline:
+        return None
+    delta = getattr(pipeline.capture, 'delta', None)
+    if delta:
+        return '%s %s' % (pipeline.report(), delta)
+    return pipeline.report()
+
+
 class TelemetryRecord:
     RPI_TEMP = 'RPI_TEMP'
     RPI_CPU = 'RPI_CPU'
@@ -56,9 +111,32 @@ class TelemetryRecord:
     BATTERY = 'BATTERY'
     ROTATION = 'ROTATION'
     THROTTLE = 'THROTTLE'
+    LOOP_TIME = 'LOOP_TIME'
+    BLACKBOX = 'BLACKBOX'
+    SESSION = 'SESSION'
+    LINK = 'LINK'
+    VIDEO = 'VIDEO'
+
+    SOURCES = {
+        RPI_TEMP: get_cpu_temperature,
+        RPI_CPU: get_cpu_percent,
+        RPI_MEM: get_mem_percent,
+        SIG_STR: get_signal_strength,
+        BATTERY: get_battery_percent,
+        ROTATION: get_rotation,
+        THROTTLE: get_throttle,
+        LOOP_TIME: get_loop_time,
+        BLACKBOX: get_blackbox,
+        SESSION: get_session,
+        LINK: get_link,
+        VIDEO: get_video,
+    }
 
     @classmethod
     def all(cls):
+        """
+        Index in this list is the record id in snapshots, only ever append to it
+        """
         return [
             cls.RPI_TEMP,
             cls.RPI_CPU,
@@ -67,39 +145,263 @@ class TelemetryRecord:
             cls.BATTERY,
             cls.ROTATION,
             cls.THROTTLE,
+            cls.LOOP_TIME,
+            cls.BLACKBOX,
+            cls.SESSION,
+            cls.LINK,
+            cls.VIDEO,
         ]
 
     @classmethod
     def read_value(cls, value: str, **kwargs):
-        return {
-            cls.RPI_TEMP: get_cpu_temperature,
-            cls.RPI_CPU: get_cpu_percent,
-            cls.RPI_MEM: get_mem_percent,
-            cls.SIG_STR: get_signal_strength,
-            cls.BATTERY: get_battery_percent,
-            cls.ROTATION: get_rotation,
-            cls.THROTTLE: get_throttle,
-        }[value](**kwargs)
+        return cls.SOURCES[value](**kwargs)
+
+
+"""
+Snapshot payload, every record of one cycle in a single frame
+
+    | RECORD ID u8 | LENGTH u8 | VALUE ascii ... | RECORD ID u8 | ...
+"""
+
+
+def encode_snapshot_record(buf, offset: int, record_id: int, value: str) -> int:
+    """
+    Write one record into buf at offset
+    @return: offset after the record
+    """
+    value = value.encode('ascii')
+    size = min(len(value), 255)
+    buf[offset] = record_id
+    buf[offset + 1] = size
+    buf[offset + 2:offset + 2 + size] = value[:size]
+    return offset + 2 + size
+
+
+def decode_snapshot(data):
+    """
+    @return: list of (record name, value)
+    """
+    records = TelemetryRecord.all()
+    result = []
+    offset = 0
+    while offset + 2 <= len(data):
+        record_id = data[offset]
+        size = data[offset + 1]
+        value = str(data[offset + 2:offset + 2 + size], 'ascii')
+        offset += 2 + size
+        if record_id < len(records):
+            result.append((records[record_id], value))
+    return result
+
+
+def format_value(value) -> str:
+    """
+    Sources return raw values, this is how they look on the wire
+    """
+    if isinstance(value, float):
+        return '%.2f' % value
+    if isinstance(value, (list, tuple)):
+        return ','.join([format_value(x) for x in value])
+    return str(value)
+
+
+def value_changed(old, new, deadband) -> bool:
+    """
+    Numbers (or sequences of numbers) only count as changed past the deadband, anything else on any change
+    """
+    if old is None:
+        return True
+    if deadband is None:
+        return old != new
+    if isinstance(new, (list, tuple)):
+        for a, b in zip(old, new):
+            if abs(a - b) >= deadband:
+                return True
+        return False
+    return abs(old - new) >= deadband
+
+
+# Priorities, high priority sources are never throttled
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+# RECORD: (rate in Hz, deadband, priority)
+SCHEDULE = {
+    TelemetryRecord.ROTATION: (20, 0.5, PRIORITY_HIGH),
+    TelemetryRecord.THROTTLE: (20, None, PRIORITY_HIGH),
+    TelemetryRecord.LOOP_TIME: (1, None, PRIORITY_NORMAL),
+    TelemetryRecord.BLACKBOX: (1, None, PRIORITY_LOW),
+    TelemetryRecord.SESSION: (1, None, PRIORITY_LOW),
+    TelemetryRecord.LINK: (1, None, PRIORITY_LOW),
+    TelemetryRecord.VIDEO: (1, None, PRIORITY_LOW),
+    TelemetryRecord.SIG_STR: (1, None, PRIORITY_NORMAL),
+    TelemetryRecord.RPI_CPU: (1, None, PRIORITY_LOW),
+    TelemetryRecord.RPI_TEMP: (0.2, None, PRIORITY_LOW),
+    TelemetryRecord.RPI_MEM: (0.2, None, PRIORITY_LOW),
+    TelemetryRecord.BATTERY: (0.2, 1.0, PRIORITY_LOW),
+}
+
+
+class TelemetrySource:
+    # Send even unchanged values this often so late clients catch up
+    refresh_interval = 5000  # ms
+    # Slowest a throttled source can go, as a multiple of its interval
+    max_throttle = 8
+
+    def __init__(self, record: str, record_id: int, func, rate: float, deadband=None, priority: int = PRIORITY_NORMAL):
+        self.record = record
+        self.record_id = record_id
+        self.func = func
+        self.interval = int(1000 / rate)  # ms
+        self.deadband = deadband
+        self.priority = priority
+        # Current interval is interval * throttle
+        self.throttle = 1
+
+        self.deadline = helpers.ticks_ms()
+        self.value = None
+        self.sent_at = None
+        # Time spent in func
+        self.cost = LoopStats()
+
+    def due(self, now: int) -> bool:
+        return helpers.ticks_diff(now, self.deadline) >= 0
+
+    def read(self, now: int, **kwargs):
+        started = helpers.ticks_us()
+        value = self.func(**kwargs)
+        self.cost.add(helpers.ticks_diff(helpers.ticks_us(), started))
+        self.deadline = helpers.ticks_add(now, self.interval * self.throttle)
+        return value
+
+    def should_send(self, now: int, value) -> bool:
+        if self.sent_at is None or helpers.ticks_diff(now, self.sent_at) >= self.refresh_interval:
+            return True
+        return value_changed(self.value, value, self.deadband)
 
 
 class Telemetry:
     """
     This class will aggregate all readings on pi side and
     then send them to client on a different or same socket every x seconds
+
+    Each record has its own rate, deadband and priority (see SCHEDULE), every cycle only due records that changed are
+    written in one preallocated buffer and sent as a single SNAPSHOT. When reading sources takes longer than
+    `budget` the most expensive low priority source is slowed down, and sped back up once there is room again
     """
 
     def __init__(self, send_callback, **kwargs):
         self.send_callback = send_callback
-        self.cycle_speed = 100
+        self.cycle_speed = 25
+        self.budget = 2000  # us
         self.options = kwargs
+        self.sources = []
+        self._buf = bytearray(network.MAX_PAYLOAD)
+        self._mv = memoryview(self._buf)
+        self.overruns = 0
+        self.release_after = 40  # cycles
+        self._calm = 0
+        # Records the client subscribed to, None for all of them
+        self.subscriptions = None
 
-    def loop(self):
-        # Get all readings then send them to client
         for record in TelemetryRecord.all():
-            value = TelemetryRecord.read_value(record, **self.options)
-            self.send_callback(network.NetworkEvent.TELEMETRY, helpers.encode_telemetry_record(record, value))
+            rate, deadband, priority = SCHEDULE.get(record, (1, None, PRIORITY_NORMAL))
+            self.register(record, TelemetryRecord.SOURCES[record], rate, deadband=deadband, priority=priority)
+
+    def register(self, record: str, func, rate: float, deadband=None, priority: int = PRIORITY_NORMAL):
+        """
+        Add or replace the source of a record
+        """
+        self.sources = [x for x in self.sources if x.record != record]
+        source = TelemetrySource(record, TelemetryRecord.all().index(record), func, rate, deadband, priority)
+        self.sources.append(source)
+        # Most important first so they always make it in the snapshot
+        self.sources.sort(key=lambda x: -x.priority)
+        return source
+
+    def subscribe(self, session):
+        """
+        Only send what the session subscribed to, and everything of it again on the next cycle
+        """
+        self.subscriptions = session.subscriptions
+        for source in self.sources:
+            source.sent_at = None
+            source.deadline = helpers.ticks_ms()
+
+    def _write(self, offset: int, source, value) -> int:
+        value = format_value(value)
+        if offset + 2 + len(value) > len(self._buf):
+            print('TELEMETRY SNAPSHOT FULL, SKIPPING %s' % source.record)
+            return offset
+        return encode_snapshot_record(self._buf, offset, source.record_id, value)
+
+    def snapshot(self):
+        """
+        Read every record into the snapshot buffer regardless of schedule
+        @return: memoryview of the payload, only valid until the next call
+        """
+        offset = 0
+        for source in self.sources:
+            value = source.func(**self.options)
+            if value is not None:
+                offset = self._write(offset, source, value)
+        return self._mv[:offset]
+
+    def collect(self):
+        """
+        Read due records into the snapshot buffer, skipping the ones that did not change
+        @return: memoryview of the payload, only valid until the next call
+        """
+        now = helpers.ticks_ms()
+        started = helpers.ticks_us()
+        offset = 0
+        for source in self.sources:
+            if self.subscriptions is not None and source.record not in self.subscriptions:
+                continue
+            if not source.due(now):
+                continue
+
+            value = source.read(now, **self.options)
+            if value is None or not source.should_send(now, value):
+                continue
+
+            source.value = value
+            source.sent_at = now
+            offset = self._write(offset, source, value)
+
+        self.balance(helpers.ticks_diff(helpers.ticks_us(), started))
+        return self._mv[:offset]
+
+    def balance(self, elapsed: int):
+        """
+        Throttle the most expensive low priority source on overrun, release one when well under budget
+        """
+        if elapsed > self.budget:
+            self.overruns += 1
+            candidates = [x for x in self.sources if x.priority < PRIORITY_HIGH and x.throttle < x.max_throttle]
+            if candidates:
+                source = max(candidates, key=lambda x: (-x.priority, x.cost.avg_us))
+                source.throttle *= 2
+            self._calm = 0
+        elif elapsed < self.budget // 4:
+            # Only release after a while under budget, otherwise it flips back and forth every cycle
+            self._calm += 1
+            if self._calm < self.release_after:
+                return
+            self._calm = 0
+            for source in self.sources:
+                if source.throttle > 1:
+                    source.throttle //= 2
+                    break
+
+    def loop(self):
+        # Get due readings then send them to client
+        payload = self.collect()
+        if len(payload):
+            self.send_callback(network.NetworkEvent.SNAPSHOT, payload)
 
     def run(self):
         while True:
             self.loop()
-            time.sleep(self.cycle_speed)
+            time.sleep(self.cycle_speed / 1000)